@@ -63,9 +63,9 @@ def annotation_ancestors(search_g, node):
 
 def update_annotation(request, dest_g, annotations_g, anno_uri):
     old_anno_g = annotation_graph(dest_g, anno_uri)
+    new_anno_g = annotation_graph(annotations_g, anno_uri)
     for t in old_anno_g:
         dest_g.remove(t)
-    new_anno_g = annotation_graph(annotations_g, anno_uri)
     new_anno_g.add((anno_uri, NS.oa['annotatedAt'], Literal(datetime.utcnow())))
     if request.user.is_authenticated():
         user_uri = uris.uri('semantic_store_users', username=request.user.username)
@@ -74,8 +74,7 @@ def update_annotation(request, dest_g, annotations_g, anno_uri):
         new_anno_g.add((user_uri, NS.foaf['name'], Literal(request.user.username)))
         new_anno_g.add((user_uri, NS.foaf['mbox'], 
                         URIRef("mailto:" + request.user.email)))
-    for t in new_anno_g:
-        dest_g.add(t)
+    dest_g += new_anno_g
     return new_anno_g
 
 def create_or_update_annotations(request, dest_graph_uri=None, anno_uri=None):
@@ -95,7 +94,8 @@ def create_or_update_annotations(request, dest_graph_uri=None, anno_uri=None):
 
     with transaction.commit_on_success():
         for i in anno_uris:
-            stored_g = update_annotation(request, dest_g, annotations_g, i)
+            with rdfstore().batch():
+                stored_g = update_annotation(request, dest_g, annotations_g, i)
 
     return NegotiatedGraphResponse(request, stored_g, status=201)
 
@@ -1,11 +1,11 @@
 from django.db import transaction
 
 from rdflib import Literal, URIRef, Graph
-from rdflib.plugins.sparql import prepareQuery
 
 from semantic_store.rdfstore import rdfstore
 from semantic_store.namespaces import NS, ns, bind_namespaces
 from semantic_store.utils import metadata_triples, timed_block
+from semantic_store import subgraphs
 
 from itertools import chain
 
@@ -43,6 +43,7 @@ def annotation_subgraph(graph, anno):
     return subgraph
 
 def resource_annotation_subgraph(graph, resource_uri):
+    graph = subgraphs.resource_annotations(graph, resource_uri)
     subgraph = Graph()
 
     for anno, p, o in graph.triples_choices((None, [NS.oa.hasTarget, NS.oa.hasBody], resource_uri)):
@@ -0,0 +1,192 @@
+"""
+Write batching for the rdflib stores used by DM.
+
+Inside a `with store.batch():` block, triples added to or removed from any graph backed by the
+store are buffered (per thread) rather than written one at a time, and are written together when
+the outermost block exits. Consecutive adds (and consecutive removes) are grouped by named graph,
+so each group can be written as a single operation by the backend.
+
+Reads made inside a batch flush the pending writes first, so code in the block always sees its own
+writes. If the block raises an exception, writes which have not been flushed yet are discarded.
+
+Writes made outside of a batch are written as a batch of their own, so every write to the store
+passes through `_write_batch`, and is announced to the store's `write_listeners` once written.
+Each callable in `before_write_listeners` is called with the batch just before it is written, while
+the store still holds the triples it is about to remove. Each callable in `write_guards` is called
+with the batch, and returns a context manager held while the batch is written and announced (e.g. a
+lock, so the writes of a graph are announced in the order they were made).
+
+Removing the pattern (None, None, None) from a named graph (`drop_graph`) drops the whole graph,
+which the backends write natively (DROP GRAPH, or a delete by context), rather than as a pattern
+delete.
+"""
+from contextlib import contextmanager
+from collections import OrderedDict
+import threading
+
+ADD = 'add'
+REMOVE = 'remove'
+
+def is_drop(triple, context):
+    """Whether removing a triple pattern from a context drops the whole named graph"""
+    return context is not None and triple == (None, None, None)
+
+class WriteBatch(object):
+    """
+    An ordered buffer of add and remove operations.
+
+    Operations are kept as a list of runs; each run holds only adds or only removes, grouped by
+    context, so the order between adds and removes (e.g. from Graph.set) is preserved while the
+    operations within a run can be sent together.
+    """
+
+    def __init__(self):
+        self.runs = []
+        self.contexts = {}
+
+    def __len__(self):
+        return sum(len(triples) for kind, by_context in self.runs for triples in by_context.values())
+
+    def _run(self, kind):
+        if not self.runs or self.runs[-1][0] != kind:
+            self.runs.append((kind, OrderedDict()))
+        return self.runs[-1][1]
+
+    def _context_key(self, context):
+        if context is None:
+            return None
+
+        key = context.identifier
+        self.contexts.setdefault(key, context)
+        return key
+
+    def add(self, triple, context=None):
+        triples = self._run(ADD).setdefault(self._context_key(context), OrderedDict())
+        triples[triple] = True
+
+    def remove(self, triple, context=None):
+        triples = self._run(REMOVE).setdefault(self._context_key(context), OrderedDict())
+        triples[triple] = True
+
+    def operations(self):
+        """Yields (kind, context, triples) for each context of each run, in order"""
+        for kind, by_context in self.runs:
+            for key, triples in by_context.iteritems():
+                yield kind, self.contexts.get(key), list(triples)
+
+    def graph_identifiers(self):
+        """Returns the set of named graph identifiers written to by this batch"""
+        return set(key for key in self.contexts)
+
+class BatchingStore(object):
+    """
+    Mixin for rdflib stores adding the `batch` context manager.
+
+    Concrete stores implement `_write_batch(batch)`, which must apply every operation of a
+    WriteBatch, in order, in as few round trips (or as one transaction) as the backend allows.
+    Reads should call `flush_batch()` before touching the underlying storage.
+
+    Each callable in `write_listeners` is called with every batch after it has been written, and
+    each callable in `before_write_listeners` before it is written, inside the context managers
+    returned by each callable in `write_guards`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._batch_local = threading.local()
+        self.before_write_listeners = []
+        self.write_listeners = []
+        self.write_guards = []
+        super(BatchingStore, self).__init__(*args, **kwargs)
+
+    def current_batch(self):
+        """Returns the WriteBatch of the calling thread, or None if it is not inside a batch"""
+        return getattr(self._batch_local, 'batch', None)
+
+    @contextmanager
+    def batch(self):
+        local = self._batch_local
+        depth = getattr(local, 'depth', 0)
+
+        if depth == 0:
+            local.batch = WriteBatch()
+        local.depth = depth + 1
+
+        try:
+            yield local.batch
+        except:
+            if depth == 0:
+                local.batch = None
+            raise
+        finally:
+            local.depth = depth
+
+        if depth == 0:
+            batch, local.batch = local.batch, None
+            if len(batch) > 0:
+                self._write(batch)
+
+    def flush_batch(self):
+        """Writes any operations buffered by the calling thread's batch, which stays open"""
+        batch = self.current_batch()
+
+        if batch is not None and len(batch) > 0:
+            self._batch_local.batch = WriteBatch()
+            self._write(batch)
+
+    def _write(self, batch, guards=None):
+        if guards is None:
+            guards = list(self.write_guards)
+        if guards:
+            with guards[0](batch):
+                return self._write(batch, guards[1:])
+
+        for listener in self.before_write_listeners:
+            listener(batch)
+
+        self._write_batch(batch)
+
+        for listener in self.write_listeners:
+            listener(batch)
+
+    def _write_batch(self, batch):
+        raise NotImplementedError()
+
+    def add(self, triple, context=None, quoted=False):
+        batch = self.current_batch()
+
+        if quoted:
+            super(BatchingStore, self).add(triple, context, quoted)
+        elif batch is not None:
+            batch.add(triple, context)
+        else:
+            with self.batch() as batch:
+                batch.add(triple, context)
+
+    def addN(self, quads):
+        with self.batch() as batch:
+            for s, p, o, context in quads:
+                batch.add((s, p, o), context)
+
+    def remove(self, triple, context=None):
+        with self.batch() as batch:
+            batch.remove(triple, context)
+
+    def drop_graph(self, context):
+        """Removes every triple of a named graph"""
+        self.remove((None, None, None), context)
+
+    def triples(self, triple, context=None):
+        self.flush_batch()
+        return super(BatchingStore, self).triples(triple, context)
+
+    def triples_choices(self, triple, context=None):
+        self.flush_batch()
+        return super(BatchingStore, self).triples_choices(triple, context)
+
+    def __len__(self, context=None):
+        self.flush_batch()
+        return super(BatchingStore, self).__len__(context)
+
+    def contexts(self, triple=None):
+        self.flush_batch()
+        return super(BatchingStore, self).contexts(triple)
@@ -0,0 +1,279 @@
+"""
+Materialised canvas views.
+
+Reading a canvas of a project (canvases.generate_canvas_graph) gathers the canvas, its images,
+the annotations on it and in its annotation lists, and its specific resources from the project
+graph. The result is stored as a graph of its own, under the canvas's identifier in the project
+(uris.canvas_view_graph_identifier), and later reads of the canvas are served from it.
+
+A view is recorded (models.CanvasView) with the resources it was built from: the subjects of its
+triples, and the resources they link to. Every write to a project graph is seen by the store's
+write listeners (see CanvasViews); the views built from any resource the write touched (its
+subjects, and the resources it links to, e.g. the canvas targeted by a new annotation) are
+invalidated, their graphs dropped, and built again when they are next read. A write to the project
+graph made while a view is being built invalidates the view as soon as it is stored. A view graph
+read while it is invalidated (or stored again) may be incomplete, so it is only served if its record
+still exists once it has been read, and is not empty.
+
+Views are only stored for the canvases a project holds (project_canvases); other canvases are read
+from the project graph each time, so reads of arbitrary uris do not add views.
+
+Several canvases (e.g. the next pages of a manuscript) are read together by read_many: the stored
+views are read concurrently, and the missing ones are built from one set-based read of the project
+graph (subgraphs.canvases).
+
+The rebuild_canvas_views command builds the views of existing projects.
+"""
+from django.db import transaction
+
+from rdflib import Graph, URIRef
+
+from semantic_store.models import CanvasView, CanvasViewResource
+from semantic_store.namespaces import NS
+from semantic_store import uris, subgraphs
+
+# Predicates whose objects are terms of a vocabulary, rather than resources of the project
+VOCABULARY_PREDICATES = (NS.rdf.type, NS.oa.motivatedBy)
+
+# Number of resources looked up at a time
+CHUNK_SIZE = 500
+
+def default_store(store):
+    if store is None:
+        from semantic_store.rdfstore import rdfstore
+        store = rdfstore()
+    return store
+
+def linked_resources(triples):
+    """
+    Returns the resources the triples (or triple patterns) are about: their subjects, and the
+    resources they link to. Returns None if a pattern could match any resource.
+    """
+    resources = set()
+    for s, p, o in triples:
+        if s is not None:
+            resources.add(s)
+        elif not isinstance(o, URIRef):
+            return None
+
+        if isinstance(o, URIRef) and p not in VOCABULARY_PREDICATES:
+            resources.add(o)
+    return resources
+
+def graph_revision(store, identifier):
+    catalog = getattr(store, 'catalog', None)
+    if catalog is None:
+        return None
+    return catalog.revisions([identifier])[unicode(identifier)][0]
+
+def held_canvases(project_uri, canvas_uris, store):
+    """The canvases, of those given, which the project aggregates, as listed in its metadata graph"""
+    metadata_graph = Graph(store, uris.project_metadata_graph_identifier(project_uri))
+    project_uri = URIRef(project_uri)
+    return set(canvas_uri for canvas_uri in canvas_uris
+               if (project_uri, NS.ore.aggregates, canvas_uri) in metadata_graph and
+               (canvas_uri, NS.rdf.type, NS.sc.Canvas) in metadata_graph)
+
+def store_views(project_uri, graphs, revision, store):
+    """
+    Stores the view graphs of canvases ({canvas_uri: graph}) built from the project graph at a
+    revision, and records what they were built from
+    """
+    project_identifier = uris.uri('semantic_store_projects', uri=project_uri)
+
+    with store.batch():
+        for canvas_uri, graph in graphs.iteritems():
+            view_graph = Graph(store, uris.canvas_view_graph_identifier(project_uri, canvas_uri))
+            store.drop_graph(view_graph)
+            for t in graph:
+                view_graph.add(t)
+
+    with transaction.commit_on_success():
+        for canvas_uri, graph in graphs.iteritems():
+            CanvasView.objects.filter(project=project_uri, canvas=canvas_uri).delete()
+            view = CanvasView.objects.create(project=project_uri, canvas=canvas_uri)
+            CanvasViewResource.objects.bulk_create(CanvasViewResource(view=view, resource=resource)
+                                                   for resource in linked_resources(graph) | set([URIRef(canvas_uri)]))
+
+    if revision != graph_revision(store, project_identifier):
+        # The project was written while the views were being built
+        for canvas_uri in graphs:
+            invalidate_canvas(project_uri, canvas_uri, store)
+
+def build(project_uri, canvas_uri, store=None):
+    """Builds the view of a canvas, stores it, and records what it was built from. Returns the view graph."""
+    return build_many(project_uri, [canvas_uri], store)[canvas_uri]
+
+def build_many(project_uri, canvas_uris, store=None):
+    """
+    Builds the views of several canvases, from one set-based read of the project graph (see
+    subgraphs.canvases), and stores those of the canvases the project holds. Returns a dictionary
+    of the view graphs by canvas.
+    """
+    # Imported here, as canvases reads its views through this module
+    from semantic_store.canvases import generate_canvas_graph
+
+    store = default_store(store)
+    project_identifier = uris.uri('semantic_store_projects', uri=project_uri)
+
+    revision = graph_revision(store, project_identifier)
+    if len(canvas_uris) > 1:
+        local = subgraphs.canvases(Graph(store, project_identifier), canvas_uris)
+    else:
+        local = None
+    graphs = dict((canvas_uri, generate_canvas_graph(project_uri, canvas_uri, store, local))
+                  for canvas_uri in canvas_uris)
+
+    held = held_canvases(project_uri, canvas_uris, store)
+    store_views(project_uri, dict((canvas_uri, graph) for canvas_uri, graph in graphs.iteritems() if canvas_uri in held),
+                revision, store)
+    return graphs
+
+def stored_view(project_uri, canvas_uri, store):
+    graph = Graph()
+    graph += Graph(store, uris.canvas_view_graph_identifier(project_uri, canvas_uri))
+    return graph
+
+def stored_canvases(project_uri, canvas_uris):
+    """The canvases, of those given, whose views are recorded as stored"""
+    stored = set()
+    for i in range(0, len(canvas_uris), CHUNK_SIZE):
+        stored.update(URIRef(canvas) for canvas in CanvasView.objects.filter(
+            project=project_uri, canvas__in=canvas_uris[i:i + CHUNK_SIZE]).values_list('canvas', flat=True))
+    return stored
+
+def read(project_uri, canvas_uri, store=None):
+    """Returns an in-memory graph of the view of a canvas, building it if it is not stored"""
+    store = default_store(store)
+
+    if CanvasView.objects.filter(project=project_uri, canvas=canvas_uri).exists():
+        graph = stored_view(project_uri, canvas_uri, store)
+        # Invalidation deletes the record before dropping the graph
+        if len(graph) and CanvasView.objects.filter(project=project_uri, canvas=canvas_uri).exists():
+            return graph
+
+    return build(project_uri, canvas_uri, store)
+
+def read_many(project_uri, canvas_uris, store=None):
+    """
+    Returns a list of (canvas_uri, in-memory view graph) for each of the canvases, in order. The
+    stored views are read concurrently, and the views which are not stored are built together.
+    """
+    # Imported here, as rdfstore wires the views into the store
+    from semantic_store.rdfstore import gather
+
+    store = default_store(store)
+    canvas_uris = [URIRef(canvas_uri) for canvas_uri in canvas_uris]
+
+    stored = stored_canvases(project_uri, canvas_uris)
+    stored = [canvas_uri for canvas_uri in canvas_uris if canvas_uri in stored]
+    project_graph = Graph(store, uris.uri('semantic_store_projects', uri=project_uri))
+    graphs = dict(zip(stored, gather(project_graph, [
+        lambda canvas_uri=canvas_uri: stored_view(project_uri, canvas_uri, store) for canvas_uri in stored])))
+
+    # As in read, views invalidated while they were read are built again
+    still_stored = stored_canvases(project_uri, stored)
+    graphs = dict((canvas_uri, graph) for canvas_uri, graph in graphs.iteritems()
+                  if len(graph) and canvas_uri in still_stored)
+
+    missing = [canvas_uri for canvas_uri in canvas_uris if canvas_uri not in graphs]
+    if missing:
+        graphs.update(build_many(project_uri, missing, store))
+
+    return [(canvas_uri, graphs[canvas_uri]) for canvas_uri in canvas_uris]
+
+def iter_views(project_uri, canvas_uris, chunk_size=None, store=None):
+    """
+    Yields (canvas_uri, in-memory view graph) for each of the canvases, in order, reading them
+    `chunk_size` canvases at a time (see read_many), so the first are ready before the rest are read
+    """
+    store = default_store(store)
+    chunk_size = chunk_size or subgraphs.CANVASES_PER_QUERY
+    canvas_uris = list(canvas_uris)
+
+    for i in range(0, len(canvas_uris), chunk_size):
+        for canvas_uri, graph in read_many(project_uri, canvas_uris[i:i + chunk_size], store):
+            yield canvas_uri, graph
+
+def drop(views, store):
+    views = list(views)
+    if not views:
+        return 0
+
+    with store.batch():
+        for project_uri, canvas_uri in views:
+            store.drop_graph(Graph(store, uris.canvas_view_graph_identifier(project_uri, canvas_uri)))
+    return len(views)
+
+def invalidate(project_uri, resources=None, store=None):
+    """
+    Invalidates the views of a project built from any of the resources (or all of its views, if
+    resources is None), returning the number invalidated
+    """
+    store = default_store(store)
+    views = CanvasView.objects.filter(project=project_uri)
+    if resources is None:
+        invalidated = list(views.values_list('pk', 'canvas'))
+    else:
+        # In chunks, within the bound parameter limits of the database
+        resources = sorted(unicode(resource) for resource in resources)
+        invalidated = set()
+        for i in range(0, len(resources), CHUNK_SIZE):
+            invalidated.update(views.filter(resources__resource__in=resources[i:i + CHUNK_SIZE])
+                               .values_list('pk', 'canvas'))
+        invalidated = sorted(invalidated)
+    if not invalidated:
+        return 0
+
+    with transaction.commit_on_success():
+        CanvasViewResource.objects.filter(view__in=[pk for pk, canvas in invalidated]).delete()
+        CanvasView.objects.filter(pk__in=[pk for pk, canvas in invalidated]).delete()
+
+    return drop(((project_uri, canvas) for pk, canvas in invalidated), store)
+
+def invalidate_canvas(project_uri, canvas_uri, store=None):
+    store = default_store(store)
+    with transaction.commit_on_success():
+        CanvasViewResource.objects.filter(view__project=project_uri, view__canvas=canvas_uri).delete()
+        CanvasView.objects.filter(project=project_uri, canvas=canvas_uri).delete()
+    drop([(project_uri, canvas_uri)], store)
+
+def project_canvases(project_uri, store=None):
+    """The canvases a project aggregates, as listed in its metadata graph"""
+    store = default_store(store)
+    metadata_graph = Graph(store, uris.project_metadata_graph_identifier(project_uri))
+    project_uri = URIRef(project_uri)
+    return sorted(set(canvas for canvas in metadata_graph.objects(project_uri, NS.ore.aggregates)
+                      if (canvas, NS.rdf.type, NS.sc.Canvas) in metadata_graph))
+
+def rebuild(project_uri, store=None):
+    """Builds the views of every canvas of a project again, returning the number built"""
+    store = default_store(store)
+    invalidate(project_uri, None, store)
+
+    canvases = project_canvases(project_uri, store)
+    for canvas_uri in canvases:
+        build(project_uri, canvas_uri, store)
+    return len(canvases)
+
+class CanvasViews(object):
+    """Invalidates the canvas views built from the resources written to project graphs"""
+    def __init__(self, store):
+        self.store = store
+        store.write_listeners.append(self.written)
+
+    def written(self, batch):
+        touched = {}
+        for kind, context, triples in batch.operations():
+            project_uri = uris.project_of_graph(context.identifier) if context is not None else None
+            if project_uri is None:
+                continue
+
+            resources = linked_resources(triples)
+            if resources is None or touched.get(project_uri, set()) is None:
+                touched[project_uri] = None
+            else:
+                touched.setdefault(project_uri, set()).update(resources)
+
+        for project_uri, resources in touched.iteritems():
+            invalidate(project_uri, resources, self.store)
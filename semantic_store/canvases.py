@@ -2,11 +2,10 @@ from django.db import transaction
 
 from rdflib.exceptions import ParserError
 from rdflib import Literal, URIRef, Graph
-from rdflib.plugins.sparql import prepareQuery
 
 from semantic_store.rdfstore import rdfstore
 from semantic_store.namespaces import NS, ns, bind_namespaces
-from semantic_store import uris, users
+from semantic_store import uris, users, subgraphs, queries, deltas, iiif
 from semantic_store.utils import parse_request_into_graph, NegotiatedGraphResponse, metadata_triples, list_subgraph, timed_block
 from semantic_store.annotations import resource_annotation_subgraph, canvas_annotation_lists, annotation_list_items, annotation_subgraph
 from semantic_store.specific_resources import specific_resources_subgraph
@@ -17,31 +16,28 @@ def canvas_and_images_graph(graph, canvas_uri):
     canvas_graph = Graph()
     canvas_graph += graph.triples((canvas_uri, None, None))
 
-    qres = graph.query("""SELECT ?image_anno ?image WHERE {
-        ?image_anno a oa:Annotation .
-        ?image_anno oa:hasTarget %s .
-        ?image_anno oa:hasBody ?image .
-        ?image a ?type .
-        FILTER(?type = dcmitype:Image || ?type = dms:Image || ?type = dms:ImageChoice) .
-    }""" % (canvas_uri.n3()), initNs=ns)
+    qres = queries.run('canvas_images', graph, canvas=canvas_uri)
 
     for image_anno, image in qres:
         canvas_graph += graph.triples_choices(([image_anno, image], None, None))
+        canvas_graph += image_derivatives_graph(graph, image)
 
     return canvas_graph
 
+def image_derivatives_graph(graph, image):
+    """The thumbnails and tile pyramid of an image (see image_derivatives)"""
+    derivatives_graph = Graph()
+
+    derivatives = list(graph.objects(image, NS.foaf.thumbnail)) + list(graph.objects(image, NS.sc.hasRelatedService))
+    if derivatives:
+        derivatives_graph += graph.triples_choices((derivatives, None, None))
+
+    return derivatives_graph
+
 def all_canvases_and_images_graph(graph):
     canvas_graph = Graph()
 
-    qres = graph.query("""SELECT DISTINCT ?canvas ?image_anno ?image WHERE {
-        ?canvas a ?canvasType .
-        ?image a ?imageType .
-        FILTER(?canvasType = sc:Canvas || ?canvasType = dms:Canvas) .
-        FILTER(?imageType = dcmitype:Image || ?imageType = dms:Image || ?imageType = dms:ImageChoice) .
-        ?image_anno a oa:Annotation .
-        ?image_anno oa:hasTarget ?canvas .
-        ?image_anno oa:hasBody ?image .
-    }""", initBindings={}, initNs=ns)
+    qres = queries.run('all_canvases_and_images', graph)
 
     for canvas, image_anno, image in qres:
         canvas_graph += graph.triples_choices(([canvas, image_anno, image], None, None))
@@ -74,6 +70,7 @@ def anno_lists_subgraph(graph, canvas_uri, project_uri):
 
 def canvas_subgraph(graph, canvas_uri, project_uri):
     canvas_uri = URIRef(canvas_uri)
+    graph = subgraphs.canvas(graph, canvas_uri)
 
     canvas_graph = Graph()
 
@@ -87,11 +84,14 @@ def canvas_subgraph(graph, canvas_uri, project_uri):
 
     return canvas_graph
 
-def generate_canvas_graph(project_uri, canvas_uri):
-    project_identifier = uris.uri('semantic_store_projects', uri=project_uri)
-    db_project_graph = Graph(store=rdfstore(), identifier=project_identifier)
-
-    project_graph = db_project_graph
+def generate_canvas_graph(project_uri, canvas_uri, store=None, project_graph=None):
+    """
+    Gathers the graph of a canvas from the project graph, or from project_graph, an in-memory graph
+    already holding its subgraph (see subgraphs.canvases)
+    """
+    if project_graph is None:
+        project_identifier = uris.uri('semantic_store_projects', uri=project_uri)
+        project_graph = Graph(store=store or rdfstore(), identifier=project_identifier)
 
     memory_graph = Graph()
     memory_graph += canvas_subgraph(project_graph, canvas_uri, project_uri)
@@ -109,51 +109,46 @@ def generate_canvas_graph(project_uri, canvas_uri):
     return memory_graph
 
 def update_canvas_graph(project_uri, canvas_uri):
-    identifier = uris.uri("semantic_store_project_canvases", project_uri=project_uri, canvas_uri=canvas_uri)
-    canvas_graph = Graph(rdfstore(), identifier=identifier)
-
-    for t in generate_canvas_graph(project_uri, canvas_uri):
-        canvas_graph.add(t)
+    """Builds and stores the materialised view of a canvas again, returning it"""
+    from semantic_store import canvas_views
 
-        return canvas_graph
+    canvas_views.invalidate_canvas(project_uri, canvas_uri)
+    return canvas_views.read(project_uri, canvas_uri)
 
 def read_canvas(request, project_uri, canvas_uri):
-    project_identifier = uris.uri('semantic_store_projects', uri=project_uri)
-    db_project_graph = Graph(store=rdfstore(), identifier=project_identifier)
+    # Imported here, as canvas_views builds the views with this module
+    from semantic_store import canvas_views
 
-    return canvas_subgraph(db_project_graph, canvas_uri, project_uri)
+    return canvas_views.read(project_uri, canvas_uri)
 
 def update_canvas(project_uri, canvas_uri, input_graph):
+    # Imported here, as project_metadata derives the metadata of canvases with this module
+    from semantic_store import project_metadata
+
     project_uri = URIRef(project_uri)
     canvas_uri = URIRef(canvas_uri)
 
     project_identifier = uris.uri('semantic_store_projects', uri=project_uri)
     project_graph = Graph(store=rdfstore(), identifier=project_identifier)
-    project_metadata_g = Graph(rdfstore(), identifier=uris.project_metadata_graph_identifier(project_uri))
-
-    if (canvas_uri, NS.dc.title, None) in input_graph:
-        project_graph.remove((canvas_uri, NS.dc.title, None))
-        project_metadata_g.remove((canvas_uri, NS.dc.title, None))
-    if (canvas_uri, NS.rdfs.label, None) in input_graph:
-        project_graph.remove((canvas_uri, NS.rdfs.label, None))
-        project_metadata_g.remove((canvas_uri, NS.rdfs.label, None))
 
-    project_graph += input_graph
-    project_metadata_g += canvas_and_images_graph(input_graph, canvas_uri)
+    with project_metadata.maintaining(project_uri):
+        delta = deltas.patch(project_graph, input_graph, [(canvas_uri, NS.dc.title), (canvas_uri, NS.rdfs.label)])
 
-    return project_graph
+    return project_graph, delta
 
 def remove_canvas_triples(project_uri, canvas_uri, input_graph):
-    project_graph = Graph(store=rdfstore(), identifier=canvas_identifier)
-    project_metadata_g = Graph(rdfstore(), identifier=uris.project_metadata_graph_identifier(project_uri))
+    from semantic_store import project_metadata
+
+    project_identifier = uris.uri('semantic_store_projects', uri=project_uri)
+    project_graph = Graph(store=rdfstore(), identifier=project_identifier)
 
     removed_graph = Graph()
 
-    for t in input_graph:
-        if t in project_graph:
-            project_graph.remove(t)
-            project_metadata_g.remove(t)
-            removed_graph.add(t)
+    with project_metadata.maintaining(project_uri), rdfstore().batch():
+        for t in input_graph:
+            if t in project_graph:
+                project_graph.remove(t)
+                removed_graph.add(t)
 
     return removed_graph
 
@@ -178,6 +173,9 @@ def create_canvas_from_upload(graph, uploaded_image, uri, user=None, title=None)
     graph.add((uri, NS.exif.width, width))
     graph.add((uri, NS.exif.height, height))
 
+    # Regions and sizes of the image are served by the IIIF image server
+    graph += iiif.service_graph(image_uri, uploaded_image)
+
     anno_uri = uris.uuid()
     graph.add((anno_uri, NS.rdf.type, NS.oa.Annotation))
     graph.add((anno_uri, NS.oa.motivatedBy, NS.sc.painting))
@@ -0,0 +1,151 @@
+"""
+A changelog of the writes to each project graph, from which clients holding a copy of a project at
+one revision can catch up with the changes made since, rather than reading the whole project again.
+
+Every write batch touching a project graph is recorded (models.ProjectChange) as the RDF Patch of
+the triples it added and removed, in order. The id of the entry is the project's revision after
+the write, so revisions increase monotonically, but are not consecutive within a project. A batch
+is written, and its entry inserted, holding a lock for each project it touches, so concurrent writes
+to a project in a process are logged in the order they were made in the store. Removals
+by pattern (e.g. from Graph.set) are expanded to the triples they remove, read from the store just
+before the batch is written; removing the whole graph is recorded as a truncated entry.
+
+`changes_since` returns the patch of the changes after a revision, as one RDF Patch transaction per
+write. Entries older than the retention window are compacted away (the compact_changelog command),
+leaving a truncated entry in their place; a client whose revision is before a truncated entry has
+to read the project again.
+"""
+from django.db import transaction
+from django.db.models import Max
+
+from rdflib import Graph
+from rdflib.plugins.serializers.nt import _nt_row
+
+from semantic_store.models import ProjectChange
+from semantic_store.batching import ADD
+from semantic_store import uris
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+
+ADDED = 'A'
+DELETED = 'D'
+
+# Number of locks the projects are spread over
+LOCK_STRIPES = 64
+
+RDF_PATCH_MIMETYPE = 'application/rdf-patch'
+
+class ChangesTruncated(Exception):
+    """Raised when the changes since a revision are no longer all in the changelog"""
+    pass
+
+def matches(pattern, triple):
+    return all(p is None or p == t for p, t in zip(pattern, triple))
+
+class ProjectChangelog(object):
+    def __init__(self, store):
+        self.store = store
+        self._local = threading.local()
+        self._locks = [threading.RLock() for i in range(LOCK_STRIPES)]
+        store.write_guards.append(self.locked)
+        store.before_write_listeners.append(self.writing)
+        store.write_listeners.append(self.written)
+
+    def is_project_graph(self, identifier):
+        return uris.project_of_graph(identifier) is not None
+
+    def graph_identifier(self, project_uri):
+        return unicode(uris.uri('semantic_store_projects', uri=project_uri))
+
+    @contextmanager
+    def locked(self, batch):
+        """Holds the locks of the projects a batch writes to, in order, while it is written and logged"""
+        stripes = sorted(set(hash(unicode(context.identifier)) % LOCK_STRIPES
+                             for kind, context, triples in batch.operations()
+                             if context is not None and self.is_project_graph(context.identifier)))
+        for stripe in stripes:
+            self._locks[stripe].acquire()
+        try:
+            yield
+        finally:
+            for stripe in reversed(stripes):
+                self._locks[stripe].release()
+
+    def writing(self, batch):
+        """Collects the changes a batch makes to project graphs, before it is written"""
+        changes = OrderedDict()
+        added = {}
+
+        for kind, context, triples in batch.operations():
+            if context is None or not self.is_project_graph(context.identifier):
+                continue
+
+            identifier = unicode(context.identifier)
+            lines, truncated = changes.get(identifier, ([], False))
+            graph_added = added.setdefault(identifier, [])
+
+            for triple in triples:
+                if kind == ADD:
+                    lines.append((ADDED, triple))
+                    graph_added.append(triple)
+                elif triple == (None, None, None):
+                    lines, truncated = [], True
+                    del graph_added[:]
+                elif None in triple:
+                    removed = set(Graph(self.store, context.identifier).triples(triple))
+                    removed.update(t for t in graph_added if matches(triple, t))
+                    lines.extend((DELETED, t) for t in removed)
+                else:
+                    lines.append((DELETED, triple))
+
+            changes[identifier] = (lines, truncated)
+
+        self._local.pending = (batch, changes)
+
+    def written(self, batch):
+        pending_batch, changes = getattr(self._local, 'pending', (None, None))
+        self._local.pending = None
+        if pending_batch is not batch:
+            return
+
+        for identifier, (lines, truncated) in changes.iteritems():
+            if lines or truncated:
+                ProjectChange.objects.create(graph=identifier, truncated=truncated,
+                                             patch=u''.join(u'%s %s' % (op, _nt_row(t)) for op, t in lines))
+
+    def revision(self, project_uri):
+        """The current revision of a project (0 if it has no changes in the log)"""
+        latest = ProjectChange.objects.filter(graph=self.graph_identifier(project_uri)).aggregate(Max('id'))['id__max']
+        return latest or 0
+
+    def changes_since(self, project_uri, revision):
+        """
+        Returns the project's current revision, and the RDF Patch of the changes made after the
+        given revision. Raises ChangesTruncated if some of those changes are no longer in the log.
+        """
+        entries = list(ProjectChange.objects.filter(graph=self.graph_identifier(project_uri), pk__gt=revision)
+                       .order_by('pk'))
+
+        if any(entry.truncated for entry in entries):
+            raise ChangesTruncated('The changes to %s since revision %d are no longer in the changelog' % (
+                project_uri, revision))
+
+        patch = u''.join(u'TX .\n%sTC .\n' % entry.patch for entry in entries)
+        return (entries[-1].pk if entries else revision), patch
+
+    def compact(self, before):
+        """
+        Removes the changes made before a datetime, leaving a truncated entry for each project at
+        the revision of its last removed change. Returns the number of entries removed.
+        """
+        removed = 0
+        for identifier, newest in (ProjectChange.objects.filter(created__lt=before, truncated=False)
+                                   .values('graph').annotate(newest=Max('id')).values_list('graph', 'newest')):
+            with transaction.commit_on_success():
+                old = ProjectChange.objects.filter(graph=identifier, pk__lt=newest)
+                removed += old.count()
+                old.delete()
+                ProjectChange.objects.filter(pk=newest).update(truncated=True, patch='')
+        return removed
@@ -3,10 +3,11 @@ from urllib2 import urlopen
 from argparse import ArgumentParser
 import pickle
 from rdflib.graph import ConjunctiveGraph
-from rdflib.term import URIRef
+from rdflib.term import URIRef, Literal
 from rdflib import RDF
 from semantic_store.namespaces import ns, bind_namespaces, update_old_namespaces, NS
 from semantic_store.utils import parse_into_graph
+from semantic_store import queries
 
 """
 Example:
@@ -25,14 +26,7 @@ def resource_uri(resource_url, g):
 
 def find_resource(manifest_uri, g, pred, obj):
     bind_namespaces(g)
-    query = """SELECT DISTINCT ?resource_uri ?resource_url
-               WHERE {
-                   <%s> ore:aggregates ?resource_uri .
-                   ?resource_url ore:describes ?resource_uri .
-                   ?resource_uri %s "%s" .
-               }""" % (manifest_uri, pred, obj)
-    qres = g.query(query, initNs = ns)
-    return qres
+    return queries.run('find_resource', g, manifest_uri=manifest_uri, predicate=pred, object=Literal(obj))
     
 
 def list_resources(manifest_uri, g):
@@ -46,51 +40,22 @@ def list_resources(manifest_uri, g):
 
 def resource_urls(manifest_uri, g):
     bind_namespaces(g)
-    query = """SELECT DISTINCT ?resource_url
-               WHERE {
-                   ?manifest_uri ore:aggregates ?resource_uri .
-                   ?resource_url ore:describes ?resource_uri
-               }"""
-    qres = g.query(query, initNs=ns, initBindings={'manifest_uri': URIRef(manifest_uri)})
+    qres = queries.run('described_resource_urls', g, manifest_uri=manifest_uri)
     if len(qres) == 0:
-        query = """SELECT DISTINCT ?resource_url
-                   WHERE {
-                       ?manifest_uri ore:aggregates ?resource_uri .
-                       ?resource_uri ore:isDescribedBy ?resource_url
-                   }"""
-        qres = g.query(query, initNs=ns, initBindings={'manifest_uri': URIRef(manifest_uri)})
+        qres = queries.run('described_by_resource_urls', g, manifest_uri=manifest_uri)
     return qres
 
 
 def aggregated_uris_urls(uri, g):
     bind_namespaces(g)
-    query = """SELECT DISTINCT ?resource_uri ?resource_url
-               WHERE {
-                   ?uri ore:aggregates ?resource_uri .
-                   OPTIONAL { ?resource_url ore:describes ?resource_uri } .
-                   OPTIONAL { ?resource_uri ore:isDescribedBy ?resource_url }
-               }"""
-    qres = g.query(query, initNs=ns, initBindings={'uri': URIRef(uri)})
-    return list(qres)
+    return queries.run('aggregated_uris_urls', g, uri=uri)
 
 
 def resource_uris_urls_old(manifest_uri, g):
     bind_namespaces(g)
-    query = """SELECT DISTINCT ?resource_uri ?resource_url
-               WHERE {
-                   ?manifest_uri ore:aggregates ?resource_uri .
-                   ?resource_url ore:describes ?resource_uri
-               }"""
-    qres = g.query(query, initNs=ns, initBindings={'manifest_uri': URIRef(manifest_uri)})
-    uris_urls = set(qres)
-
-    query = """SELECT DISTINCT ?resource_uri ?resource_url
-               WHERE {
-                   ?manifest_uri ore:aggregates ?resource_uri .
-                   ?resource_uri ore:isDescribedBy ?resource_url
-               }"""
-    qres = g.query(query, initNs=ns, initBindings={'manifest_uri': URIRef(manifest_uri)})
-    for i in qres:
+    uris_urls = set(queries.run('described_resource_uris_urls', g, manifest_uri=manifest_uri))
+
+    for i in queries.run('described_by_resource_uris_urls', g, manifest_uri=manifest_uri):
         uris_urls.add(i)
 
     return uris_urls
@@ -98,28 +63,12 @@ def resource_uris_urls_old(manifest_uri, g):
 
 def image_annotations(manifest_uri, g):
     bind_namespaces(g)
-    query = """SELECT DISTINCT ?resource_uri ?resource_url
-               WHERE {
-                   ?manifest_uri ore:aggregates ?resource_uri .
-                   ?resource_uri rdf:type dms:ImageAnnotationList .
-                   OPTIONAL { ?resource_url ore:describes ?resource_uri } .
-                   OPTIONAL { ?resource_uri ore:isDescribedBy ?resource_url }
-               }"""
-    qres = g.query(query, initNs=ns, initBindings={'manifest_uri': URIRef(manifest_uri)})
-    return list(qres)
+    return queries.run('image_annotations', g, manifest_uri=manifest_uri)
 
 
 def aggregated_seq_uris_urls(uri, g):
     bind_namespaces(g)
-    query = """SELECT DISTINCT ?resource_uri ?resource_url
-               WHERE {
-                   ?uri ore:aggregates ?resource_uri .
-                   {?resource_uri a dms:Sequence} UNION {?resource_uri a sc:Sequence} .
-                   OPTIONAL { ?resource_url ore:describes ?resource_uri } .
-                   OPTIONAL { ?resource_uri ore:isDescribedBy ?resource_url }
-               }"""
-    qres = g.query(query, initNs=ns, initBindings={'uri': uri})
-    return list(qres)
+    return queries.run('aggregated_seq_uris_urls', g, uri=uri)
 
 def fetch_and_parse(url, g, manifest_file=None, fmt="xml", cache=None):
     if (not cache) or (cache and (url not in cache['urls'])):
@@ -151,19 +100,7 @@ def harvest_resource_triples(g, collection_uri=None, pred=None, obj=None,
 
 def page_attributes(g, page_uri, res_uri):
     bind_namespaces(g)
-    qres = g.query("""SELECT DISTINCT ?res_title ?title ?width ?height ?image 
-               WHERE {
-                   {?res_uri dc:title ?res_title} UNION {?res_uri rdfs:label ?res_title} .
-                   {?page_uri dc:title ?title} UNION {?page_uri rdfs:label ?title} .
-                   ?page_uri exif:width ?width .
-                   ?page_uri exif:height ?height .
-                   ?anno oa:hasTarget ?page_uri .
-                   ?anno oa:hasBody ?image .
-                   ?image rdf:type dcmitype:Image .
-               }""", initBindings={
-        'res_uri': URIRef(res_uri),
-        'page_uri': URIRef(page_uri)
-    })
+    qres = queries.run('page_attributes', g, res_uri=res_uri, page_uri=page_uri)
     if qres:
         (res_title, page_title, width, height, image) = list(qres)[0]
         return (unicode(res_title), unicode(page_title), int(width), int(height), 
@@ -205,14 +142,7 @@ def pagination(g, collection_uri=None, pred=None, obj=None,
                                                   cache=cache, 
                                                   fmt=fmt)
 
-    query = """SELECT DISTINCT ?first ?rest ?sequence_uri
-               WHERE {
-                   ?res_uri ore:aggregates ?sequence_uri .
-                   ?sequence_uri rdf:first ?first .
-                   {?first a dms:Canvas} UNION {?first a sc:Canavas} .
-                   ?sequence_uri rdf:rest ?rest
-               }"""
-    qres = g.query(query, initNs=ns, initBindings={'res_uri': res_uri})
+    qres = queries.run('first_sequence', g, res_uri=res_uri)
 
     (first, rest, seq_uri) = list(qres)[0]
     seq_num = 1
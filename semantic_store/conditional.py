@@ -0,0 +1,97 @@
+"""
+Conditional GETs of the views which return graphs.
+
+The validators of a response are computed from what it is read from: the revision and modification
+time of each named graph (from the graph catalog, see semantic_store.graph_catalog), and any values
+read from the database (e.g. the permissions listed in a project). The strong ETag is a digest of
+all of them and of the requested format; the Last-Modified time is the latest of the graphs'
+modification times and of any datetime values, and is only sent when every dependency has a time.
+
+A request whose If-None-Match or If-Modified-Since header matches is answered with 304 Not Modified
+before the view reads anything from the store. As Last-Modified times are to the second, a request
+with If-None-Match is answered from its ETags alone, and If-Modified-Since is only compared when
+there is no If-None-Match.
+"""
+from django.http import HttpResponseNotModified
+from django.utils.http import parse_etags, quote_etag, parse_http_date_safe, http_date
+
+from semantic_store.rdfstore import rdfstore
+
+from calendar import timegm
+from functools import wraps
+import datetime
+import hashlib
+
+def validators(request, graphs, values=()):
+    """Returns the (etag, last modified time) of a response read from the graphs and values"""
+    revisions = rdfstore().catalog.revisions(graphs)
+
+    digest = hashlib.sha1()
+    digest.update(request.META.get('HTTP_ACCEPT', ''))
+
+    times = []
+    for identifier, (revision, modified) in sorted(revisions.items()):
+        digest.update((u'\n%s %d %s' % (identifier, revision, modified.isoformat() if modified else '')).encode('utf-8'))
+        times.append(modified)
+
+    for value in values:
+        digest.update((u'\n%s' % (value.isoformat() if isinstance(value, datetime.datetime) else value,)).encode('utf-8'))
+        times.append(value if isinstance(value, datetime.datetime) else None)
+
+    if times and all(times):
+        last_modified = max(times)
+    else:
+        last_modified = None
+
+    return digest.hexdigest(), last_modified
+
+def not_modified(request, etag, last_modified):
+    """True if the request's If-None-Match (or, without it, If-Modified-Since) header matches"""
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        try:
+            etags = parse_etags(if_none_match)
+        except ValueError:
+            return False
+        return etag in etags or '*' in etags
+
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return (if_modified_since is not None and last_modified is not None and
+            timegm(last_modified.utctimetuple()) <= if_modified_since)
+
+def conditional_response(request, graphs, values, respond):
+    """
+    Returns a 304 response if the request's validators match the graphs and values, and otherwise
+    respond(), with ETag and Last-Modified headers
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return respond()
+
+    etag, last_modified = validators(request, graphs, values)
+
+    if not_modified(request, etag, last_modified):
+        response = HttpResponseNotModified()
+    else:
+        response = respond()
+
+    if last_modified is not None and not response.has_header('Last-Modified'):
+        response['Last-Modified'] = http_date(timegm(last_modified.utctimetuple()))
+    if not response.has_header('ETag'):
+        response['ETag'] = quote_etag(etag)
+    return response
+
+def conditional(dependencies):
+    """
+    Decorator for views answering GET requests conditionally. `dependencies` is called with the
+    arguments of the view, and returns the graph identifiers and values the response is read from.
+    """
+    def decorator(view):
+        @wraps(view)
+        def inner(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+
+            graphs, values = dependencies(request, *args, **kwargs)
+            return conditional_response(request, graphs, values, lambda: view(request, *args, **kwargs))
+        return inner
+    return decorator
@@ -0,0 +1,318 @@
+"""
+A small, thread-safe pool of keep-alive HTTP connections to a single endpoint.
+
+Each thread checks a connection out for the duration of one request/response exchange,
+so a connection is never shared between threads mid-request. Idle connections are kept
+open (HTTP/1.1 keep-alive) and health checked before they are handed out again.
+"""
+from contextlib import contextmanager
+import httplib
+import select
+import socket
+import threading
+import time
+import urlparse
+import Queue
+
+class ConnectionPoolError(Exception):
+    pass
+
+class ConnectionPoolTimeout(ConnectionPoolError):
+    """Raised when no connection could be checked out of a full pool in time"""
+    pass
+
+RETRYABLE_EXCEPTIONS = (
+    socket.error,
+    httplib.BadStatusLine,
+    httplib.ImproperConnectionState,
+    httplib.IncompleteRead,
+)
+
+class PooledConnection(httplib.HTTPConnection):
+    """An HTTPConnection which remembers when it was created and last used"""
+
+    def __init__(self, *args, **kwargs):
+        httplib.HTTPConnection.__init__(self, *args, **kwargs)
+        self.created_at = time.time()
+        self.last_used_at = self.created_at
+        self.request_count = 0
+
+    def is_healthy(self, max_idle_time):
+        if max_idle_time is not None and time.time() - self.last_used_at > max_idle_time:
+            return False
+        if self.sock is None:
+            # httplib will transparently reconnect
+            return True
+
+        # An idle keep-alive socket should have nothing to read; if it is readable, the server
+        # has closed its end (or sent garbage), so it cannot be reused
+        try:
+            readable, writable, errored = select.select([self.sock], [], [self.sock], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not (readable or errored)
+
+class PooledResponse(object):
+    """
+    File-like wrapper around an httplib response which returns its connection to the
+    pool once the body has been read completely or the response is closed.
+    """
+
+    def __init__(self, pool, connection, response):
+        self.pool = pool
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.bytes_read = 0
+        self._buffer = ''
+        self._released = False
+        # Called with the response once it has been released
+        self.release_listeners = []
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, amt=None):
+        if self._buffer:
+            if amt is None:
+                data, self._buffer = self._buffer + self._read(), ''
+            else:
+                data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+            return data
+
+        return self._read(amt)
+
+    def readline(self, limit=-1):
+        while '\n' not in self._buffer:
+            chunk = self._read(self.pool.chunk_size)
+            if not chunk:
+                break
+            self._buffer += chunk
+
+        end = self._buffer.find('\n') + 1 or len(self._buffer)
+        if limit is not None and limit >= 0:
+            end = min(end, limit)
+
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+    def _read(self, amt=None):
+        if self._released:
+            return ''
+
+        try:
+            data = self.response.read(amt) if amt is not None else self.response.read()
+        except Exception:
+            self.release(reusable=False)
+            raise
+
+        self.bytes_read += len(data)
+        if amt is None or not data or self.response.isclosed():
+            self.release()
+        return data
+
+    def close(self):
+        """
+        Releases the connection before the body has been read completely. Up to `pool.max_drain`
+        bytes of the remaining body are read and discarded so the connection can be reused; if
+        more than that is left, the connection is closed instead.
+        """
+        if not self._released:
+            drained = 0
+            try:
+                while not self._released and drained <= self.pool.max_drain:
+                    drained += len(self._read(self.pool.chunk_size))
+            except Exception:
+                pass
+            self.release(reusable=False)
+
+    def release(self, reusable=True):
+        if not self._released:
+            self._released = True
+            self.pool._checkin(self.connection, reusable and not self.response.will_close)
+            for listener in self.release_listeners:
+                listener(self)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.pool.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def __del__(self):
+        if not self._released:
+            self.release(reusable=False)
+
+class HTTPConnectionPool(object):
+    """
+    A bounded pool of keep-alive connections to one HTTP endpoint.
+
+    `max_size` bounds the number of connections open at any one time; a thread which asks for
+    a connection while all of them are checked out waits up to `timeout` seconds.
+    Requests which fail at the connection level are retried up to `max_retries` times, waiting
+    `backoff * 2 ** attempt` seconds between attempts, each time on a fresh connection.
+    """
+
+    chunk_size = 64 * 1024
+    max_drain = 256 * 1024
+
+    def __init__(self, url, max_size=10, timeout=30, socket_timeout=None,
+                 max_idle_time=60, max_retries=3, backoff=0.1):
+        p = urlparse.urlparse(url)
+
+        assert p.scheme == 'http', 'Only http endpoints may be pooled'
+        self.url = url
+        self.host = p.hostname
+        self.port = p.port
+        self.path = p.path or '/'
+
+        self.max_size = max_size
+        self.timeout = timeout
+        self.socket_timeout = socket_timeout
+        self.max_idle_time = max_idle_time
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self._idle = Queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+
+        self._stats = {
+            'created': 0,
+            'reused': 0,
+            'discarded': 0,
+            'checkouts': 0,
+            'in_use': 0,
+            'requests': 0,
+            'retries': 0,
+            'failures': 0,
+            'timeouts': 0,
+            'wait_time': 0.0,
+        }
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def _new_connection(self):
+        if self.socket_timeout is not None:
+            connection = PooledConnection(self.host, self.port, timeout=self.socket_timeout)
+        else:
+            connection = PooledConnection(self.host, self.port)
+        self._count('created')
+        return connection
+
+    def _checkout(self):
+        started = time.time()
+        if not self._acquire_slot():
+            self._count('timeouts')
+            raise ConnectionPoolTimeout('Timed out after %ss waiting for a connection to %s' % (self.timeout, self.url))
+        self._count('wait_time', time.time() - started)
+
+        connection = None
+        while connection is None:
+            try:
+                connection = self._idle.get_nowait()
+            except Queue.Empty:
+                connection = self._new_connection()
+            else:
+                if connection.is_healthy(self.max_idle_time):
+                    self._count('reused')
+                else:
+                    connection.close()
+                    self._count('discarded')
+                    connection = None
+
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['in_use'] += 1
+        return connection
+
+    def _acquire_slot(self):
+        if self.timeout is None:
+            return self._slots.acquire()
+
+        deadline = time.time() + self.timeout
+        while not self._slots.acquire(False):
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def _checkin(self, connection, reusable=True):
+        connection.last_used_at = time.time()
+
+        if reusable:
+            self._idle.put(connection)
+        else:
+            connection.close()
+            self._count('discarded')
+
+        with self._lock:
+            self._stats['in_use'] -= 1
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Checks out a connection for the calling thread, returning it to the pool afterwards"""
+        connection = self._checkout()
+        try:
+            yield connection
+        except Exception:
+            self._checkin(connection, reusable=False)
+            raise
+        else:
+            self._checkin(connection)
+
+    def request(self, method, body=None, headers={}, path=None):
+        """
+        Sends a request to the endpoint, returning a PooledResponse. The caller must read the
+        response to the end (or close it) to return the connection to the pool.
+        """
+        path = path or self.path
+
+        attempt = 0
+        while True:
+            connection = self._checkout()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+            except RETRYABLE_EXCEPTIONS as e:
+                self._checkin(connection, reusable=False)
+
+                if attempt >= self.max_retries:
+                    self._count('failures')
+                    raise ConnectionPoolError('%s %s failed after %d attempts: %s' % (method, self.url, attempt + 1, e))
+
+                self._count('retries')
+                time.sleep(self.backoff * (2 ** attempt))
+                attempt += 1
+            except Exception:
+                self._checkin(connection, reusable=False)
+                self._count('failures')
+                raise
+            else:
+                connection.request_count += 1
+                self._count('requests')
+                return PooledResponse(self, connection, response)
+
+    def clear(self):
+        """Closes all idle connections"""
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            else:
+                connection.close()
+                self._count('discarded')
+
+    def statistics(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['idle'] = self._idle.qsize()
+        stats['max_size'] = self.max_size
+        stats['url'] = self.url
+        return stats
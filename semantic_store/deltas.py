@@ -0,0 +1,66 @@
+"""
+Writes of resource graphs as their difference from what is stored.
+
+The workspace PUTs whole resource graphs, most of whose triples are usually stored already. Rather
+than adding every triple of the input again, `patch` reads the stored triples of the input's
+subjects in one query, and writes only the delta, as one batch: the input triples which are not
+stored, and the stored values of the properties which the input replaces (e.g. a title), where the
+input gives them new values. Saving a graph which has not changed costs that one read, and no write.
+"""
+from rdflib import Graph, BNode
+
+class Delta(object):
+    """The triples added to and removed from a graph by a write"""
+    def __init__(self, added=(), removed=()):
+        self.added = list(added)
+        self.removed = list(removed)
+
+    def __len__(self):
+        return len(self.added) + len(self.removed)
+
+    def add_headers(self, response):
+        """Reports the size of the delta in the headers of a response"""
+        response['X-Triples-Added'] = str(len(self.added))
+        response['X-Triples-Removed'] = str(len(self.removed))
+        return response
+
+def stored_triples(graph, subjects):
+    """Reads the triples of each subject from a graph, in one query, into an in-memory graph"""
+    stored = Graph()
+
+    # Blank nodes of the input are never the ones stored, and cannot be queried by the SPARQL stores
+    subjects = [s for s in set(subjects) if not isinstance(s, BNode)]
+    if subjects:
+        for t in graph.triples_choices((subjects, None, None)):
+            stored.add(t)
+
+    return stored
+
+def delta(stored, input_graph, replaced=()):
+    """
+    Returns the Delta which writes the input graph over the stored triples. `replaced` lists the
+    (subject, predicate) pairs whose stored values are replaced, rather than added to, by the
+    input's values; pairs the input gives no value are left as they are.
+    """
+    added = [t for t in input_graph if t not in stored]
+    removed = []
+
+    for s, p in set(replaced):
+        values = set(input_graph.objects(s, p))
+        if values:
+            removed.extend((s, p, o) for o in stored.objects(s, p) if o not in values)
+
+    return Delta(added, removed)
+
+def patch(graph, input_graph, replaced=()):
+    """Writes the delta from the stored triples of a graph to the input graph, returning the Delta"""
+    changes = delta(stored_triples(graph, input_graph.subjects()), input_graph, replaced)
+
+    if changes:
+        with graph.store.batch():
+            for t in changes.removed:
+                graph.remove(t)
+            for t in changes.added:
+                graph.add(t)
+
+    return changes
@@ -0,0 +1,159 @@
+"""
+Streaming serialization of project exports.
+
+A project export is the project graph, its metadata graph, and the current version of each of its
+texts (from the Text model). `stream_project_export` reads them a page at a time and yields the
+serialization as it goes, so neither the export graph nor its serialization is ever held in memory
+as a whole, and the first bytes are sent as soon as the first page has been read.
+
+N-Triples, N-Quads (with each triple in the graph it was read from) and Turtle are streamed. The
+metadata graph is a copy of part of the project graph, so in the formats without graphs its
+triples are only written if they are not in the project graph. Turtle
+is written in chunks, each grouping the triples of a chunk by subject; as the same subject may
+appear in several chunks, blank nodes are always written by label. Other formats are serialized
+from the whole export graph (projects.project_export_graph).
+"""
+from rdflib import Graph, URIRef, Literal
+from rdflib.plugins.serializers.nt import _nt_row, _quoteLiteral, _xmlcharref_encode
+from rdflib.plugins.serializers.nquads import _nq_row
+
+from semantic_store.rdfstore import rdfstore
+from semantic_store.namespaces import ns
+from semantic_store.project_texts import overwrite_text_graph_from_text
+from semantic_store.models import Text
+from semantic_store import uris, utils
+
+from collections import OrderedDict
+import itertools
+import re
+import zlib
+
+STREAMING_FORMATS = ('nt', 'nquads', 'turtle')
+
+# Number of triples serialized (or texts read) at a time
+PAGE_SIZE = 1000
+
+# Bytes of serialization collected before each is yielded
+BUFFER_SIZE = 64 * 1024
+
+LOCAL_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_-]*$')
+
+def export_quads(project_uri, distinct_triples=False):
+    """
+    Yields (s, p, o, graph identifier) for every triple of a project's export. With
+    distinct_triples, the triples of the metadata graph which are also in the project graph are
+    left out.
+    """
+    project_uri = URIRef(project_uri)
+    project_identifier = uris.uri('semantic_store_projects', uri=project_uri)
+    metadata_identifier = uris.project_metadata_graph_identifier(project_uri)
+    project_graph = Graph(rdfstore(), project_identifier)
+
+    for s, p, o in project_graph.triples((None, None, None)):
+        yield s, p, o, project_identifier
+
+    metadata_triples = Graph(rdfstore(), metadata_identifier).triples((None, None, None))
+    if distinct_triples:
+        metadata_triples = triples_not_in(metadata_triples, project_graph)
+    for s, p, o in metadata_triples:
+        yield s, p, o, metadata_identifier
+
+    for text in text_pages(project_uri):
+        for s, p, o in overwrite_text_graph_from_text(text, Graph()):
+            yield s, p, o, project_identifier
+
+def triples_not_in(triples, graph, page_size=PAGE_SIZE):
+    """Yields the triples which are not in graph, looking up the triples of a page of subjects at a time"""
+    triples = iter(triples)
+    while True:
+        page = list(itertools.islice(triples, page_size))
+        if not page:
+            break
+
+        subjects = utils.unique(s for s, p, o in page)
+        in_graph = set(graph.triples_choices((subjects, None, None)))
+        for t in page:
+            if t not in in_graph:
+                yield t
+
+def text_pages(project_uri, page_size=PAGE_SIZE):
+    """Yields the current Texts of a project, read page_size at a time"""
+    last = 0
+    while True:
+        page = list(Text.objects.filter(project=project_uri, valid=True, pk__gt=last).order_by('pk')[:page_size])
+        for text in page:
+            yield text
+        if len(page) < page_size:
+            break
+        last = page[-1].pk
+
+def nt_lines(quads):
+    for s, p, o, identifier in quads:
+        yield _nt_row((s, p, o))
+
+def nquads_lines(quads):
+    for s, p, o, identifier in quads:
+        yield _nq_row((s, p, o), identifier)
+
+def turtle_lines(quads, page_size=PAGE_SIZE):
+    # Longest namespaces first, so each uri is abbreviated with the most specific prefix
+    namespaces = sorted(((prefix, unicode(namespace)) for prefix, namespace in ns.items()),
+                        key=lambda (prefix, namespace): len(namespace), reverse=True)
+
+    for prefix, namespace in sorted(namespaces):
+        yield u'@prefix %s: <%s> .\n' % (prefix, namespace)
+    yield u'\n'
+
+    def term(node):
+        if isinstance(node, Literal):
+            return _xmlcharref_encode(_quoteLiteral(node))
+        if isinstance(node, URIRef):
+            for prefix, namespace in namespaces:
+                if node.startswith(namespace) and LOCAL_NAME.match(node[len(namespace):]):
+                    return u'%s:%s' % (prefix, node[len(namespace):])
+        return _xmlcharref_encode(node.n3())
+
+    quads = iter(quads)
+    while True:
+        page = list(itertools.islice(quads, page_size))
+        if not page:
+            break
+
+        by_subject = OrderedDict()
+        for s, p, o, identifier in page:
+            by_subject.setdefault(s, []).append((p, o))
+
+        for s, predicate_objects in by_subject.iteritems():
+            yield u'%s %s .\n\n' % (term(s), u' ;\n    '.join(u'%s %s' % (term(p), term(o)) for p, o in predicate_objects))
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def stream_project_export(project_uri, format, compress=False, buffer_size=BUFFER_SIZE):
+    """
+    Yields the serialization of a project's export in one of the STREAMING_FORMATS, as byte
+    strings of about buffer_size bytes, gzipped if compress is set
+    """
+    lines = {
+        'nt': nt_lines,
+        'nquads': nquads_lines,
+        'turtle': turtle_lines,
+    }[format](export_quads(project_uri, distinct_triples=(format != 'nquads')))
+
+    def buffered():
+        buffer, size = [], 0
+        for line in lines:
+            line = line.encode('utf-8')
+            buffer.append(line)
+            size += len(line)
+            if size >= buffer_size:
+                yield ''.join(buffer)
+                buffer, size = [], 0
+        yield ''.join(buffer)
+
+    return gzipped(buffered()) if compress else buffered()
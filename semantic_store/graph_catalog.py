@@ -0,0 +1,194 @@
+"""
+A catalog of the named graphs in the rdf store: the number of triples in each graph, the number
+of triples of each predicate, and when the graph was last written.
+
+The catalog is kept in the database (models.GraphStatistics) and maintained through the store's
+write listeners: each write batch marks the graphs it touched as modified, and their counts as
+stale. Stale counts are recounted, for that graph alone, the next time they are asked for, so
+sizing a graph never scans more than that graph, and graphs which are not written are never
+counted again. Sizing a graph only counts its triples; the triples of each predicate are only
+counted again when they are asked for (statistics).
+
+Each write also increments the graph's revision, which, with its modification time, validates
+the responses read from the graph (see semantic_store.conditional).
+
+Once the catalog has been built for the whole store (`rebuild`, or the graph_statistics
+command), it also lists the graphs in the store, which FourStore.contexts() then answers from,
+rather than scanning every quad for their names.
+"""
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+
+from rdflib import Graph, URIRef
+
+from semantic_store.models import GraphStatistics
+
+from collections import defaultdict
+import json
+
+# Identifier of the entry recording that the catalog lists every graph in the store
+COMPLETE = '*'
+
+class GraphCatalog(object):
+    def __init__(self, store):
+        self.store = store
+        store.write_listeners.append(self.written)
+
+    def _find(self, identifier):
+        entries = list(GraphStatistics.objects.filter(identifier=identifier)[:1])
+        return entries[0] if entries else None
+
+    def written(self, batch):
+        self.bump(batch.graph_identifiers())
+
+    def bump(self, identifiers):
+        """
+        Marks graphs as modified, with stale counts, and increments their revisions. Called for
+        every write batch of the store, and by anything writing the graphs through another store.
+        """
+        now = timezone.now()
+        for identifier in identifiers:
+            if identifier is None:
+                continue
+            identifier = unicode(identifier)
+            if not self._mark_written(identifier, now):
+                sid = transaction.savepoint()
+                try:
+                    GraphStatistics.objects.create(identifier=identifier, stale=True, predicates_stale=True,
+                                                   modified=now, revision=1)
+                except IntegrityError:
+                    # Created by a concurrent first write to the graph
+                    transaction.savepoint_rollback(sid)
+                    self._mark_written(identifier, now)
+                else:
+                    transaction.savepoint_commit(sid)
+
+    def _mark_written(self, identifier, now):
+        return GraphStatistics.objects.filter(identifier=identifier).update(
+            stale=True, predicates_stale=True, modified=now, revision=F('revision') + 1)
+
+    def count_triples(self, identifier):
+        """Counts the triples of a graph, in the store"""
+        if hasattr(self.store, 'count_triples'):
+            return self.store.count_triples(identifier)
+
+        return sum(1 for t in Graph(self.store, URIRef(identifier)).triples((None, None, None)))
+
+    def predicate_counts(self, identifier):
+        """Counts the triples of each predicate in a graph, in the store"""
+        if hasattr(self.store, 'predicate_counts'):
+            return self.store.predicate_counts(identifier)
+
+        counts = defaultdict(int)
+        for s, p, o in Graph(self.store, URIRef(identifier)).triples((None, None, None)):
+            counts[unicode(p)] += 1
+        return dict(counts)
+
+    def refresh(self, identifier):
+        """Recounts a graph, and the triples of each of its predicates, returning its GraphStatistics"""
+        identifier = unicode(identifier)
+        # Read before counting, so that a write while counting changes the revision saved against
+        entry = self._find(identifier) or GraphStatistics(identifier=identifier)
+
+        counts = self.predicate_counts(identifier)
+        entry.triples = sum(counts.values())
+        entry.predicates = json.dumps(counts)
+        entry.predicates_stale = False
+        return self._save_counts(entry, ('triples', 'predicates', 'predicates_stale'))
+
+    def recount(self, identifier):
+        """Recounts the triples of a graph, returning its GraphStatistics"""
+        identifier = unicode(identifier)
+        entry = self._find(identifier) or GraphStatistics(identifier=identifier)
+
+        entry.triples = self.count_triples(identifier)
+        return self._save_counts(entry, ('triples',))
+
+    def _save_counts(self, entry, fields):
+        """
+        Saves the counted fields of an entry, unless the graph has been written since the entry
+        was read, in which case the counts may be out of date and the entry is left stale
+        """
+        entry.counted = timezone.now()
+        entry.stale = False
+
+        if entry.pk is not None:
+            values = dict((field, getattr(entry, field)) for field in fields + ('counted', 'stale'))
+            if not GraphStatistics.objects.filter(pk=entry.pk, revision=entry.revision).update(**values):
+                entry.stale = entry.predicates_stale = True
+            return entry
+
+        sid = transaction.savepoint()
+        try:
+            entry.save()
+        except IntegrityError:
+            # Created by a write to the graph while it was counted, so the counts may be stale
+            transaction.savepoint_rollback(sid)
+            entry = self._find(entry.identifier)
+        else:
+            transaction.savepoint_commit(sid)
+        return entry
+
+    def entry(self, identifier, predicates=False):
+        """
+        The GraphStatistics of a graph, counted if they are stale or unknown (with the triples of
+        each predicate, if predicates is set)
+        """
+        entry = self._find(unicode(identifier))
+        if predicates and (entry is None or entry.stale or entry.predicates_stale):
+            entry = self.refresh(identifier)
+        elif entry is None or entry.stale:
+            entry = self.recount(identifier)
+        return entry
+
+    def triples(self, identifier):
+        return self.entry(identifier).triples
+
+    def statistics(self, identifier):
+        entry = self.entry(identifier, predicates=True)
+        return {
+            'identifier': entry.identifier,
+            'triples': entry.triples,
+            'predicates': json.loads(entry.predicates),
+            'modified': entry.modified,
+            'counted': entry.counted,
+        }
+
+    def revisions(self, identifiers):
+        """
+        Returns {identifier: (revision, modified)} for each of the graphs, without counting them.
+        A graph which has not been written since the catalog was created has revision 0, and no
+        modification time.
+        """
+        identifiers = [unicode(identifier) for identifier in identifiers]
+        revisions = dict((identifier, (0, None)) for identifier in identifiers)
+        for identifier, revision, modified in GraphStatistics.objects.filter(identifier__in=identifiers).values_list(
+                'identifier', 'revision', 'modified'):
+            revisions[identifier] = (revision, modified)
+        return revisions
+
+    def is_complete(self):
+        return GraphStatistics.objects.filter(identifier=COMPLETE).exists()
+
+    def graphs(self):
+        """The identifiers of the non-empty graphs in the catalog"""
+        for entry in GraphStatistics.objects.filter(stale=True).exclude(identifier=COMPLETE):
+            self.recount(entry.identifier)
+        return [URIRef(identifier) for identifier in GraphStatistics.objects.filter(triples__gt=0)
+                .exclude(identifier=COMPLETE).order_by('identifier').values_list('identifier', flat=True)]
+
+    def rebuild(self, contexts):
+        """Counts every graph in contexts, the identifiers of all the graphs in the store"""
+        contexts = [unicode(identifier) for identifier in contexts]
+        for identifier in contexts:
+            self.refresh(identifier)
+
+        # Graphs which are no longer in the store
+        known = set(contexts + [COMPLETE])
+        removed = [pk for pk, identifier in GraphStatistics.objects.values_list('pk', 'identifier') if identifier not in known]
+
+        with transaction.commit_on_success():
+            GraphStatistics.objects.filter(pk__in=removed).delete()
+            if self._find(COMPLETE) is None:
+                GraphStatistics.objects.create(identifier=COMPLETE, stale=False)
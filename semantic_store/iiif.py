@@ -0,0 +1,442 @@
+"""
+An IIIF Image API (2.0, level 2) server for uploaded images.
+
+Each uploaded image is a service at images/<upload's id>, whose info.json gives its size, and the
+tile size and scale factors of its tile pyramid (see semantic_store.image_derivatives); images are
+requested as images/<id>/<region>/<size>/<rotation>/<quality>.<format>. The service is linked
+from the image in the canvas's graph (sc:hasRelatedService). Images which are not public are only
+served to their owner, and to users who may read a project holding them.
+
+A request decodes as little of the image as it can: the whole image at a thumbnail's size or
+smaller is scaled from the thumbnail, a region at a pyramid level's scale or smaller is assembled
+from the tiles of that level which cover it, and otherwise the uploaded file is read, decoded at a
+reduced scale where the format allows it (JPEG). The responses are kept in a bounded on-disk
+cache (IIIF_CACHE_MAX_SIZE bytes under IIIF_CACHE_LOCATION), which evicts the least recently used.
+Images are never scaled up, nor rendered larger than IIIF_MAX_WIDTH x IIIF_MAX_HEIGHT (as given in
+info.json).
+"""
+from django.conf import settings
+from django.core.cache import cache as django_cache
+from django.core.files.storage import default_storage
+
+from rdflib import Graph, URIRef
+
+from semantic_store.rdfstore import rdfstore
+from semantic_store.namespaces import NS
+from semantic_store import uris, image_derivatives, permissions
+
+from PIL import Image, ImageOps
+
+from cStringIO import StringIO
+import hashlib
+import math
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+CONTEXT = 'http://iiif.io/api/image/2/context.json'
+PROTOCOL = 'http://iiif.io/api/image'
+PROFILE = 'http://iiif.io/api/image/2/level2.json'
+
+# Formats: (PIL format, mimetype)
+FORMATS = {
+    'jpg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+    'gif': ('GIF', 'image/gif'),
+    'tif': ('TIFF', 'image/tiff'),
+}
+
+QUALITIES = ('default', 'color', 'gray', 'bitonal')
+
+# Seconds for which the projects holding an image are remembered, by each process
+IMAGE_PROJECTS_CACHE_TIMEOUT = 5 * 60
+
+# Eviction removes the least recently used responses until the cache is this fraction of its size
+LOW_WATER_MARK = 0.8
+
+NUMBER = r'\d+(?:\.\d*)?|\.\d+'
+REGION = re.compile(r'^(pct:)?(%s),(%s),(%s),(%s)$' % (NUMBER, NUMBER, NUMBER, NUMBER))
+SIZE = re.compile(r'^(!)?(\d+)?,(\d+)?$')
+PERCENT_SIZE = re.compile(r'^pct:(%s)$' % NUMBER)
+ROTATION = re.compile(r'^(!)?(%s)$' % NUMBER)
+
+class ImageRequestError(Exception):
+    """Raised for requests which cannot be answered, with the status of the response"""
+    status = 400
+
+class UnsupportedParameter(ImageRequestError):
+    """Raised for parameter values the server does not implement"""
+    status = 501
+
+def cache_location_setting():
+    return getattr(settings, 'IIIF_CACHE_LOCATION', 'user_images/iiif_cache/')
+
+def cache_max_size_setting():
+    return getattr(settings, 'IIIF_CACHE_MAX_SIZE', 512 * 1024 * 1024)
+
+def max_width_setting():
+    return getattr(settings, 'IIIF_MAX_WIDTH', 4096)
+
+def max_height_setting():
+    return getattr(settings, 'IIIF_MAX_HEIGHT', 4096)
+
+def max_age_setting():
+    return getattr(settings, 'IIIF_MAX_AGE', 24 * 60 * 60)
+
+def parse_region(region, width, height):
+    """Returns the (x, y, w, h) of a region parameter, clipped to the image"""
+    if region == 'full':
+        return 0, 0, width, height
+
+    match = REGION.match(region)
+    if not match:
+        raise ImageRequestError('Invalid region "%s"' % region)
+
+    x, y, w, h = (float(n) for n in match.groups()[1:])
+    if match.group(1):
+        x, y, w, h = x * width / 100, y * height / 100, w * width / 100, h * height / 100
+
+    x, y = int(x), int(y)
+    w, h = min(int(math.ceil(w)), width - x), min(int(math.ceil(h)), height - y)
+    if w <= 0 or h <= 0:
+        raise ImageRequestError('The region "%s" is not within the image' % region)
+    return x, y, w, h
+
+def parse_size(size, region_width, region_height, max_width=None, max_height=None):
+    """
+    Returns the (width, height) of a size parameter, for a region of the given size. Sizes larger
+    than the region (images are not scaled up), or than max_width x max_height, are refused.
+    """
+    if size == 'full':
+        w, h = region_width, region_height
+    else:
+        w, h = requested_size(size, region_width, region_height)
+
+    if w > region_width or h > region_height:
+        raise UnsupportedParameter('The size "%s" is larger than the region, and images are not scaled up' % size)
+    if (max_width is not None and w > max_width) or (max_height is not None and h > max_height):
+        raise ImageRequestError('The size "%s" is larger than the largest served, %dx%d' % (size, max_width, max_height))
+    return w, h
+
+def requested_size(size, region_width, region_height):
+    # A best fit within a size larger than the region is the region's size
+    match = PERCENT_SIZE.match(size)
+    if match:
+        scale = float(match.group(1)) / 100
+        w, h = int(region_width * scale), int(region_height * scale)
+    else:
+        match = SIZE.match(size)
+        if not match or not (match.group(2) or match.group(3)):
+            raise ImageRequestError('Invalid size "%s"' % size)
+
+        best_fit, w, h = match.group(1), match.group(2), match.group(3)
+        if best_fit and not (w and h):
+            raise ImageRequestError('Invalid size "%s"' % size)
+
+        if w and h:
+            w, h = int(w), int(h)
+            if best_fit:
+                scale = min(float(w) / region_width, float(h) / region_height, 1)
+                w, h = int(region_width * scale), int(region_height * scale)
+        elif w:
+            w = int(w)
+            h = int(round(float(region_height) * w / region_width))
+        else:
+            h = int(h)
+            w = int(round(float(region_width) * h / region_height))
+
+    if w <= 0 or h <= 0:
+        raise ImageRequestError('The size "%s" is empty' % size)
+    return w, h
+
+def parse_rotation(rotation):
+    """Returns (mirrored, degrees clockwise) of a rotation parameter"""
+    match = ROTATION.match(rotation)
+    if not match or not 0 <= float(match.group(2)) <= 360:
+        raise ImageRequestError('Invalid rotation "%s"' % rotation)
+    return bool(match.group(1)), float(match.group(2)) % 360
+
+class ImageRequest(object):
+    """The parameters of a request for an image, of the given size"""
+    def __init__(self, width, height, region, size, rotation, quality, format):
+        if format not in FORMATS:
+            raise UnsupportedParameter('The format "%s" is not supported' % format)
+        if quality not in QUALITIES:
+            raise ImageRequestError('Invalid quality "%s"' % quality)
+
+        self.region = parse_region(region, width, height)
+        self.size = parse_size(size, self.region[2], self.region[3], max_width_setting(), max_height_setting())
+        self.mirrored, self.degrees = parse_rotation(rotation)
+        self.quality = quality
+        self.format = format
+
+    def key(self):
+        """The canonical form of the request, under which its response is cached"""
+        return '%d,%d,%d,%d/%d,%d/%s%r/%s.%s' % (self.region + self.size + (
+            '!' if self.mirrored else '', self.degrees, self.quality, self.format))
+
+    @property
+    def mimetype(self):
+        return FORMATS[self.format][1]
+
+def tiled_region(directory, description, factor, region):
+    """The region of an image assembled from the tiles of a pyramid level which cover it"""
+    x, y, w, h = region
+    tile_size = description['tile_size']
+    level_width = int(math.ceil(float(description['width']) / factor))
+    level_height = int(math.ceil(float(description['height']) / factor))
+
+    left, top = x // factor, y // factor
+    right = max(left + 1, min(level_width, int(math.ceil(float(x + w) / factor))))
+    bottom = max(top + 1, min(level_height, int(math.ceil(float(y + h) / factor))))
+
+    image = None
+    for row in range(top // tile_size, (bottom - 1) // tile_size + 1):
+        for column in range(left // tile_size, (right - 1) // tile_size + 1):
+            tile = Image.open(os.path.join(directory, 'tiles', str(factor), '%d_%d.jpg' % (column, row)))
+            if image is None:
+                image = Image.new(tile.mode, (right - left, bottom - top))
+            image.paste(tile, (column * tile_size - left, row * tile_size - top))
+    return image
+
+def region_image(path, derivatives, request):
+    """
+    Returns the region of an image at least at the size requested (or at full size), reading as
+    little as it can: a thumbnail, the tiles of a pyramid level, or the image decoded at a reduced
+    scale. derivatives is the (directory, description) of the image's derivatives, or None.
+    """
+    x, y, w, h = request.region
+    scale = min(float(w) / request.size[0], float(h) / request.size[1])
+
+    if derivatives is not None:
+        directory, description = derivatives
+
+        if request.region == (0, 0, description['width'], description['height']):
+            thumbnails = sorted(size for size, (tw, th) in description['thumbnails'].items()
+                                if tw >= request.size[0] and th >= request.size[1])
+            if thumbnails:
+                return Image.open(os.path.join(directory, 'thumbnails', '%d.jpg' % thumbnails[0]))
+
+        factors = [factor for factor in description['scale_factors'] if factor <= scale]
+        if factors:
+            return tiled_region(directory, description, max(factors), request.region)
+
+    image = Image.open(path)
+    width, height = image.size
+    if scale >= 2 and image.format == 'JPEG':
+        # Decodes the image at 1/2, 1/4 or 1/8 scale, no smaller than requested
+        image.draft(image.mode, (int(width / scale), int(height / scale)))
+
+    x_scale, y_scale = float(image.size[0]) / width, float(image.size[1]) / height
+    return image.crop((int(x * x_scale), int(y * y_scale),
+                       int(math.ceil((x + w) * x_scale)), int(math.ceil((y + h) * y_scale))))
+
+def render(path, derivatives, request):
+    """Returns the bytes of the response to an image request"""
+    image = region_image(path, derivatives, request)
+
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    if image.size != request.size:
+        image = image.resize(request.size, Image.ANTIALIAS)
+
+    if request.mirrored:
+        image = ImageOps.mirror(image)
+    if request.degrees:
+        # Rotations are clockwise; PIL's are counterclockwise
+        transpositions = {90: Image.ROTATE_270, 180: Image.ROTATE_180, 270: Image.ROTATE_90}
+        if request.degrees in transpositions:
+            image = image.transpose(transpositions[request.degrees])
+        else:
+            image = image.rotate(-request.degrees, Image.BICUBIC, expand=True)
+
+    if request.quality == 'gray':
+        image = image.convert('L')
+    elif request.quality == 'bitonal':
+        image = image.convert('1')
+        if request.format == 'jpg':
+            image = image.convert('L')
+
+    data = StringIO()
+    pil_format = FORMATS[request.format][0]
+    if pil_format == 'JPEG':
+        image.save(data, pil_format, quality=image_derivatives.JPEG_QUALITY)
+    else:
+        image.save(data, pil_format)
+    return data.getvalue()
+
+class DerivativeCache(object):
+    """
+    A bounded on-disk cache of the responses to image requests, by image. A read of a response marks
+    it as used (by its modification time); when a write takes the cache over max_size bytes, the
+    least recently used responses are removed.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self._size = None
+        self._lock = threading.Lock()
+
+    def path(self, image_id, key):
+        return os.path.join(self.directory, str(image_id), hashlib.sha1(key).hexdigest())
+
+    def get(self, image_id, key):
+        """The cached response, or None"""
+        path = self.path(image_id, key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def put(self, image_id, key, data):
+        path = self.path(image_id, key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Made by another thread meanwhile
+                pass
+
+        # Written under a temporary name, so a response is never read half written
+        fd, temporary_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(temporary_path, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self.size()
+            else:
+                self._size += len(data)
+            if self._size > self.max_size:
+                self._size = self.evict(int(self.max_size * LOW_WATER_MARK))
+
+    def entries(self):
+        """(last used time, size, path) of each cached response"""
+        entries = []
+        for directory, directories, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def size(self):
+        return sum(size for used, size, path in self.entries())
+
+    def evict(self, target_size):
+        """Removes the least recently used responses until the cache is at most target_size bytes, returning its size"""
+        entries = sorted(self.entries())
+        size = sum(size for used, size, path in entries)
+        for used, entry_size, path in entries:
+            if size <= target_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+        return size
+
+    def forget(self, image_id):
+        """Removes the cached responses for an image"""
+        shutil.rmtree(os.path.join(self.directory, str(image_id)), ignore_errors=True)
+        with self._lock:
+            self._size = None
+
+_default_cache = []
+
+def default_cache():
+    if not _default_cache:
+        _default_cache.append(DerivativeCache(default_storage.path(cache_location_setting()), cache_max_size_setting()))
+    return _default_cache[0]
+
+def derivatives_of(uploaded_image, storage=None):
+    """The (directory, description) of an upload's derivatives, or None if it has none"""
+    directory = image_derivatives.derivatives_directory(uploaded_image, storage)
+    description = image_derivatives.read_description(directory)
+    return (directory, description) if description is not None else None
+
+def image_response(uploaded_image, region, size, rotation, quality, format, cache=None, storage=None):
+    """
+    Returns the bytes and mimetype of the response to an image request for an upload, from the
+    cache if it is there. Raises ImageRequestError if the request cannot be answered.
+    """
+    cache = cache or default_cache()
+    path = uploaded_image.imagefile.path
+
+    # Only the header of the image is read
+    width, height = Image.open(path).size
+    request = ImageRequest(width, height, region, size, rotation, quality, format)
+
+    data = cache.get(uploaded_image.pk, request.key())
+    if data is None:
+        data = render(path, derivatives_of(uploaded_image, storage), request)
+        cache.put(uploaded_image.pk, request.key(), data)
+    return data, request.mimetype
+
+def image_projects(uploaded_image, store=None):
+    """The projects whose project graphs hold an uploaded image"""
+    key = 'semantic_store_iiif_image_projects_%d' % uploaded_image.pk
+    projects = django_cache.get(key)
+    if projects is None:
+        image_uri = uris.absolutize(uploaded_image.imagefile.url)
+        projects = [unicode(uris.project_of_graph(graph.identifier))
+                    for graph in image_derivatives.image_project_graphs(image_uri, store or rdfstore())]
+        django_cache.set(key, projects, IMAGE_PROJECTS_CACHE_TIMEOUT)
+    return projects
+
+def may_read(uploaded_image, user, store=None):
+    """Whether a user may read an uploaded image: it is public, theirs, or in a project they may read"""
+    if uploaded_image.isPublic:
+        return True
+    if not user.is_authenticated():
+        return False
+    if uploaded_image.owner_id == user.pk:
+        return True
+    return any(permissions.has_permission_over(project_uri, user=user, permission=NS.perm.mayRead)
+               for project_uri in image_projects(uploaded_image, store))
+
+def service_uri(uploaded_image):
+    return uris.url('semantic_store_iiif_service', identifier=str(uploaded_image.pk))
+
+def info(uploaded_image, storage=None):
+    """The image information (info.json) of an upload"""
+    width, height = Image.open(uploaded_image.imagefile.path).size
+    info = {
+        '@context': CONTEXT,
+        '@id': unicode(service_uri(uploaded_image)),
+        'protocol': PROTOCOL,
+        'width': width,
+        'height': height,
+        'profile': [PROFILE],
+        'maxWidth': max_width_setting(),
+        'maxHeight': max_height_setting(),
+    }
+
+    derivatives = derivatives_of(uploaded_image, storage)
+    if derivatives is not None:
+        directory, description = derivatives
+        info['tiles'] = [{'width': description['tile_size'], 'scaleFactors': description['scale_factors']}]
+        info['sizes'] = [{'width': w, 'height': h} for size, (w, h) in sorted(description['thumbnails'].items())]
+    return info
+
+def service_graph(image_uri, uploaded_image):
+    """Links an uploaded image to its IIIF image service"""
+    graph = Graph()
+    service = service_uri(uploaded_image)
+    graph.add((URIRef(image_uri), NS.sc.hasRelatedService, service))
+    graph.add((service, NS.dcterms.conformsTo, URIRef(PROFILE)))
+    return graph
+
+def forget(uploaded_image):
+    default_cache().forget(uploaded_image.pk)
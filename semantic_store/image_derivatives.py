@@ -0,0 +1,294 @@
+"""
+Thumbnails and tile pyramids of uploaded images.
+
+Uploaded images are full resolution scans, which are too large to download just to show a
+thumbnail, or the part of a page a user has zoomed in on. After an upload, its derivatives are
+written to the media storage, under IMAGE_DERIVATIVES_LOCATION/<upload's id>/:
+
+    thumbnails/<size>.jpg              scaled to fit in size x size pixels, for each of
+                                       IMAGE_THUMBNAIL_SIZES
+    tiles/<scale>/<column>_<row>.jpg   the image scaled down by each scale factor (1, 2, 4, ...
+                                       until it fits in one tile), cut into IMAGE_TILE_SIZE tiles
+    description.json                   the sizes of all of the above (see read_description)
+
+and described in each project graph which holds the image: its thumbnails (foaf:thumbnail) as
+images with their sizes, and the pyramid as a service of the image (sc:hasRelatedService) with its
+tile size and scale factors, so clients can load only the tiles they show.
+
+Each level of the pyramid is scaled from the one above it, and each thumbnail from the smallest
+level larger than it, so the full image is only scaled once. The derivatives of an image are
+written to a new directory, which then replaces the old one.
+
+The derivatives of an upload are generated in a background thread (or, with the setting
+IMAGE_DERIVATIVES_IN_BACKGROUND = False, by the generate_image_derivatives command, which also
+generates those of existing uploads). A generation which has been running for longer than
+IMAGE_DERIVATIVES_TIMEOUT seconds is taken to have died with its process, and is run again when
+the derivatives are next requested.
+"""
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connection as db_connection
+from django.db.models import Q
+from django.utils import timezone
+
+from rdflib import Graph, Literal, URIRef
+
+from semantic_store.rdfstore import rdfstore
+from semantic_store.namespaces import NS
+from semantic_store.models import ImageDerivatives
+from semantic_store import uris
+
+from PIL import Image
+
+import datetime
+import json
+import logging
+import math
+import os
+import shutil
+import threading
+import traceback
+
+JPEG_QUALITY = 85
+
+logger = logging.getLogger(__name__)
+
+def location_setting():
+    return getattr(settings, 'IMAGE_DERIVATIVES_LOCATION', 'user_images/derived_images/')
+
+def tile_size_setting():
+    return getattr(settings, 'IMAGE_TILE_SIZE', 256)
+
+def thumbnail_sizes_setting():
+    return getattr(settings, 'IMAGE_THUMBNAIL_SIZES', (150, 600))
+
+def in_background_setting():
+    return getattr(settings, 'IMAGE_DERIVATIVES_IN_BACKGROUND', True)
+
+def timeout_setting():
+    return getattr(settings, 'IMAGE_DERIVATIVES_TIMEOUT', 60 * 60)
+
+def derivatives_name(uploaded_image):
+    """The name of the directory holding an upload's derivatives, in the media storage"""
+    return '%s%d/' % (location_setting(), uploaded_image.pk)
+
+def scale_factors(width, height, tile_size):
+    """The scale factors of the levels of a pyramid: 1, 2, 4, ... until the image fits in one tile"""
+    factors = [1]
+    while max(width, height) > tile_size * factors[-1]:
+        factors.append(factors[-1] * 2)
+    return factors
+
+def save_jpeg(image, path):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    image.save(path, 'JPEG', quality=JPEG_QUALITY)
+
+def generate(image, directory, tile_size, thumbnail_sizes):
+    """
+    Writes the thumbnails and tiles of a PIL image into a directory. Returns a dictionary of their
+    sizes: the image's width and height, the tile size, the scale factors, and the (width, height)
+    of each thumbnail, by size.
+    """
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    width, height = image.size
+    factors = scale_factors(width, height, tile_size)
+
+    thumbnails = {}
+    pending = sorted(set(thumbnail_sizes), reverse=True)
+
+    level = image
+    for i, factor in enumerate(factors):
+        if factor > 1:
+            level = level.resize((int(math.ceil(float(width) / factor)), int(math.ceil(float(height) / factor))),
+                                 Image.ANTIALIAS)
+        level_width, level_height = level.size
+
+        for y in range(0, level_height, tile_size):
+            for x in range(0, level_width, tile_size):
+                tile = level.crop((x, y, min(x + tile_size, level_width), min(y + tile_size, level_height)))
+                save_jpeg(tile, os.path.join(directory, 'tiles', str(factor), '%d_%d.jpg' % (x // tile_size, y // tile_size)))
+
+        # Thumbnails larger than the next level are scaled from this one
+        next_longest = int(math.ceil(float(max(width, height)) / (factor * 2)))
+        while pending and (pending[0] > next_longest or i == len(factors) - 1):
+            size = pending.pop(0)
+            thumbnail = level.copy()
+            thumbnail.thumbnail((size, size), Image.ANTIALIAS)
+            save_jpeg(thumbnail, os.path.join(directory, 'thumbnails', '%d.jpg' % size))
+            thumbnails[size] = thumbnail.size
+
+    description = {
+        'width': width,
+        'height': height,
+        'tile_size': tile_size,
+        'scale_factors': factors,
+        'thumbnails': thumbnails,
+    }
+    with open(os.path.join(directory, 'description.json'), 'w') as f:
+        json.dump(dict(description, thumbnails=sorted((size, w, h) for size, (w, h) in thumbnails.items())), f)
+
+    return description
+
+def read_description(directory):
+    """The description of the derivatives written into a directory by generate, or None if there are none"""
+    try:
+        with open(os.path.join(directory, 'description.json')) as f:
+            description = json.load(f)
+    except IOError:
+        return None
+
+    description['thumbnails'] = dict((size, (w, h)) for size, w, h in description['thumbnails'])
+    return description
+
+def derivatives_directory(uploaded_image, storage=None):
+    storage = storage or default_storage
+    return storage.path(derivatives_name(uploaded_image)).rstrip(os.sep)
+
+def description_graph(image_uri, base_uri, description):
+    """The graph describing the derivatives of an image, written under base_uri"""
+    graph = Graph()
+    image_uri = URIRef(image_uri)
+
+    for size, (width, height) in sorted(description['thumbnails'].items()):
+        thumbnail_uri = URIRef('%sthumbnails/%d.jpg' % (base_uri, size))
+        graph.add((image_uri, NS.foaf.thumbnail, thumbnail_uri))
+        graph.add((thumbnail_uri, NS.rdf.type, NS.dcmitype.Image))
+        graph.add((thumbnail_uri, NS.exif.width, Literal(width)))
+        graph.add((thumbnail_uri, NS.exif.height, Literal(height)))
+
+    pyramid_uri = URIRef('%stiles/' % base_uri)
+    graph.add((image_uri, NS.sc.hasRelatedService, pyramid_uri))
+    graph.add((pyramid_uri, NS.rdf.type, NS.dm.ImagePyramid))
+    graph.add((pyramid_uri, NS.exif.width, Literal(description['width'])))
+    graph.add((pyramid_uri, NS.exif.height, Literal(description['height'])))
+    graph.add((pyramid_uri, NS.dm.tileSize, Literal(description['tile_size'])))
+    for factor in description['scale_factors']:
+        graph.add((pyramid_uri, NS.dm.scaleFactor, Literal(factor)))
+
+    return graph
+
+def image_project_graphs(image_uri, store):
+    """The project graphs in which the image is described"""
+    graphs = []
+    for context in store.contexts((URIRef(image_uri), NS.rdf.type, None)):
+        identifier = getattr(context, 'identifier', context)
+        if uris.project_of_graph(identifier) is not None:
+            graphs.append(Graph(store, identifier))
+    return graphs
+
+def record(image_uri, graph, base_uri, store):
+    """
+    Describes the derivatives of an image in each project graph holding it, replacing any earlier
+    description of derivatives under base_uri
+    """
+    image_uri = URIRef(image_uri)
+
+    with store.batch():
+        for project_graph in image_project_graphs(image_uri, store):
+            for predicate in (NS.foaf.thumbnail, NS.sc.hasRelatedService):
+                for derivative in project_graph.objects(image_uri, predicate):
+                    if derivative.startswith(base_uri):
+                        project_graph.remove((image_uri, predicate, derivative))
+                        project_graph.remove((derivative, None, None))
+            project_graph += graph
+
+def delete_files(uploaded_image, storage=None):
+    directory = derivatives_directory(uploaded_image, storage)
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+
+def run(derivatives, store=None, storage=None):
+    """Generates (or generates again) the derivatives of an upload, returning the ImageDerivatives"""
+    store = store or rdfstore()
+    storage = storage or default_storage
+    uploaded_image = derivatives.image
+
+    derivatives.state = ImageDerivatives.RUNNING
+    derivatives.started = timezone.now()
+    derivatives.save()
+
+    try:
+        name = derivatives_name(uploaded_image)
+        directory = derivatives_directory(uploaded_image, storage)
+        new_directory = directory + '.new'
+        if os.path.isdir(new_directory):
+            shutil.rmtree(new_directory)
+
+        uploaded_image.imagefile.open('rb')
+        try:
+            description = generate(Image.open(uploaded_image.imagefile), new_directory,
+                                   tile_size_setting(), thumbnail_sizes_setting())
+        finally:
+            uploaded_image.imagefile.close()
+
+        delete_files(uploaded_image, storage)
+        os.rename(new_directory, directory)
+
+        image_uri = uris.absolutize(uploaded_image.imagefile.url)
+        base_uri = uris.absolutize(storage.url(name))
+        graph = description_graph(image_uri, base_uri, description)
+
+        # Imported here, as the IIIF image server reads the derivatives through this module. Uploads
+        # made before the server existed are linked to it here.
+        from semantic_store import iiif
+        graph += iiif.service_graph(image_uri, uploaded_image)
+
+        record(image_uri, graph, base_uri, store)
+    except Exception:
+        logger.exception('Generating the derivatives of %s failed', uploaded_image)
+        derivatives.state = ImageDerivatives.FAILED
+        derivatives.error = traceback.format_exc()
+    else:
+        derivatives.state = ImageDerivatives.DONE
+        derivatives.error = ''
+
+    derivatives.finished = timezone.now()
+    derivatives.save()
+    return derivatives
+
+def run_in_background(derivatives_pk):
+    try:
+        run(ImageDerivatives.objects.get(pk=derivatives_pk))
+    finally:
+        # Each thread has a database connection of its own
+        db_connection.close()
+
+def retryable():
+    """
+    The generations which may be run again: those which failed, and those which have been running
+    for longer than IMAGE_DERIVATIVES_TIMEOUT (or since before their start was recorded)
+    """
+    started_before = timezone.now() - datetime.timedelta(seconds=timeout_setting())
+    return ImageDerivatives.objects.filter(
+        Q(state=ImageDerivatives.FAILED) |
+        Q(state=ImageDerivatives.RUNNING, started__lt=started_before) |
+        Q(state=ImageDerivatives.RUNNING, started__isnull=True))
+
+def request_derivatives(uploaded_image):
+    """
+    Queues the generation of an upload's derivatives, and starts it in the background (unless the
+    setting IMAGE_DERIVATIVES_IN_BACKGROUND is False). Returns the ImageDerivatives.
+    """
+    derivatives, created = ImageDerivatives.objects.get_or_create(image=uploaded_image)
+    if not created:
+        if derivatives.state == ImageDerivatives.PENDING:
+            return derivatives
+        if derivatives.state == ImageDerivatives.RUNNING and not retryable().filter(pk=derivatives.pk).exists():
+            return derivatives
+
+        # Only one of the requests seeing the same state queues the generation again
+        queued = ImageDerivatives.objects.filter(pk=derivatives.pk, state=derivatives.state,
+                                                 started=derivatives.started).update(state=ImageDerivatives.PENDING)
+        derivatives = ImageDerivatives.objects.get(pk=derivatives.pk)
+        if not queued:
+            return derivatives
+
+    if in_background_setting():
+        thread = threading.Thread(target=run_in_background, args=(derivatives.pk,))
+        thread.daemon = True
+        thread.start()
+
+    return derivatives
@@ -0,0 +1,229 @@
+"""
+Instrumentation of the store round trips made while handling a request.
+
+The stores record every query and update they send (4store requests, and the SQL statements of
+the SQLAlchemy store) with `record`, into the StoreStatistics being collected by the calling
+thread. StoreInstrumentationMiddleware collects the statistics of each HTTP request, returns
+them in X-Store-* response headers, and logs them as a JSON line. Queries slower than
+RDF_SLOW_QUERY_SECONDS are logged with their text, whether or not they are part of a request.
+
+Both kinds of line are written to the 'semantic_store.instrumentation' logger; the
+store_request_stats management command aggregates a log of them by endpoint.
+"""
+from django.conf import settings
+
+from contextlib import contextmanager
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger('semantic_store.instrumentation')
+
+QUERY = 'query'
+UPDATE = 'update'
+
+# Upper bounds, in seconds, of the buckets of the latency histogram (the last bucket is unbounded)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Longest part of a query's text written to the slow query log
+MAX_LOGGED_QUERY_LENGTH = 10000
+
+def slow_query_seconds():
+    return getattr(settings, 'RDF_SLOW_QUERY_SECONDS', 1.0)
+
+def bucket_labels():
+    return ['<=%gs' % bound for bound in LATENCY_BUCKETS] + ['>%gs' % LATENCY_BUCKETS[-1]]
+
+class StoreStatistics(object):
+    """Counts of the queries and updates sent to the store, the bytes transferred, and their latencies"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.updates = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.time = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, kind, elapsed, sent=0, received=0):
+        bucket = len(LATENCY_BUCKETS)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed <= bound:
+                bucket = i
+                break
+
+        with self._lock:
+            if kind == UPDATE:
+                self.updates += 1
+            else:
+                self.queries += 1
+            self.bytes_sent += sent
+            self.bytes_received += received
+            self.time += elapsed
+            self.histogram[bucket] += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'queries': self.queries,
+                'updates': self.updates,
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'store_time': round(self.time, 6),
+                'latency_histogram': dict(zip(bucket_labels(), self.histogram)),
+            }
+
+_local = threading.local()
+
+def current():
+    """The StoreStatistics being collected by the calling thread, or None"""
+    return getattr(_local, 'statistics', None)
+
+@contextmanager
+def collecting(statistics=None):
+    """Collects the store round trips made by the calling thread in the block into statistics"""
+    if statistics is None:
+        statistics = StoreStatistics()
+
+    previous = current()
+    _local.statistics = statistics
+    try:
+        yield statistics
+    finally:
+        _local.statistics = previous
+
+def propagate(function):
+    """
+    Wraps function so that, when it is called from another thread (e.g. a worker of a thread
+    pool), its round trips are recorded into the statistics of the calling thread
+    """
+    statistics = current()
+    if statistics is None:
+        return function
+
+    def collected(*args, **kwargs):
+        with collecting(statistics):
+            return function(*args, **kwargs)
+    return collected
+
+def record(kind, text, elapsed, sent=0, received=0, statistics=None):
+    """Records a round trip to the store, logging it if it was slow"""
+    if statistics is None:
+        statistics = current()
+    if statistics is not None:
+        statistics.record(kind, elapsed, sent, received)
+
+    threshold = slow_query_seconds()
+    if threshold is not None and elapsed >= threshold:
+        text = unicode(text)
+        logger.warning(json.dumps({
+            'type': 'slow_query',
+            'kind': kind,
+            'seconds': round(elapsed, 6),
+            'bytes_received': received,
+            'path': getattr(_local, 'path', None),
+            'text': text[:MAX_LOGGED_QUERY_LENGTH],
+        }))
+
+def record_response(kind, text, sent, response, started):
+    """
+    Records a request to the store once its pooled response has been read, so the time and bytes
+    include receiving the whole body
+    """
+    statistics = current()
+
+    def released(response):
+        record(kind, text, time.time() - started, sent, response.bytes_read, statistics)
+    response.release_listeners.append(released)
+
+def instrument_engine(engine):
+    """Records the statements executed through a SQLAlchemy engine"""
+    from sqlalchemy import event
+
+    if event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        return
+
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('instrumentation_started', []).append(time.time())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['instrumentation_started'].pop()
+    kind = QUERY if statement.lstrip()[:6].upper() == 'SELECT' else UPDATE
+    record(kind, statement, time.time() - started, len(statement))
+
+class StoreInstrumentationMiddleware(object):
+    """
+    Collects the store round trips made while handling each request, adding them to the response
+    as X-Store-* headers and logging them to the 'semantic_store.instrumentation' logger.
+
+    The body of a streaming response is generated after the response has been returned, so its
+    round trips are collected as it is iterated, and the request is logged once it finishes; as
+    its headers are sent before the body is generated, they carry no X-Store-* counts.
+    """
+
+    def process_request(self, request):
+        request.store_statistics = StoreStatistics()
+        request.store_started = time.time()
+        _local.statistics = request.store_statistics
+        _local.path = request.path
+
+    def process_response(self, request, response):
+        statistics = getattr(request, 'store_statistics', None)
+        _local.statistics = None
+        _local.path = None
+        if statistics is None:
+            return response
+
+        if getattr(response, 'streaming', False):
+            response.streaming_content = self.streamed(request, response, response.streaming_content)
+            return response
+
+        stats = statistics.as_dict()
+        response['X-Store-Queries'] = str(stats['queries'])
+        response['X-Store-Updates'] = str(stats['updates'])
+        response['X-Store-Bytes'] = str(stats['bytes_sent'] + stats['bytes_received'])
+        response['X-Store-Time'] = '%.6f' % stats['store_time']
+
+        self.log(request, response, stats)
+        return response
+
+    @contextmanager
+    def bound(self, request):
+        """Collects the round trips of the calling thread into the request's statistics in the block"""
+        previous = current(), getattr(_local, 'path', None)
+        _local.statistics, _local.path = request.store_statistics, request.path
+        try:
+            yield
+        finally:
+            _local.statistics, _local.path = previous
+
+    def streamed(self, request, response, content):
+        """Yields the chunks of a streaming response's content, logging the request once it is finished or closed"""
+        content = iter(content)
+        try:
+            while True:
+                with self.bound(request):
+                    try:
+                        chunk = next(content)
+                    except StopIteration:
+                        break
+                yield chunk
+        finally:
+            self.log(request, response, request.store_statistics.as_dict())
+
+    def log(self, request, response, stats):
+        resolver_match = getattr(request, 'resolver_match', None)
+        stats.update({
+            'type': 'request',
+            'method': request.method,
+            'path': request.path,
+            'endpoint': resolver_match.url_name if resolver_match is not None and resolver_match.url_name else request.path,
+            'status': response.status_code,
+            'seconds': round(time.time() - request.store_started, 6),
+        })
+        logger.info(json.dumps(stats))
@@ -0,0 +1,178 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from optparse import make_option
+
+from semantic_store import rdfstore, uris
+from semantic_store.namespaces import NS
+from semantic_store.canvases import canvas_subgraph
+from semantic_store.annotations import resource_annotation_subgraph
+from semantic_store.utils import metadata_triples
+
+from rdflib import Graph, URIRef, Literal
+
+import shutil
+import tempfile
+import time
+import uuid
+import os
+
+class Command(BaseCommand):
+    """
+    Compares the store backends on the access patterns of DM's views, using a generated project
+    of canvases with image annotations and annotations on regions of the canvases.
+
+    The embedded and SQLAlchemy stores are created in a temporary directory; 4store (when it is
+    configured) is written to in a scratch graph, which is removed afterwards.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('--backends', dest='backends', default=None,
+                    help='Comma separated backends to compare (embedded, sqlalchemy, fourstore)'),
+        make_option('--canvases', dest='canvases', type='int', default=50, help='Number of canvases in the project'),
+        make_option('--annotations', dest='annotations', type='int', default=10, help='Number of annotations on each canvas'),
+        make_option('--repeat', dest='repeat', type='int', default=3, help='Number of times each read is timed (the best is kept)'),
+    )
+
+    operations = (
+        'load project',
+        'canvas subgraphs',
+        'canvas annotations',
+        'metadata choices',
+        'list canvases',
+        'update titles',
+    )
+
+    def handle(self, backends, canvases, annotations, repeat, *args, **options):
+        if backends:
+            backends = [b.strip() for b in backends.split(',')]
+        else:
+            backends = ['embedded', 'sqlalchemy']
+            if rdfstore.configured_backend() == 'fourstore':
+                backends.append('fourstore')
+
+        directory = tempfile.mkdtemp()
+        try:
+            results = {}
+            for backend in backends:
+                store, cleanup = self.make_store(backend, directory)
+                try:
+                    print 'Benchmarking %s' % backend
+                    results[backend] = self.run(store, canvases, annotations, repeat)
+                finally:
+                    cleanup()
+        finally:
+            shutil.rmtree(directory)
+
+        print
+        print '%-20s' % 'seconds' + ''.join('%12s' % backend for backend in backends)
+        for operation in self.operations:
+            print '%-20s' % operation + ''.join('%12.3f' % results[backend][operation] for backend in backends)
+
+    def make_store(self, backend, directory):
+        """Returns a new store for the backend, and a function removing what was written to it"""
+        identifier = rdfstore.default_identifier
+
+        if backend == 'embedded':
+            store = rdfstore.EmbeddedStore(identifier=identifier)
+            path = os.path.join(directory, 'quads.db')
+            store.open(path)
+            return store, lambda: store.destroy(path)
+        elif backend == 'sqlalchemy':
+            store = rdfstore.SQLAlchemyStore(identifier=identifier)
+            store.open(Literal('sqlite:///%s' % os.path.join(directory, 'sqlalchemy.db')))
+            return store, lambda: store.close()
+        elif backend == 'fourstore':
+            if rdfstore.configured_backend() != 'fourstore':
+                raise CommandError('FOUR_STORE_URIS must be set to benchmark 4store')
+            store = rdfstore.FourStore(settings.FOUR_STORE_URIS['SPARQL'], settings.FOUR_STORE_URIS['UPDATE'])
+            return store, lambda: store.update('DROP SILENT GRAPH %s' % self.graph_identifier.n3())
+        else:
+            raise CommandError('Unknown backend "%s"' % backend)
+
+    def generate_project(self, canvases, annotations):
+        self.project_uri = URIRef(uuid.uuid4().urn)
+        self.graph_identifier = uris.uri('semantic_store_projects', uri=self.project_uri)
+        self.canvas_uris = []
+
+        g = Graph()
+        g.add((self.project_uri, NS.rdf.type, NS.dm.Project))
+
+        for i in range(canvases):
+            canvas = URIRef(uuid.uuid4().urn)
+            self.canvas_uris.append(canvas)
+            g.add((self.project_uri, NS.ore.aggregates, canvas))
+            g.add((canvas, NS.rdf.type, NS.sc.Canvas))
+            g.add((canvas, NS.rdfs.label, Literal('Canvas %d' % i)))
+            g.add((canvas, NS.exif.width, Literal(1000)))
+            g.add((canvas, NS.exif.height, Literal(1500)))
+
+            image_anno, image = URIRef(uuid.uuid4().urn), URIRef(uuid.uuid4().urn)
+            g.add((image_anno, NS.rdf.type, NS.oa.Annotation))
+            g.add((image_anno, NS.oa.hasTarget, canvas))
+            g.add((image_anno, NS.oa.hasBody, image))
+            g.add((image, NS.rdf.type, NS.dcmitype.Image))
+
+            for j in range(annotations):
+                anno, body = URIRef(uuid.uuid4().urn), URIRef(uuid.uuid4().urn)
+                target, selector = URIRef(uuid.uuid4().urn), URIRef(uuid.uuid4().urn)
+
+                g.add((anno, NS.rdf.type, NS.oa.Annotation))
+                g.add((anno, NS.oa.hasTarget, target))
+                g.add((anno, NS.oa.hasBody, body))
+                g.add((target, NS.rdf.type, NS.oa.SpecificResource))
+                g.add((target, NS.oa.hasSource, canvas))
+                g.add((target, NS.oa.hasSelector, selector))
+                g.add((selector, NS.rdf.type, NS.oa.SvgSelector))
+                g.add((selector, NS.cnt.chars, Literal('<path d="M0 0 L%d %d"/>' % (i, j))))
+                g.add((body, NS.rdf.type, NS.dcmitype.Text))
+                g.add((body, NS.rdf.type, NS.cnt.ContentAsText))
+                g.add((body, NS.cnt.chars, Literal('Annotation %d on canvas %d' % (j, i))))
+
+        return g
+
+    def timed(self, repeat, f):
+        best = None
+        for i in range(repeat):
+            started = time.time()
+            f()
+            elapsed = time.time() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def run(self, store, canvases, annotations, repeat):
+        project = self.generate_project(canvases, annotations)
+        graph = Graph(store, identifier=self.graph_identifier)
+        timings = {}
+
+        def load():
+            with store.batch():
+                graph.addN((s, p, o, graph) for s, p, o in project)
+        timings['load project'] = self.timed(1, load)
+
+        def canvas_subgraphs():
+            for canvas in self.canvas_uris:
+                canvas_subgraph(graph, canvas, self.project_uri)
+        timings['canvas subgraphs'] = self.timed(repeat, canvas_subgraphs)
+
+        def canvas_annotations():
+            for canvas in self.canvas_uris:
+                resource_annotation_subgraph(graph, canvas)
+        timings['canvas annotations'] = self.timed(repeat, canvas_annotations)
+
+        def metadata_choices():
+            for canvas in self.canvas_uris:
+                list(metadata_triples(graph, canvas))
+        timings['metadata choices'] = self.timed(repeat, metadata_choices)
+
+        def list_canvases():
+            for canvas in graph.subjects(NS.rdf.type, NS.sc.Canvas):
+                graph.value(canvas, NS.rdfs.label)
+        timings['list canvases'] = self.timed(repeat, list_canvases)
+
+        def update_titles():
+            with store.batch():
+                for i, canvas in enumerate(self.canvas_uris):
+                    graph.set((canvas, NS.rdfs.label, Literal('Renamed canvas %d' % i)))
+        timings['update titles'] = self.timed(repeat, update_titles)
+
+        return timings
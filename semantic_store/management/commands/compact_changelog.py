@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.utils import timezone
+from optparse import make_option
+
+from semantic_store.rdfstore import rdfstore
+
+from datetime import timedelta
+
+class Command(BaseCommand):
+    """
+    Removes the changes older than the retention window from the project changelogs (see
+    semantic_store.changelog). Clients at a revision before the removed changes have to read their
+    projects again.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', dest='days', type='int',
+                    default=getattr(settings, 'PROJECT_CHANGELOG_RETENTION_DAYS', 30),
+                    help='Keep the changes made in this many days'),
+    )
+
+    def handle(self, days, *args, **options):
+        removed = rdfstore().changelog.compact(timezone.now() - timedelta(days=days))
+        print 'Removed %d changes made more than %d days ago' % (removed, days)
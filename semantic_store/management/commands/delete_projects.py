@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from semantic_store import project_deletion
+from semantic_store.models import ProjectDeletion
+
+import json
+
+class Command(BaseCommand):
+    """
+    Runs the project deletions which are queued (see semantic_store.project_deletion), e.g. from cron
+    when the setting PROJECT_DELETION_IN_BACKGROUND is False. Deletions which were interrupted, or
+    which failed, are resumed with --resume. Projects given by uri are queued and deleted.
+    """
+
+    args = '[project uri ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--resume', dest='resume', default=False, action='store_true',
+                    help='Also resume deletions which were interrupted or failed'),
+    )
+
+    def handle(self, *project_uris, **options):
+        for project_uri in project_uris:
+            ProjectDeletion.objects.create(identifier=project_uri)
+
+        states = [ProjectDeletion.PENDING]
+        if options['resume']:
+            states += [ProjectDeletion.RUNNING, ProjectDeletion.FAILED]
+
+        for deletion in ProjectDeletion.objects.filter(state__in=states).order_by('pk'):
+            print 'Deleting %s' % deletion.identifier
+            deletion = project_deletion.run(deletion)
+            print '    %s, removed %s' % (deletion.state, json.dumps(project_deletion.status(deletion)['removed'], sort_keys=True))
+            if deletion.error:
+                print deletion.error
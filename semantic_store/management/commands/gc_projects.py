@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from semantic_store import project_gc
+from semantic_store.models import ProjectPermission
+
+class Command(BaseCommand):
+    """
+    Finds the orphaned triples of project graphs (about resources which are no longer reachable from
+    their project, see semantic_store.project_gc), and with --delete removes them, in batches.
+
+    Either the projects to collect are given, or --all collects every project which has been
+    written since its last collection, so it can be run on a schedule (--limit bounds the number of
+    projects collected in one run).
+    """
+
+    args = '[project uri ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--all', dest='all', default=False, action='store_true',
+                    help='Collect every project written since its last collection'),
+        make_option('--delete', dest='delete', default=False, action='store_true',
+                    help='Remove the orphaned triples, rather than only reporting them'),
+        make_option('--batch-size', dest='batch_size', type='int', default=project_gc.BATCH_SIZE,
+                    help='Number of triples removed at a time'),
+        make_option('--limit', dest='limit', type='int', default=None,
+                    help='Collect at most this many projects'),
+        make_option('--show', dest='show', default=False, action='store_true',
+                    help='List each orphaned triple'),
+    )
+
+    def handle(self, *project_uris, **options):
+        if options['all']:
+            project_uris = [uri for uri in sorted(set(ProjectPermission.objects.values_list('identifier', flat=True)))
+                            if project_gc.is_due(uri)]
+        elif not project_uris:
+            raise CommandError('Give the uris of the projects to collect, or --all')
+
+        if options['limit'] is not None:
+            project_uris = project_uris[:options['limit']]
+
+        total = 0
+        for project_uri in project_uris:
+            try:
+                orphans, removed = project_gc.collect(project_uri, options['delete'], options['batch_size'])
+            except project_gc.ConcurrentWrite as e:
+                print '%s (it will be collected on the next run)' % e
+                continue
+
+            total += len(orphans)
+            if orphans or options['verbosity'] > 1:
+                print '%s: %d orphaned triples%s' % (project_uri, len(orphans), ', removed' if removed else '')
+            if options['show']:
+                for s, p, o in orphans:
+                    print '    %s %s %s' % (s.n3(), p.n3(), o.n3())
+
+        print '%d orphaned triples in %d projects%s' % (
+            total, len(project_uris), '' if options['delete'] else ' (use --delete to remove them)')
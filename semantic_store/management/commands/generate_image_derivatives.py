@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from semantic_store import image_derivatives
+from semantic_store.models import ImageDerivatives, UploadedImage
+
+class Command(BaseCommand):
+    """
+    Generates the thumbnails and tile pyramids of uploaded images (see
+    semantic_store.image_derivatives): those which are queued, e.g. from cron when the setting
+    IMAGE_DERIVATIVES_IN_BACKGROUND is False, and those of uploads which have none yet. Generations
+    which failed, or which have been running for longer than IMAGE_DERIVATIVES_TIMEOUT (so were
+    interrupted), are run again with --retry. Uploads given by id have their derivatives generated
+    again.
+    """
+
+    args = '[uploaded image id ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--retry', dest='retry', default=False, action='store_true',
+                    help='Also run generations which failed, or which are still running after IMAGE_DERIVATIVES_TIMEOUT'),
+    )
+
+    def handle(self, *image_ids, **options):
+        for image in UploadedImage.objects.filter(pk__in=image_ids):
+            ImageDerivatives.objects.filter(image=image).update(state=ImageDerivatives.PENDING)
+
+        for image in UploadedImage.objects.filter(derivatives__isnull=True):
+            ImageDerivatives.objects.create(image=image)
+
+        queued = ImageDerivatives.objects.filter(state=ImageDerivatives.PENDING)
+        if options['retry']:
+            queued = queued | image_derivatives.retryable()
+
+        for derivatives in queued.select_related('image').order_by('pk'):
+            print 'Generating the derivatives of %s' % derivatives.image
+            derivatives = image_derivatives.run(derivatives)
+            print '    %s' % derivatives.state
+            if derivatives.error:
+                print derivatives.error
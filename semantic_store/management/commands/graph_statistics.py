@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from semantic_store.rdfstore import rdfstore, store_contexts
+
+class Command(BaseCommand):
+    """
+    Lists the named graphs in the rdf store with their triple counts and last modification times,
+    from the graph catalog (see semantic_store.graph_catalog), or the number of triples of each
+    predicate in one graph.
+
+    --rebuild counts every graph in the store, after which the catalog lists the store's graphs.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rebuild', dest='rebuild', default=False, action='store_true',
+                    help='Count every graph in the store, and record which graphs it has'),
+        make_option('--graph', dest='graph', help='Show the number of triples of each predicate in this graph'),
+    )
+
+    def handle(self, rebuild, graph, *args, **options):
+        store = rdfstore()
+        catalog = store.catalog
+
+        if rebuild:
+            if hasattr(store, 'scan_contexts'):
+                contexts = store.scan_contexts()
+            else:
+                contexts = store_contexts(store)
+            catalog.rebuild(contexts)
+
+        if graph:
+            statistics = catalog.statistics(graph)
+            print '%s: %d triples, modified %s, counted %s' % (
+                graph, statistics['triples'], statistics['modified'], statistics['counted'])
+            for predicate, count in sorted(statistics['predicates'].items(), key=lambda (p, c): c, reverse=True):
+                print '%10d %s' % (count, predicate)
+        else:
+            if not catalog.is_complete():
+                print 'The catalog has not been built for the whole store (see --rebuild), so some graphs may be missing'
+
+            total = 0
+            for identifier in catalog.graphs():
+                statistics = catalog.statistics(identifier)
+                total += statistics['triples']
+                print '%10d %-32s %s' % (statistics['triples'], statistics['modified'] or '', identifier)
+            print '%10d triples' % total
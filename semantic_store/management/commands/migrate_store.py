@@ -0,0 +1,101 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from semantic_store import rdfstore, query_cache
+
+from rdflib import Graph
+
+import json
+import os
+import threading
+import time
+
+class Command(BaseCommand):
+    """
+    Copies every named graph from one configured store backend to another (see
+    rdfstore.open_store), streaming each graph in chunks which are written as bulk inserts,
+    several graphs at a time.
+
+    Each graph is recorded in a checkpoint file once it has been copied, so an interrupted
+    migration can be run again with the same checkpoint file, and only copies the graphs which
+    were not finished. Afterwards, the number of triples in each graph is compared between the
+    two stores.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('--from', dest='source', help='Backend to copy from (fourstore, embedded, sqlalchemy)'),
+        make_option('--to', dest='target', help='Backend to copy to (fourstore, embedded, sqlalchemy)'),
+        make_option('--parallel', dest='parallel', type='int', default=4, help='Number of graphs copied at once'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=rdfstore.COPY_CHUNK_SIZE,
+                    help='Number of triples written to the new store at a time'),
+        make_option('--checkpoint', dest='checkpoint', default='migrate_store.checkpoint',
+                    help='File recording the graphs which have been copied'),
+        make_option('--restart', dest='restart', default=False, action='store_true',
+                    help='Ignore an existing checkpoint file, and copy every graph'),
+        make_option('--no-verify', dest='verify', default=True, action='store_false',
+                    help='Do not compare the number of triples in each graph afterwards'),
+    )
+
+    def handle(self, source, target, parallel, chunk_size, checkpoint, restart, verify, *args, **options):
+        if not source or not target:
+            raise CommandError('Both --from and --to backends must be given')
+        if source == target:
+            raise CommandError('The backends to copy from and to must be different')
+
+        old_store = rdfstore.open_store(source)
+        new_store = rdfstore.open_store(target)
+
+        finished = {} if restart else self.read_checkpoint(checkpoint)
+        contexts = rdfstore.store_contexts(old_store)
+        remaining = [c for c in contexts if unicode(c) not in finished]
+
+        print '%d graphs to copy (%d already copied)' % (len(remaining), len(contexts) - len(remaining))
+
+        lock = threading.Lock()
+        started = time.time()
+
+        def copied(identifier, count):
+            with lock:
+                finished[unicode(identifier)] = count
+                self.write_checkpoint(checkpoint, finished)
+                print '[%d/%d] %s: %d triples (%.1fs)' % (
+                    len(finished), len(contexts), identifier, count, time.time() - started)
+
+        try:
+            total = rdfstore.copy_to_store(old_store, new_store, remaining, chunk_size, parallel, copied)
+        finally:
+            # Results cached by running processes, and the validators of their responses (see
+            # semantic_store.conditional), may be of the graphs which have been written
+            query_cache.GraphRevisions().bump(finished.keys())
+            rdfstore.rdfstore().catalog.bump(finished.keys())
+
+        print 'Copied %d triples in %.1fs' % (total, time.time() - started)
+
+        if verify:
+            self.verify(old_store, new_store, contexts, parallel)
+
+    def read_checkpoint(self, path):
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def write_checkpoint(self, path, finished):
+        # Written aside and renamed, so an interruption never leaves a partial checkpoint
+        with open(path + '.tmp', 'w') as f:
+            json.dump(finished, f)
+        os.rename(path + '.tmp', path)
+
+    def verify(self, old_store, new_store, contexts, parallel):
+        def counts(identifier):
+            return len(Graph(old_store, identifier)), len(Graph(new_store, identifier))
+
+        mismatched = []
+        for identifier, (old_count, new_count) in zip(contexts, rdfstore.concurrent_map(counts, contexts, parallel)):
+            if old_count != new_count:
+                mismatched.append(identifier)
+                print '%s: %d triples, but %d copied' % (identifier, old_count, new_count)
+
+        if mismatched:
+            raise CommandError('%d of %d graphs have different triple counts' % (len(mismatched), len(contexts)))
+        print 'Triple counts match in all %d graphs' % len(contexts)
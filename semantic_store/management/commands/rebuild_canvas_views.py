@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from semantic_store import canvas_views
+from semantic_store.rdfstore import concurrent_map
+from semantic_store.models import ProjectPermission
+
+import threading
+import time
+
+class Command(BaseCommand):
+    """
+    Builds the materialised views of every canvas of projects again (see
+    semantic_store.canvas_views), e.g. for the data stored before the views were maintained.
+
+    Either the projects to rebuild are given, or --all rebuilds every project with permissions
+    granted over it, several projects at a time.
+    """
+
+    args = '[project uri ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--all', dest='all', default=False, action='store_true',
+                    help='Rebuild the canvas views of every project'),
+        make_option('--parallel', dest='parallel', type='int', default=4, help='Number of projects rebuilt at once'),
+    )
+
+    def handle(self, *project_uris, **options):
+        if options['all']:
+            project_uris = sorted(set(ProjectPermission.objects.values_list('identifier', flat=True)))
+        elif not project_uris:
+            raise CommandError('Give the uris of the projects to rebuild, or --all')
+
+        lock = threading.Lock()
+        started = time.time()
+
+        def rebuild(project_uri):
+            built = canvas_views.rebuild(project_uri)
+            with lock:
+                print '%s: built %d canvas views' % (project_uri, built)
+            return built
+
+        built = sum(concurrent_map(rebuild, project_uris, options['parallel']))
+
+        print 'Built %d canvas views of %d projects in %.1fs' % (built, len(project_uris), time.time() - started)
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from semantic_store import project_metadata
+from semantic_store.rdfstore import concurrent_map
+from semantic_store.models import ProjectPermission
+
+import threading
+import time
+
+class Command(BaseCommand):
+    """
+    Checks the metadata graphs of projects against their project graphs, and repairs those which
+    have drifted apart, writing only the triples which differ (see semantic_store.project_metadata).
+
+    Either the projects to repair are given, or --all repairs every project with permissions
+    granted over it, several projects at a time.
+    """
+
+    args = '[project uri ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--all', dest='all', default=False, action='store_true',
+                    help='Repair every project'),
+        make_option('--parallel', dest='parallel', type='int', default=4, help='Number of projects repaired at once'),
+    )
+
+    def handle(self, *project_uris, **options):
+        if options['all']:
+            project_uris = sorted(set(ProjectPermission.objects.values_list('identifier', flat=True)))
+        elif not project_uris:
+            raise CommandError('Give the uris of the projects to repair, or --all')
+
+        lock = threading.Lock()
+        started = time.time()
+        drifted = []
+
+        def repair(project_uri):
+            added, removed = project_metadata.rebuild(project_uri)
+            with lock:
+                if added or removed:
+                    drifted.append(project_uri)
+                    print '%s: added %d and removed %d triples' % (project_uri, added, removed)
+            return added, removed
+
+        concurrent_map(repair, project_uris, options['parallel'])
+
+        print 'Checked %d projects in %.1fs, %d of which had drifted' % (
+            len(project_uris), time.time() - started, len(drifted))
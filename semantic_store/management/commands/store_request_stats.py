@@ -0,0 +1,96 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from optparse import make_option
+
+from collections import defaultdict
+import json
+
+class Command(BaseCommand):
+    """
+    Summarises a store instrumentation log (see semantic_store.instrumentation) by endpoint: how
+    many store round trips its requests make and how long they spend in the store. Endpoints whose
+    requests make many queries each are marked, as they are likely reading item by item (N+1).
+    The slowest logged queries are listed afterwards.
+    """
+
+    args = '[log file ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sort', dest='sort', default='store_time',
+                    help='Column to sort endpoints by (requests, queries, updates, store_time, seconds)'),
+        make_option('--many-queries', dest='many_queries', type='int', default=20,
+                    help='Mark endpoints making more than this many queries per request on average'),
+        make_option('--slow', dest='slow', type='int', default=10, help='Number of slow queries to list'),
+    )
+
+    columns = ('requests', 'queries', 'max_queries', 'updates', 'kbytes', 'store_time', 'seconds', 'p95_seconds')
+
+    def handle(self, *paths, **options):
+        if not paths:
+            if not getattr(settings, 'STORE_INSTRUMENTATION_LOG', None):
+                raise CommandError('Give the log files to read, or set STORE_INSTRUMENTATION_LOG')
+            paths = [settings.STORE_INSTRUMENTATION_LOG]
+
+        if options['sort'] not in self.columns:
+            raise CommandError('Cannot sort by "%s"' % options['sort'])
+
+        requests, slow_queries = self.read(paths)
+        endpoints = self.summarise(requests)
+
+        print '%-40s' % 'endpoint' + ''.join('%13s' % column for column in self.columns)
+        for endpoint, summary in sorted(endpoints.items(), key=lambda (e, s): s[options['sort']], reverse=True):
+            marker = ' *' if summary['queries'] > options['many_queries'] else ''
+            print '%-40s' % endpoint[:40] + ''.join(self.format(summary[column]) for column in self.columns) + marker
+
+        if any(s['queries'] > options['many_queries'] for s in endpoints.values()):
+            print
+            print '* more than %d queries per request' % options['many_queries']
+
+        if slow_queries and options['slow']:
+            print
+            print 'Slowest queries:'
+            for entry in sorted(slow_queries, key=lambda e: e['seconds'], reverse=True)[:options['slow']]:
+                print
+                print '%.3fs %s %s' % (entry['seconds'], entry['kind'], entry.get('path') or '')
+                print entry['text']
+
+    def format(self, value):
+        if isinstance(value, float):
+            return '%13.3f' % value
+        return '%13d' % value
+
+    def read(self, paths):
+        requests = defaultdict(list)
+        slow_queries = []
+
+        for path in paths:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+
+                    if entry.get('type') == 'request':
+                        requests['%s %s' % (entry['method'], entry['endpoint'])].append(entry)
+                    elif entry.get('type') == 'slow_query':
+                        slow_queries.append(entry)
+
+        return requests, slow_queries
+
+    def summarise(self, requests):
+        endpoints = {}
+        for endpoint, entries in requests.items():
+            count = len(entries)
+            durations = sorted(e['seconds'] for e in entries)
+            endpoints[endpoint] = {
+                'requests': count,
+                'queries': float(sum(e['queries'] for e in entries)) / count,
+                'max_queries': max(e['queries'] for e in entries),
+                'updates': float(sum(e['updates'] for e in entries)) / count,
+                'kbytes': sum(e['bytes_sent'] + e['bytes_received'] for e in entries) / 1024.0 / count,
+                'store_time': sum(e['store_time'] for e in entries) / count,
+                'seconds': sum(durations) / count,
+                'p95_seconds': durations[min(count - 1, int(count * 0.95))],
+            }
+        return endpoints
@@ -1,11 +1,14 @@
 from rdflib.graph import Graph, URIRef
 from rdflib import URIRef
 
-from semantic_store.rdfstore import rdfstore
+from semantic_store.rdfstore import rdfstore, gather
 from semantic_store.namespaces import NS
+from semantic_store import subgraphs
 
 from semantic_store.utils import metadata_triples, list_subgraph
 
+import itertools
+
 
 def canvases(uri):
     g = Graph(store=rdfstore(), identifier=URIRef(uri))
@@ -27,16 +30,51 @@ def sequence_canvases(graph, sequence_uri):
     for canvas in graph.items(graph.value(sequence_uri, NS.sc.hasCanvases)):
         yield canvas
 
+def first_sequence(graph, manuscript_uri):
+    sequences_uri = graph.value(URIRef(manuscript_uri), NS.sc.hasSequences)
+    return graph.value(sequences_uri, NS.rdf.first) if sequences_uri is not None else None
+
+def sequence_canvas_range(graph, sequence_uri, start=0, count=None):
+    """
+    Returns the canvases of a sequence from position `start`, `count` of them (or the rest, if count
+    is None). Where the store allows, the list is read a number of cells per query (see
+    subgraphs.fetch_lists), rather than a cell at a time, and only as far as the last canvas asked for.
+    """
+    sequence_uri = URIRef(sequence_uri)
+    stop = start + count if count is not None else None
+
+    local = graph
+    if subgraphs.supports_construct(graph, sequence_uri):
+        local = Graph()
+        # The lists are walked from the link to their head, so it is fetched first
+        local += graph.triples((sequence_uri, NS.sc.hasCanvases, None))
+        subgraphs.fetch_lists(graph, local, [(sequence_uri, NS.sc.hasCanvases)], length=stop)
+
+    return list(itertools.islice(sequence_canvases(local, sequence_uri), start, stop))
+
 def manuscript_subgraph(graph, manuscript_uri):
     subgraph = Graph()
 
     subgraph += graph.triples((manuscript_uri, None, None))
     subgraph += list_subgraph(graph, graph.value(manuscript_uri, NS.sc.hasSequences))
 
-    for sequence in sequences(graph, manuscript_uri):
-        subgraph += graph.triples((sequence, None, None))
-        subgraph += list_subgraph(graph, graph.value(sequence, NS.sc.hasCanvases))
-        for canvas in sequence_canvases(graph, sequence):
-            subgraph += metadata_triples(graph, canvas)
+    # The sequences, and then their canvases, are independent of each other, so are read concurrently
+    def sequence_subgraph(sequence):
+        def read():
+            sequence_graph = Graph()
+            sequence_graph += graph.triples((sequence, None, None))
+            sequence_graph += list_subgraph(graph, graph.value(sequence, NS.sc.hasCanvases))
+            return sequence_graph
+        return read
+
+    sequence_uris = list(sequences(subgraph, manuscript_uri))
+
+    canvas_uris = []
+    for sequence, sequence_graph in zip(sequence_uris, gather(graph, [sequence_subgraph(sequence) for sequence in sequence_uris])):
+        subgraph += sequence_graph
+        canvas_uris.extend(sequence_canvases(sequence_graph, sequence))
+
+    for triples in gather(graph, [lambda canvas=canvas: list(metadata_triples(graph, canvas)) for canvas in canvas_uris]):
+        subgraph += triples
 
     return subgraph
@@ -61,3 +61,125 @@ class UploadedImage(models.Model):
     def __str__(self):
         return self.imagefile.name[len(IMAGE_UPLOAD_LOCATION):]
 
+
+class GraphStatistics(models.Model):
+    """
+    An entry of the catalog of named graphs in the rdf store (see semantic_store.graph_catalog).
+    The counts are those of the last time the graph was counted; a write to the graph since then
+    marks them as stale. The number of triples may be counted again without the triples of each
+    predicate, which stay stale until they are counted. The revision is incremented by every write
+    to the graph.
+    """
+    identifier = models.CharField(max_length=2000, unique=True)
+    triples = models.IntegerField(null=True)
+    predicates = models.TextField(default='{}')
+    modified = models.DateTimeField(null=True)
+    counted = models.DateTimeField(null=True)
+    stale = models.BooleanField(default=True)
+    predicates_stale = models.BooleanField(default=True)
+    revision = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return '%s: %s triples%s' % (self.identifier, self.triples, ' (stale)' if self.stale else '')
+
+class ProjectChange(models.Model):
+    """
+    An entry of the changelog of a project graph (see semantic_store.changelog): the triples added
+    and removed by one write, as RDF Patch. Its id is the project's revision after the write. A
+    truncated entry marks that the changes before it are not in the log, as they were compacted
+    away or the whole graph was removed.
+    """
+    graph = models.CharField(max_length=2000, db_index=True)
+    patch = models.TextField(blank=True, default='')
+    truncated = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __unicode__(self):
+        return '%s revision %d%s' % (self.graph, self.pk, ' (truncated)' if self.truncated else '')
+
+class ProjectCollection(models.Model):
+    """
+    The last garbage collection of a project graph (see semantic_store.project_gc), and the revision
+    of the graph it left, so a project which has not been written since is not collected again
+    """
+    identifier = models.CharField(max_length=2000, db_index=True)
+    revision = models.IntegerField(default=0)
+    collected = models.DateTimeField()
+    removed = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return '%s: %d triples removed %s' % (self.identifier, self.removed, self.collected)
+
+class ProjectDeletion(models.Model):
+    """
+    A project being deleted in the background (see semantic_store.project_deletion), with the steps
+    of the deletion which have been completed, and what each removed
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATE_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    identifier = models.CharField(max_length=2000, db_index=True)
+    requested_by = models.ForeignKey(User, null=True)
+    state = models.CharField(max_length=10, choices=STATE_CHOICES, default=PENDING, db_index=True)
+    completed_steps = models.IntegerField(default=0)
+    progress = models.TextField(default='{}')
+    error = models.TextField(blank=True, default='')
+    requested = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True)
+
+    def __unicode__(self):
+        return '%s: %s' % (self.identifier, self.state)
+
+class CanvasView(models.Model):
+    """
+    A materialised canvas view (see semantic_store.canvas_views): the graph served when a canvas of
+    a project is read, stored under the canvas's identifier, while none of the resources it was
+    built from have been written since
+    """
+    project = models.CharField(max_length=2000, db_index=True)
+    canvas = models.CharField(max_length=2000, db_index=True)
+    built = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return '%s in %s' % (self.canvas, self.project)
+
+class CanvasViewResource(models.Model):
+    """A resource a materialised canvas view was built from, whose writes invalidate the view"""
+    view = models.ForeignKey(CanvasView, related_name='resources')
+    resource = models.CharField(max_length=2000, db_index=True)
+
+class ImageDerivatives(models.Model):
+    """
+    The generation of the thumbnails and tile pyramid of an uploaded image (see
+    semantic_store.image_derivatives)
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATE_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    image = models.OneToOneField(UploadedImage, related_name='derivatives')
+    state = models.CharField(max_length=10, choices=STATE_CHOICES, default=PENDING, db_index=True)
+    error = models.TextField(blank=True, default='')
+    requested = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+
+    def __unicode__(self):
+        return '%s: %s' % (self.image, self.state)
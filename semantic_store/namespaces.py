@@ -22,6 +22,7 @@ ns = {
     'skos': Namespace("http://www.w3.org/2004/02/skos/core#"),
     'trig': Namespace("http://www.w3.org/2004/03/trix/rdfg-1/"),
     'perm': Namespace("http://vocab.ox.ac.uk/perm#"),
+    'void': Namespace("http://rdfs.org/ns/void#"),
     'dm': Namespace("http://dm.drew.edu/ns/")
 }
 
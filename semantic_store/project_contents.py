@@ -0,0 +1,100 @@
+"""
+Paginated listing of the contents of a project, and its summary.
+
+The resources a project aggregates are listed in pages ordered by uri, read from the project's
+metadata graph. A page is followed by a cursor, the (encoded) uri of its last resource; the next
+page starts after that uri, so pages stay stable while resources are added or removed elsewhere in
+the listing. Only the metadata of the resources on a page is read.
+
+The summary of a project is its own metadata (title, description, etc.), with the number of
+resources it aggregates, in total and of each rdf:type, as VoID entity counts.
+"""
+from django.conf import settings
+
+from rdflib import Graph, URIRef, BNode, Literal
+
+from semantic_store.rdfstore import gather
+from semantic_store.namespaces import NS
+from semantic_store.project_metadata import ProjectMetadata
+from semantic_store.utils import metadata_triples
+from semantic_store import queries
+
+import base64
+import heapq
+
+class InvalidCursor(ValueError):
+    pass
+
+def page_size_setting():
+    return getattr(settings, 'PROJECT_CONTENTS_PAGE_SIZE', 100)
+
+def max_page_size_setting():
+    return getattr(settings, 'PROJECT_CONTENTS_MAX_PAGE_SIZE', 1000)
+
+def encode_cursor(uri):
+    return base64.urlsafe_b64encode(unicode(uri).encode('utf-8')).rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        return base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)).decode('utf-8')
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidCursor('Invalid cursor %r' % cursor)
+
+def aggregates_after(metadata_graph, project_uri, after, limit, types=()):
+    """The uris of the first `limit` resources aggregated by the project after `after`, in order"""
+    if not types:
+        return [row[0] for row in queries.run('aggregates_after', metadata_graph, project_uri=project_uri, after=after,
+                                              limit=limit)]
+
+    # Merged in order, as a resource may be of several of the types
+    listings = [[row[0] for row in queries.run('aggregates_of_type_after', metadata_graph,
+                                               project_uri=project_uri, type=t, after=after, limit=limit)] for t in types]
+    aggregates = []
+    for uri in heapq.merge(*listings):
+        if not aggregates or aggregates[-1] != uri:
+            aggregates.append(uri)
+    return aggregates[:limit]
+
+def contents_page(project_uri, cursor=None, limit=None, types=()):
+    """
+    Returns a graph of a page of the resources a project aggregates, with their metadata, and the
+    cursor of the next page (None if it is the last page)
+    """
+    project_uri = URIRef(project_uri)
+    if limit is None:
+        limit = page_size_setting()
+    limit = max(1, min(limit, max_page_size_setting()))
+    after = decode_cursor(cursor) if cursor else u''
+
+    project_metadata = ProjectMetadata(project_uri)
+    # One more than the page, to tell whether there is a next page
+    aggregates = aggregates_after(project_metadata.metadata_graph, project_uri, Literal(after), limit + 1, types)
+    page = aggregates[:limit]
+
+    graph = Graph()
+    for uri, triples in zip(page, gather(project_metadata.metadata_graph,
+                                         [lambda uri=uri: project_metadata.cached(uri) for uri in page])):
+        graph.add((project_uri, NS.ore.aggregates, uri))
+        graph += triples
+
+    next_cursor = encode_cursor(page[-1]) if len(aggregates) > limit else None
+    return graph, next_cursor
+
+def contents_summary(project_uri):
+    """Returns a graph of the project's own metadata, and of the number of resources it aggregates"""
+    project_uri = URIRef(project_uri)
+    metadata_graph = ProjectMetadata(project_uri).metadata_graph
+
+    graph = Graph()
+    graph += metadata_triples(metadata_graph, project_uri)
+
+    for count, in queries.run('aggregate_count', metadata_graph, project_uri=project_uri):
+        graph.add((project_uri, NS.void.entities, Literal(int(count))))
+
+    for resource_type, count in queries.run('aggregate_type_counts', metadata_graph, project_uri=project_uri):
+        partition = BNode()
+        graph.add((project_uri, NS.void.classPartition, partition))
+        graph.add((partition, NS.void['class'], resource_type))
+        graph.add((partition, NS.void.entities, Literal(int(count))))
+
+    return graph
@@ -0,0 +1,233 @@
+"""
+Deletion of projects, with everything kept about them.
+
+A project's data lives in its project and metadata graphs, its texts (Text rows, and their entries
+in the search index), the images uploaded for its canvases, its materialised canvas views, and its
+changelog and garbage collection records. Deleting a project removes each of these in bulk, one step at a time: graphs are dropped
+whole (see BatchingStore.drop_graph), and rows are deleted a page at a time by primary key, rather
+than object by object.
+
+A deletion is requested by removing the project's permissions, so it disappears from every user at
+once, and queueing a ProjectDeletion, which is run in a background thread (or, with the setting
+PROJECT_DELETION_IN_BACKGROUND = False, by the delete_projects command, e.g. from cron). The
+deletion records each step as it completes, and how much the step removed so far, so its progress
+can be followed, and an interrupted deletion resumes from the step it was in.
+"""
+from django.conf import settings
+from django.db import connection as db_connection
+from django.db.models.sql import DeleteQuery
+from django.utils import timezone
+
+from rdflib import Graph, URIRef
+
+from semantic_store.rdfstore import rdfstore
+from semantic_store.namespaces import NS
+from semantic_store.models import (ProjectPermission, ProjectDeletion, ProjectChange, ProjectCollection, Text,
+                                   UploadedImage)
+from semantic_store.exports import text_pages
+from semantic_store import uris, canvas_views, image_derivatives, iiif
+
+from settings import IMAGE_UPLOAD_LOCATION
+
+import json
+import logging
+import threading
+import traceback
+
+# Number of rows deleted at a time
+PAGE_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+def in_background_setting():
+    return getattr(settings, 'PROJECT_DELETION_IN_BACKGROUND', True)
+
+def project_graph_identifiers(project_uri):
+    return [uris.uri('semantic_store_projects', uri=project_uri), uris.project_metadata_graph_identifier(project_uri)]
+
+def remove_permissions(project_uri, store, report):
+    permissions = ProjectPermission.objects.filter(identifier=project_uri)
+    count = permissions.count()
+    permissions.delete()
+    return count
+
+def remove_from_search_index(project_uri, store, report):
+    """Removes the project's texts from each search index, by query where the backend allows it"""
+    from haystack import connections
+    try:
+        from haystack.backends.solr_backend import SolrSearchBackend
+    except ImportError:
+        SolrSearchBackend = None
+
+    removed = 0
+    for search_connection in connections.all():
+        backend = search_connection.get_backend()
+
+        if SolrSearchBackend is not None and isinstance(backend, SolrSearchBackend):
+            backend.conn.delete(q='django_ct:semantic_store.text AND project:"%s"' % (
+                project_uri.replace('\\', '\\\\').replace('"', '\\"')))
+        else:
+            for text in text_pages(project_uri, PAGE_SIZE):
+                backend.remove(text)
+                removed += 1
+                if removed % PAGE_SIZE == 0:
+                    report(removed)
+    return removed
+
+def remove_texts(project_uri, store, report):
+    """Deletes every version of the project's texts, a page of primary keys at a time"""
+    removed = 0
+    while True:
+        pks = list(Text.objects.filter(project=project_uri).values_list('pk', flat=True)[:PAGE_SIZE])
+        if not pks:
+            return removed
+
+        # A DeleteQuery skips the per-object signals, which would update the search index one text at a time
+        DeleteQuery(Text).delete_batch(pks, db_connection.alias)
+        removed += len(pks)
+        report(removed)
+
+def remove_uploaded_images(project_uri, store, report):
+    """
+    Deletes the images uploaded for the project's canvases, unless they are public or used outside
+    of the project
+    """
+    project_graphs = set(unicode(identifier) for identifier in project_graph_identifiers(project_uri))
+    project_graph = Graph(store, project_graph_identifiers(project_uri)[0])
+
+    images_by_name = {}
+    for image_uri in project_graph.subjects(NS.rdf.type, NS.dcmitype.Image):
+        start = image_uri.find(IMAGE_UPLOAD_LOCATION)
+        if start >= 0:
+            images_by_name[unicode(image_uri[start:])] = image_uri
+
+    removed = 0
+    for image in UploadedImage.objects.filter(imagefile__in=images_by_name.keys(), isPublic=False):
+        image_uri = images_by_name[image.imagefile.name]
+        contexts = set(unicode(getattr(context, 'identifier', context)) for pattern in
+                       ((image_uri, None, None), (None, None, image_uri)) for context in store.contexts(pattern))
+        if contexts - project_graphs:
+            continue
+
+        image_derivatives.delete_files(image)
+        iiif.forget(image)
+        image.imagefile.delete(save=False)
+        image.delete()
+        removed += 1
+    return removed
+
+def remove_canvas_views(project_uri, store, report):
+    return canvas_views.invalidate(project_uri, None, store)
+
+def drop_graphs(project_uri, store, report):
+    """Drops the project and metadata graphs, returning the number of triples they held"""
+    graphs = [Graph(store, identifier) for identifier in project_graph_identifiers(project_uri)]
+    count = sum(len(graph) for graph in graphs)
+
+    with store.batch():
+        for graph in graphs:
+            store.drop_graph(graph)
+    return count
+
+def remove_records(project_uri, store, report):
+    """Deletes the project's changelog and garbage collection records"""
+    identifier = unicode(project_graph_identifiers(project_uri)[0])
+
+    changes = ProjectChange.objects.filter(graph=identifier)
+    count = changes.count()
+    changes.delete()
+    ProjectCollection.objects.filter(identifier=identifier).delete()
+    return count
+
+# The steps of a deletion, in order: (name, function(project_uri, store, report)). Each returns the
+# number of things it removed, and may report(count) its progress as it goes; each must be safe to
+# run again from the start, should a deletion be interrupted.
+STEPS = [
+    ('permissions', remove_permissions),
+    ('search index', remove_from_search_index),
+    ('texts', remove_texts),
+    ('uploaded images', remove_uploaded_images),
+    ('canvas views', remove_canvas_views),
+    ('graphs', drop_graphs),
+    ('records', remove_records),
+]
+
+def status(deletion):
+    """A dictionary of the state and progress of a deletion"""
+    return {
+        'project': deletion.identifier,
+        'state': deletion.state,
+        'steps': [name for name, function in STEPS],
+        'completed_steps': deletion.completed_steps,
+        'removed': json.loads(deletion.progress),
+        'error': deletion.error or None,
+        'requested': deletion.requested.isoformat() if deletion.requested else None,
+        'finished': deletion.finished.isoformat() if deletion.finished else None,
+    }
+
+def run(deletion, store=None):
+    """Runs (or resumes) a deletion, returning it once it is done or has failed"""
+    store = store or rdfstore()
+    progress = json.loads(deletion.progress)
+
+    deletion.state = ProjectDeletion.RUNNING
+    deletion.save()
+
+    def report(name):
+        def save_count(count):
+            progress[name] = count
+            ProjectDeletion.objects.filter(pk=deletion.pk).update(progress=json.dumps(progress))
+        return save_count
+
+    try:
+        for name, function in STEPS[deletion.completed_steps:]:
+            progress[name] = function(URIRef(deletion.identifier), store, report(name))
+            deletion.completed_steps += 1
+            deletion.progress = json.dumps(progress)
+            deletion.save()
+    except Exception:
+        logger.exception('Deleting project %s failed', deletion.identifier)
+        deletion.state = ProjectDeletion.FAILED
+        deletion.error = traceback.format_exc()
+    else:
+        deletion.state = ProjectDeletion.DONE
+        deletion.error = ''
+
+    deletion.progress = json.dumps(progress)
+    deletion.finished = timezone.now()
+    deletion.save()
+    return deletion
+
+def run_in_background(deletion_pk):
+    try:
+        run(ProjectDeletion.objects.get(pk=deletion_pk))
+    finally:
+        # Each thread has a database connection of its own
+        db_connection.close()
+
+def request_deletion(project_uri, user=None):
+    """
+    Queues the deletion of a project, and starts it in the background (unless the setting
+    PROJECT_DELETION_IN_BACKGROUND is False). The project's permissions are removed at once.
+    Returns the ProjectDeletion.
+    """
+    project_uri = unicode(project_uri)
+    ProjectPermission.objects.filter(identifier=project_uri).delete()
+
+    queued = list(ProjectDeletion.objects.filter(identifier=project_uri,
+                                                 state__in=(ProjectDeletion.PENDING, ProjectDeletion.RUNNING))[:1])
+    if queued:
+        return queued[0]
+
+    deletion = ProjectDeletion.objects.create(identifier=project_uri, requested_by=user)
+
+    if in_background_setting():
+        thread = threading.Thread(target=run_in_background, args=(deletion.pk,))
+        thread.daemon = True
+        thread.start()
+
+    return deletion
+
+def latest_deletion(project_uri):
+    deletions = list(ProjectDeletion.objects.filter(identifier=unicode(project_uri)).order_by('-pk')[:1])
+    return deletions[0] if deletions else None
@@ -0,0 +1,95 @@
+"""
+Garbage collection of project graphs: removing the triples about resources which are no longer
+reachable from the project (orphaned annotations, specific resources, selectors, etc., see
+projects.reachable_resources).
+
+Each project graph is read once, into memory, and traversed there; the orphaned triples are then
+removed in small batches, so writers are never held up for long. Before each batch, the graph's
+revision (from the graph catalog) is compared with the revision it was read at, and the collection
+of the project stops if anyone else has written to it since, as they may have linked to a resource
+which was orphaned when it was read.
+
+Each collection is recorded (models.ProjectCollection) with the revision of the graph it left, so
+scheduled runs only collect the projects which have been written since their last collection.
+"""
+from django.utils import timezone
+
+from rdflib import Graph, URIRef
+
+from semantic_store.rdfstore import rdfstore
+from semantic_store.projects import reachable_resources
+from semantic_store.models import ProjectCollection
+from semantic_store import uris
+
+import itertools
+
+BATCH_SIZE = 500
+
+class ConcurrentWrite(Exception):
+    """Raised when a project graph is written by someone else while it is being collected"""
+    pass
+
+def graph_revision(store, identifier):
+    catalog = getattr(store, 'catalog', None)
+    if catalog is None:
+        return 0
+    return catalog.revisions([identifier])[unicode(identifier)][0]
+
+def orphaned_triples(graph, project_uri):
+    """Returns the triples of a project graph about resources which are not reachable from the project"""
+    memory_graph = Graph()
+    memory_graph += graph
+
+    reachable = reachable_resources(memory_graph, project_uri)
+    return [t for t in memory_graph if t[0] not in reachable]
+
+def last_collection(identifier):
+    collections = list(ProjectCollection.objects.filter(identifier=identifier)[:1])
+    return collections[0] if collections else None
+
+def is_due(project_uri, store=None):
+    """Whether a project has been written since it was last collected (or has never been collected)"""
+    store = store or rdfstore()
+    identifier = unicode(uris.uri('semantic_store_projects', uri=project_uri))
+
+    collection = last_collection(identifier)
+    return collection is None or collection.revision != graph_revision(store, identifier)
+
+def collect(project_uri, delete=False, batch_size=BATCH_SIZE, store=None):
+    """
+    Finds the orphaned triples of a project graph, and removes them if `delete` is set. Returns the
+    list of orphaned triples, and the number removed. Raises ConcurrentWrite (having removed some of
+    them, perhaps) if the graph is written by someone else meanwhile.
+    """
+    store = store or rdfstore()
+    project_uri = URIRef(project_uri)
+    identifier = unicode(uris.uri('semantic_store_projects', uri=project_uri))
+    graph = Graph(store, URIRef(identifier))
+
+    revision = graph_revision(store, identifier)
+    orphans = orphaned_triples(graph, project_uri)
+
+    removed = 0
+    if delete:
+        triples = iter(orphans)
+        while True:
+            chunk = list(itertools.islice(triples, batch_size))
+            if not chunk:
+                break
+
+            if graph_revision(store, identifier) != revision:
+                raise ConcurrentWrite('%s was written while it was being collected' % project_uri)
+
+            with store.batch():
+                for t in chunk:
+                    graph.remove(t)
+            removed += len(chunk)
+            revision = graph_revision(store, identifier)
+
+        collection = last_collection(identifier) or ProjectCollection(identifier=identifier)
+        collection.revision = revision
+        collection.collected = timezone.now()
+        collection.removed = removed
+        collection.save()
+
+    return orphans, removed
@@ -0,0 +1,203 @@
+"""
+Maintenance of the project metadata graphs, the caches returned when a project's contents are
+read (see projects.get_project_metadata_graph).
+
+Every triple of a metadata graph is a copy of a triple of its project graph, derived for one
+"unit" of the project:
+
+- the project itself: its metadata triples (utils.metadata_triples), and what it aggregates
+- each aggregated canvas: all of the canvas's triples, its image annotations and their images
+  (canvases.canvas_and_images_graph)
+- each other aggregated resource: its metadata triples
+
+Writes to a project graph are made inside `maintaining(project_uri)`, which records the subjects
+(and linked resources) they touch through the store's write listeners. Once the block is done,
+only the units depending on those resources are derived again, and the difference from the
+metadata graph is written, so the cache is never rebuilt as a whole on a write.
+
+`ProjectMetadata.check` derives the whole metadata graph and compares it with the cache, and
+`repair` writes the difference when they have drifted apart; the rebuild_metadata management
+command repairs projects in bulk.
+"""
+from rdflib import Graph, URIRef
+
+from semantic_store.rdfstore import rdfstore, gather
+from semantic_store.namespaces import NS
+from semantic_store import uris
+from semantic_store.utils import metadata_triples
+from semantic_store.canvases import canvas_and_images_graph
+
+from contextlib import contextmanager
+import threading
+
+CANVAS_TYPES = (NS.sc.Canvas, NS.dms.Canvas)
+
+# Predicates linking a resource to the unit its triples are derived for
+LINK_PREDICATES = (NS.ore.aggregates, NS.oa.hasTarget, NS.oa.hasBody)
+
+class ProjectMetadata(object):
+    def __init__(self, project_uri, store=None):
+        if store is None:
+            store = rdfstore()
+
+        self.store = store
+        self.project_uri = URIRef(project_uri)
+        self.project_graph = Graph(store, uris.uri('semantic_store_projects', uri=project_uri))
+        self.metadata_graph = Graph(store, uris.project_metadata_graph_identifier(project_uri))
+
+    def aggregates(self, graph):
+        return set(graph.objects(self.project_uri, NS.ore.aggregates))
+
+    def derive(self, unit, aggregates):
+        """The metadata triples of a unit, derived from the project graph"""
+        if unit == self.project_uri:
+            triples = list(metadata_triples(self.project_graph, unit))
+            triples.extend((unit, NS.ore.aggregates, aggregate) for aggregate in aggregates)
+            return triples
+        elif unit not in aggregates:
+            return []
+        elif any((unit, NS.rdf.type, t) in self.project_graph for t in CANVAS_TYPES):
+            return list(canvas_and_images_graph(self.project_graph, unit))
+        else:
+            return list(metadata_triples(self.project_graph, unit))
+
+    def cached(self, unit):
+        """The triples of a unit in the metadata graph"""
+        if unit == self.project_uri:
+            return list(self.metadata_graph.triples((unit, None, None)))
+        else:
+            # A superset of the metadata triples of any aggregate, whatever its type was
+            return list(canvas_and_images_graph(self.metadata_graph, unit))
+
+    def expected(self):
+        """Derives the whole metadata graph from the project graph, in memory"""
+        aggregates = self.aggregates(self.project_graph)
+        units = [self.project_uri] + sorted(aggregates)
+
+        expected = Graph()
+        for triples in gather(self.project_graph, [lambda unit=unit: self.derive(unit, aggregates) for unit in units]):
+            expected += triples
+        return expected
+
+    def check(self):
+        """Returns the sets of triples (missing, extra) by which the metadata graph has drifted"""
+        expected = set(self.expected())
+        cached = set(self.metadata_graph)
+        return expected - cached, cached - expected
+
+    def repair(self):
+        """
+        Writes the difference between the metadata graph and the project graph, if they have
+        drifted apart. Returns the number of triples added and removed.
+        """
+        missing, extra = self.check()
+        self.apply(missing, extra)
+        return len(missing), len(extra)
+
+    def apply(self, added, removed):
+        if not added and not removed:
+            return
+
+        with self.store.batch():
+            for t in removed:
+                self.metadata_graph.remove(t)
+            for t in added:
+                self.metadata_graph.add(t)
+
+    def affected_units(self, resources):
+        """The units whose metadata may depend on any of the resources"""
+        project_aggregates = self.aggregates(self.project_graph)
+        cached_aggregates = self.aggregates(self.metadata_graph)
+        aggregates = project_aggregates | cached_aggregates
+
+        units = set(r for r in resources if r == self.project_uri or r in aggregates)
+        if self.project_uri in units:
+            units.update(project_aggregates ^ cached_aggregates)
+
+        # Image annotations and images, which are part of the unit of the canvas they target,
+        # as recorded in the project graph now, or in the metadata graph before the write
+        others = list(set(resources) - units)
+        if others:
+            for graph in (self.project_graph, self.metadata_graph):
+                annotations = set(others)
+                annotations.update(s for s, p, o in graph.triples_choices((None, NS.oa.hasBody, others)))
+                units.update(o for s, p, o in graph.triples_choices((list(annotations), NS.oa.hasTarget, None))
+                             if o in aggregates)
+
+        return units, project_aggregates
+
+    def update(self, resources):
+        """Derives the units depending on the resources again, writing the difference"""
+        units, aggregates = self.affected_units(resources)
+        if not units:
+            return
+
+        units = sorted(units)
+        derived = gather(self.project_graph, [lambda unit=unit: self.derive(unit, aggregates) for unit in units])
+        cached = gather(self.metadata_graph, [lambda unit=unit: self.cached(unit) for unit in units])
+
+        expected = set(t for triples in derived for t in triples)
+        current = set(t for triples in cached for t in triples)
+        self.apply(expected - current, current - expected)
+
+class ChangeTracker(object):
+    """Records the resources touched by the writes to a project graph"""
+
+    def __init__(self, project_metadata):
+        self.identifier = project_metadata.project_graph.identifier
+        self.resources = set()
+        self.everything = False
+
+    def written(self, batch):
+        for kind, context, triples in batch.operations():
+            if context is None or context.identifier != self.identifier:
+                continue
+
+            for s, p, o in triples:
+                if s is None:
+                    self.everything = True
+                    continue
+
+                self.resources.add(s)
+                if p in LINK_PREDICATES and isinstance(o, URIRef):
+                    self.resources.add(o)
+
+_local = threading.local()
+
+def _trackers():
+    if not hasattr(_local, 'trackers'):
+        _local.trackers = []
+    return _local.trackers
+
+def _written(batch):
+    for tracker in _trackers():
+        tracker.written(batch)
+
+@contextmanager
+def maintaining(project_uri, store=None):
+    """
+    Maintains the metadata graph of a project through the writes made to its project graph by
+    the calling thread in the block
+    """
+    project_metadata = ProjectMetadata(project_uri, store)
+    store = project_metadata.store
+    if _written not in store.write_listeners:
+        store.write_listeners.append(_written)
+
+    tracker = ChangeTracker(project_metadata)
+    _trackers().append(tracker)
+    try:
+        yield project_metadata
+        # Writes still buffered by an enclosing batch
+        store.flush_batch()
+    finally:
+        _trackers().remove(tracker)
+
+    if tracker.everything:
+        project_metadata.repair()
+    elif tracker.resources:
+        project_metadata.update(tracker.resources)
+
+def rebuild(project_uri, store=None):
+    """Repairs the metadata graph of a project, returning the number of triples added and removed"""
+    return ProjectMetadata(project_uri, store).repair()
@@ -8,7 +8,7 @@ from rdflib import Literal, URIRef
 
 from semantic_store.rdfstore import rdfstore
 from semantic_store.namespaces import NS, ns, bind_namespaces
-from semantic_store import uris
+from semantic_store import uris, subgraphs, project_metadata
 from semantic_store.utils import parse_request_into_graph, NegotiatedGraphResponse
 from semantic_store.models import Text
 from semantic_store.users import has_permission_over
@@ -19,6 +19,15 @@ from datetime import datetime
 
 from bs4 import BeautifulSoup, Comment
 
+# Class of the elements by which the text editor marks the highlights of a text; their about attribute is the
+# uri of the highlight's selector
+HIGHLIGHT_CLASS = 'atb-editor-textannotation'
+
+def selector_uris_in_text_content(content):
+    """Returns the uris of the selectors of the highlights marked in the (html) content of a text"""
+    soup = BeautifulSoup(content)
+    return [URIRef(element['about']) for element in soup.find_all(class_=HIGHLIGHT_CLASS) if element.get('about')]
+
 def sanitized_content(content):
     soup = BeautifulSoup(content)
 
@@ -66,16 +75,22 @@ def overwrite_text_graph_from_model(text_uri, project_uri, text_g):
     try:
         text = Text.objects.get(identifier=text_uri, valid=True, project=project_uri)
     except ObjectDoesNotExist:
-        pass
+        return text_g
     else:
-        text_g.add((text_uri, NS.rdf.type, NS.dctypes.Text))
-        text_g.add((text_uri, NS.rdf.type, NS.cnt.ContentAsChars))
+        return overwrite_text_graph_from_text(text, text_g)
+
+def overwrite_text_graph_from_text(text, text_g):
+    """Writes the triples of a Text which has already been read into text_g"""
+    text_uri = URIRef(text.identifier)
+
+    text_g.add((text_uri, NS.rdf.type, NS.dctypes.Text))
+    text_g.add((text_uri, NS.rdf.type, NS.cnt.ContentAsChars))
 
-        text_g.set((text_uri, NS.dc.title, Literal(text.title)))
-        text_g.set((text_uri, NS.rdfs.label, Literal(text.title)))
-        text_g.set((text_uri, NS.cnt.chars, Literal(text.content)))
+    text_g.set((text_uri, NS.dc.title, Literal(text.title)))
+    text_g.set((text_uri, NS.rdfs.label, Literal(text.title)))
+    text_g.set((text_uri, NS.cnt.chars, Literal(text.content)))
 
-        text_g.set((text_uri, NS.dc.modified, Literal(text.timestamp)))
+    text_g.set((text_uri, NS.dc.modified, Literal(text.timestamp)))
 
     return text_g
 
@@ -94,6 +109,9 @@ def read_project_text(project_uri, text_uri):
     # Make text uri URIRef (so Graph will understand)
     text_uri = URIRef(text_uri)
 
+    # Fetch everything read below about the text in one query
+    project_g = subgraphs.text(project_g, text_uri)
+
     # Create an empty graph and bind namespaces
     text_g = Graph()
     bind_namespaces(text_g)
@@ -114,7 +132,6 @@ def update_project_text(g, p_uri, t_uri, user):
     # Correctly format project uri and get project graph
     project_uri = uris.uri('semantic_store_projects', uri=p_uri)
     project_g = Graph(rdfstore(), identifier=project_uri)
-    project_metadata_g = Graph(rdfstore(), identifier=uris.project_metadata_graph_identifier(p_uri))
     text_uri = URIRef(t_uri)
 
     title = g.value(text_uri, NS.dc.title) or g.value(text_uri, NS.rdfs.label) or Literal("")
@@ -124,7 +141,7 @@ def update_project_text(g, p_uri, t_uri, user):
     else:
         content = ''
 
-    with transaction.commit_on_success():
+    with transaction.commit_on_success(), project_metadata.maintaining(p_uri), rdfstore().batch():
         for t in Text.objects.filter(identifier=t_uri, valid=True):
             t.valid = False
             t.save()
@@ -141,17 +158,10 @@ def update_project_text(g, p_uri, t_uri, user):
         text_url = URIRef(uris.url('semantic_store_project_texts', project_uri=p_uri, text_uri=text_uri))
         project_g.set((text_uri, NS.ore.isDescribedBy, text_url))
 
-        if (URIRef(p_uri), NS.ore.aggregates, text_uri) in project_metadata_g:
-            project_metadata_g.add((text_uri, NS.rdf.type, NS.dctypes.Text))
-            project_metadata_g.set((text_uri, NS.dc.title, title))
-            project_metadata_g.set((text_uri, NS.rdfs.label, title))
-
-    specific_resource_triples = specific_resources_subgraph(g, text_uri, p_uri)
-    for t in specific_resource_triples:
-        project_g.add(t)
+        project_g += specific_resources_subgraph(g, text_uri, p_uri)
 
-    for t in g.triples((None, NS.rdf.type, NS.oa.TextQuoteSelector)):
-        project_g.set(t)
+        for t in g.triples((None, NS.rdf.type, NS.oa.TextQuoteSelector)):
+            project_g.set(t)
 
 # Updates a project's text to match data in a (PUT) request
 # This function parses the data and then sends it to update_project_text which accepts a
@@ -175,25 +185,23 @@ def update_project_text_from_request(request, project_uri, text_uri):
 
 # Removes all data from a given project about a given text
 # Although intended to be user with a DELETE request, works independently of a request
-def remove_project_text(project_uri, text_uri):
+def remove_project_text(p_uri, text_uri):
     # Correctly format project uri and get project graph
-    project_uri = uris.uri('semantic_store_projects', uri=project_uri)
+    project_uri = uris.uri('semantic_store_projects', uri=p_uri)
     project_g = Graph(rdfstore(), identifier=project_uri)
-    project_metadata_g = Graph(rdfstore(), identifier=uris.project_metadata_graph_identifier(p_uri))
 
     # Make text uri a URIRef (so Graph will understand)
     text_uri = URIRef(text_uri)
 
-    with transaction.commit_on_success():
+    with transaction.commit_on_success(), project_metadata.maintaining(p_uri), rdfstore().batch():
         for t in specific_resources_subgraph(project_g, text_uri, project_uri):
             project_g.remove(t)
 
         for t in project_g.triples((text_uri, None, None)):
             # Delete triple about text from project graph
             project_g.remove(t)
-            project_metadata_g.remove(t)
 
-        project_g.remove((URIRef(project_uri), NS.ore.aggregates, text_uri))
+        project_g.remove((URIRef(p_uri), NS.ore.aggregates, text_uri))
 
         for text in Text.objects.filter(identifier=text_uri, valid=True).only('valid'):
             text.valid = False
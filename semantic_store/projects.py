@@ -4,17 +4,20 @@ from django.contrib.auth.models import User
 
 from rdflib.graph import Graph
 from rdflib.exceptions import ParserError
-from rdflib import URIRef, Literal
+from rdflib import URIRef, Literal, BNode
 
 from semantic_store.rdfstore import rdfstore
 from semantic_store.namespaces import NS, ns, bind_namespaces
 from semantic_store import uris
-from semantic_store.utils import NegotiatedGraphResponse, parse_request_into_graph, metadata_triples, print_triples
-from semantic_store.users import PERMISSION_PREDICATES, user_graph, user_metadata_graph
+from semantic_store.utils import NegotiatedGraphResponse, JsonResponse, parse_request_into_graph, print_triples
+from semantic_store.users import PERMISSION_PREDICATES, user_graph, user_metadata_graph, permissions_by_user, project_users_graph
 from semantic_store.project_texts import sanitized_content, text_graph_from_model
-from semantic_store import project_texts, canvases, permissions, manuscripts
-from semantic_store.models import ProjectPermission
+from semantic_store import project_texts, canvases, permissions, manuscripts, project_metadata, project_deletion, deltas
+from semantic_store.models import ProjectPermission, ProjectDeletion, Text
+from semantic_store.conditional import conditional_response
+from semantic_store.canvas_views import VOCABULARY_PREDICATES
 
+from collections import defaultdict
 from datetime import datetime
 import itertools
 
@@ -44,12 +47,6 @@ def create_project_from_request(request):
 
 def create_project(g):
     """Creates a project in the database (and the metadata cache) from an input graph"""
-    query = g.query("""SELECT ?uri ?user
-                    WHERE {
-                        ?user perm:hasPermissionOver ?uri .
-                        ?user rdf:type foaf:Agent .
-                    }""", initNs=ns)
-
     for uri in g.subjects(NS.rdf.type, NS.dm.Project):
         user = g.value(None, NS.perm.hasPermissionOver, uri)
         user_obj = User.objects.get(username=user.split('/')[-1])
@@ -62,21 +59,22 @@ def create_project(g):
             text_graph += g.triples((text_uri, None, None))
             project_texts.update_project_text(text_graph, uri, text_uri, user_obj)
 
-        for t in g:
-            project_g.add(t)
+        with rdfstore().batch():
+            project_g += g
 
-        for text_uri in g.subjects(NS.rdf.type, NS.dcmitype.Text):
-            project_g.remove((text_uri, NS.cnt.chars, None))
+            for text_uri in g.subjects(NS.rdf.type, NS.dcmitype.Text):
+                project_g.remove((text_uri, NS.cnt.chars, None))
+
+            url = uris.url('semantic_store_projects', uri=uri)
+            project_g.set((uri, NS.dcterms['created'], Literal(datetime.utcnow())))
 
-        url = uris.url('semantic_store_projects', uri=uri)
-        project_g.set((uri, NS.dcterms['created'], Literal(datetime.utcnow())))
+            if user:
+                project_g.remove((user, None, None))
+                username = user.split("/")[-1]
+                permissions.grant_full_project_permissions(username, uri)
 
-        if user:
-            project_g.remove((user, None, None))
-            username = user.split("/")[-1]
-            permissions.grant_full_project_permissions(username, uri)
+            add_project_types(project_g, uri)
 
-        add_project_types(project_g, uri)
         build_project_metadata_graph(uri)
 
         print "Successfully created project with uri " + uri
@@ -96,31 +94,14 @@ def add_is_described_bys(request, project_uri, graph):
 
 def build_project_metadata_graph(project_uri):
     """
-    Takes an entire project graph (with every triple in the project in it), and builds out the metadata cache graph with just
-    enough information to render the project in a GUI.
-    This should really only be called when importing a full project from a file, or to rebuild the cache. The cache should otherwise
-    be maintained with each update, as it is very expensive to rebuild this cache.
+    Takes an entire project graph (with every triple in the project in it), and brings the metadata cache graph up to date with
+    just enough information to render the project in a GUI, writing only the triples which differ from the cache.
+    This should really only be called when importing a full project from a file, or to repair the cache. The cache is otherwise
+    maintained with each update (see semantic_store.project_metadata).
     """
-    metadata_graph = get_project_metadata_graph(project_uri)
-    project_graph = get_project_graph(project_uri)
+    project_metadata.rebuild(project_uri)
 
-    metadata_graph += metadata_triples(project_graph, project_uri)
-
-    for aggregate_uri in project_graph.objects(project_uri, NS.ore.aggregates):
-        metadata_graph.add((project_uri, NS.ore.aggregates, aggregate_uri))
-
-        if ((aggregate_uri, NS.rdf.type, NS.sc.Canvas) in project_graph or
-            (aggregate_uri, NS.rdf.type, NS.dms.Canvas) in project_graph):
-            for t in canvases.canvas_and_images_graph(project_graph, aggregate_uri):
-                metadata_graph.add(t)
-        elif (aggregate_uri, NS.rdf.type, NS.dcmitype.Text) in project_graph:
-            for t in metadata_triples(project_graph, aggregate_uri):
-                metadata_graph.add(t)
-        else:
-            for t in metadata_triples(project_graph, aggregate_uri):
-                metadata_graph.add(t)
-
-    return metadata_graph
+    return get_project_metadata_graph(project_uri)
 
 def read_project(request, project_uri):
     """Returns a HttpResponse of the cached project metadata graph"""
@@ -128,26 +109,32 @@ def read_project(request, project_uri):
 
     if request.user.is_authenticated():
         if permissions.has_permission_over(project_uri, user=request.user, permission=NS.perm.mayRead):
-            identifier = uris.uri('semantic_store_projects', uri=project_uri)
-            store_metadata_graph = get_project_metadata_graph(project_uri)
-            ret_graph = Graph()
-            ret_graph += store_metadata_graph
-
-            add_is_described_bys(request, project_uri, ret_graph)
-
-            for permission in ProjectPermission.objects.filter(identifier=project_uri):
-                user = permission.user
-                user_uri = uris.uri('semantic_store_users', username=user.username)
-                perm_uri = permissions.PERMISSION_URIS_BY_MODEL_VALUE[permission.permission]
-
-                ret_graph += user_metadata_graph(user=user)
-                ret_graph.add((user_uri, NS.perm.hasPermissionOver, project_uri))
-                ret_graph.add((user_uri, perm_uri, project_uri))
-            
-            if len(ret_graph) > 0:
-                return NegotiatedGraphResponse(request, ret_graph)
-            else:
-                return HttpResponseNotFound()
+            user_permissions = permissions_by_user(project_uri)
+
+            def respond():
+                # Read first, so a client syncing from this revision may see changes it already has, but never misses one
+                revision = rdfstore().changelog.revision(project_uri)
+
+                store_metadata_graph = get_project_metadata_graph(project_uri)
+                ret_graph = Graph()
+                ret_graph += store_metadata_graph
+
+                add_is_described_bys(request, project_uri, ret_graph)
+
+                ret_graph += project_users_graph(project_uri, user_permissions)
+
+                if len(ret_graph) > 0:
+                    response = NegotiatedGraphResponse(request, ret_graph)
+                    response['X-Project-Revision'] = str(revision)
+                    return response
+                else:
+                    return HttpResponseNotFound()
+
+            # The users listed with their permissions are part of the response, as well as the metadata graph
+            values = [(user.username, user.email, user.first_name, user.last_name, ''.join(model_values))
+                      for user, model_values in user_permissions.iteritems()]
+
+            return conditional_response(request, [uris.project_metadata_graph_identifier(project_uri)], values, respond)
         else:
             return HttpResponseForbidden('User "%s" does not have read permissions over project "%s"' % (request.user.username, project_uri))
     else:
@@ -164,57 +151,51 @@ def update_project(request, uri):
             except (ParserError, SyntaxError) as e:
                 return HttpResponse(status=400, content="Unable to parse serialization.\n%s" % e)
 
-            update_project_graph(input_graph, URIRef(uri))
+            delta = update_project_graph(input_graph, URIRef(uri))
 
-            return HttpResponse(status=204)
+            return delta.add_headers(HttpResponse(status=204))
         else:
             return HttpResponseForbidden('User "%s" does not have update permissions over project "%s"' % (request.user.username, uri))
     else:
         return HttpResponse('Unauthorized', status=401)
 
 def update_project_graph(g, identifier):
-    """Updates the main project graph and the metadata graph from an input graph"""
-
-    uri = uris.uri('semantic_store_projects', uri=identifier)
+    """
+    Updates the main project graph (and so the metadata graph) from an input graph, writing only
+    the triples which changed. Returns the Delta written.
+    """
 
     project_g = get_project_graph(identifier)
-    project_metadata_g = get_project_metadata_graph(identifier)
-
-    #Prevent duplicate metadata
-    if (URIRef(identifier), NS.dc.title, None) in g:
-        project_g.remove((URIRef(identifier), NS.dc.title, None))
-        project_metadata_g.remove((URIRef(identifier), NS.dc.title, None))
-    if (URIRef(identifier), NS.rdfs.label, None) in g:
-        project_g.remove((URIRef(identifier), NS.rdfs.label, None))
-        project_metadata_g.remove((URIRef(identifier), NS.rdfs.label, None))
-    if (URIRef(identifier), NS.dcterms.description, None) in g:
-        project_g.remove((URIRef(identifier), NS.dcterms.description, None))
-        project_metadata_g.remove((URIRef(identifier), NS.dcterms.description, None))
-
-    for triple in g:
-        project_g.add(triple)
 
-    for triple in metadata_triples(g, identifier):
-        project_metadata_g.add(triple)
+    with project_metadata.maintaining(identifier):
+        #Prevent duplicate metadata
+        replaced = [(URIRef(identifier), p) for p in (NS.dc.title, NS.rdfs.label, NS.dcterms.description)]
+        return deltas.patch(project_g, g, replaced)
 
-    for triple in g.triples((identifier, NS.ore.aggregates, None)):
-        project_metadata_g.add(triple)
-
-        aggregate_uri = triple[2]
+def delete_project_from_request(request, uri):
+    """
+    Queues the deletion of a project, which is run in the background. Returns a 202 response of the
+    status of the deletion, whose progress can be followed at its Location.
+    """
+    if request.user.is_authenticated():
+        if permissions.has_permission_over(uri, user=request.user, permission=NS.perm.mayAdminister):
+            deletion = project_deletion.request_deletion(uri, request.user)
 
-        project_metadata_g += metadata_triples(project_g, aggregate_uri)
-        project_metadata_g += metadata_triples(g, aggregate_uri)
+            response = JsonResponse(project_deletion.status(deletion), status=202)
+            response['Location'] = uris.url('semantic_store_project_deletion', project_uri=uri)
+            return response
+        else:
+            return HttpResponseForbidden('User "%s" does not have administration permissions over project "%s"' % (request.user.username, uri))
+    else:
+        return HttpResponse(status=401)
 
 def delete_project(uri):
-    """Deletes a project with the given URI. (Cascades project permissions as well)"""
-    project_graph = get_project_graph(uri)
-    metadata_graph = get_project_metadata_graph(uri)
-    
-    with transaction.commit_on_success():
-        project_graph.remove((None, None, None))
-        metadata_graph.remove((None, None, None))
-
-        ProjectPermission.objects.filter(identifier=uri).delete()
+    """
+    Deletes a project with the given URI, and everything kept about it (permissions, texts, uploaded
+    images, etc., see semantic_store.project_deletion). Returns the finished ProjectDeletion.
+    """
+    deletion = ProjectDeletion.objects.create(identifier=uri)
+    return project_deletion.run(deletion)
 
 def delete_triples_from_project(request, uri):
     """Deletes the triples in a graph provided by a request object from the project graph.
@@ -230,13 +211,14 @@ def delete_triples_from_project(request, uri):
                 return HttpResponse(status=400, content="Unable to parse serialization.\n%s" % e)
 
             project_g = get_project_graph(uri)
-            project_metadata_g = get_project_metadata_graph(uri)
 
             for t in g:
                 if t in project_g:
-                    project_g.remove(t)
                     removed.add(t)
-                project_metadata_g.remove(t)
+
+            with project_metadata.maintaining(uri), rdfstore().batch():
+                for t in removed:
+                    project_g.remove(t)
 
             return NegotiatedGraphResponse(request, removed)
         else:
@@ -288,59 +270,84 @@ def is_top_level_project_resource(project_uri, uri):
     db_project_graph = get_project_graph(project_uri)
     return (URIRef(project_uri), NS.ore.aggregates, uri) in db_project_graph
 
+# Predicates by which a resource points at the resource it is about (annotations at their targets and bodies,
+# resource maps at the resources they describe), so it is reachable from it
+INCOMING_LINK_PREDICATES = (NS.oa.hasTarget, NS.oa.hasBody, NS.ore.describes)
+
+def text_contents(graph, project_uri, texts):
+    """Returns the content of each of the texts, from the graph, or else from the project's Text models"""
+    contents = dict((text, graph.value(text, NS.cnt.chars)) for text in texts)
+    if any(content is None for content in contents.values()):
+        for identifier, content in Text.objects.filter(project=unicode(project_uri), valid=True).values_list(
+                'identifier', 'content'):
+            if contents.get(URIRef(identifier), '') is None:
+                contents[URIRef(identifier)] = content
+    return contents
+
+def reachable_resources(graph, project_uri):
+    """
+    Returns the set of resources reachable from a project: those it aggregates, any resource linked to by a reachable
+    resource (other than the terms of a vocabulary, such as its types), and any resource pointing at a reachable
+    resource as an annotation or resource map. The specific resources on a canvas are reachable from it, but those
+    on a text only if their selectors are highlighted in its content.
+    The graph is read once, and traversed with adjacency indexes built in memory.
+    """
+    project_uri = URIRef(project_uri)
+
+    outgoing = defaultdict(set)
+    incoming = defaultdict(set)
+    by_source = defaultdict(set)
+    by_selector = defaultdict(set)
+    canvas_uris = set()
+    text_uris = set()
+    for s, p, o in graph.triples((None, None, None)):
+        if p == NS.rdf.type:
+            if o == NS.sc.Canvas:
+                canvas_uris.add(s)
+            elif o == NS.dctypes.Text:
+                text_uris.add(s)
+
+        if not isinstance(o, (URIRef, BNode)) or p in VOCABULARY_PREDICATES:
+            continue
+
+        outgoing[s].add(o)
+        if p in INCOMING_LINK_PREDICATES:
+            incoming[o].add(s)
+        elif p == NS.oa.hasSource:
+            by_source[o].add(s)
+        elif p == NS.oa.hasSelector:
+            by_selector[o].add(s)
+
+    for canvas in canvas_uris:
+        incoming[canvas].update(by_source.get(canvas, ()))
+
+    for text, content in text_contents(graph, project_uri, text_uris).items():
+        if content:
+            for selector in project_texts.selector_uris_in_text_content(unicode(content)):
+                incoming[text].update(by_selector.get(selector, ()))
+
+    reachable = set([project_uri])
+    frontier = [project_uri]
+    while frontier:
+        resource = frontier.pop()
+        for linked in itertools.chain(outgoing.get(resource, ()), incoming.get(resource, ())):
+            if linked not in reachable:
+                reachable.add(linked)
+                frontier.append(linked)
+
+    return reachable
+
 def clean_project_graph(graph, project_uri):
     """
-    Returns a set of all non-orphaned resource uris in a project (i.e., resources which are top level or linked by an annotation).
-    (Does a complete graph traversal)
+    Returns a graph of the triples of a project graph about resources which are not orphaned (see reachable_resources).
+    The project graph is read once.
     """
-    clean_graph = Graph()
-    clean_graph += graph.triples((project_uri, None, None))
+    memory_graph = Graph()
+    memory_graph += graph
 
-    visited = set()
-    frontier = set(graph.objects(project_uri, NS.ore.aggregates))
+    reachable = reachable_resources(memory_graph, project_uri)
 
-    def enqueue(o):
-        if isinstance(o, URIRef):
-            if o not in visited:
-                frontier.add(o)
-        else:
-            for i in o:
-                enqueue(i)
-
-    while len(frontier) > 0:
-        visited_resource = frontier.pop()
-        visited.add(visited_resource)
-
-        if (visited_resource, NS.rdf.type, NS.sc.Canvas) in graph:
-            # Visiting a Canvas
-            clean_graph += canvases.canvas_and_images_graph(graph, visited_resource)
-            enqueue(graph.subjects(NS.oa.hasSource, visited_resource))
-
-        elif (visited_resource, NS.rdf.type, NS.dctypes.Text) in graph:
-            # Visiting a Text
-            clean_graph += graph.triples((visited_resource, None, None))
-            content = graph.value(visited_resource, NS.cnt.chars)
-            if content:
-                for selector in project_texts.selector_uris_in_text_content(unicode(content)):
-                    specific_resource = graph.value(None, NS.oa.hasSelector, selector)
-                    if specific_resource:
-                        enqueue(specific_resource)
-
-        elif (visited_resource, NS.rdf.type, NS.oa.SpecificResource) in graph:
-            # Visiting a Specific Resource
-            clean_graph += graph.triples((visited_resource, None, None))
-            selector = graph.value(visited_resource, NS.oa.hasSelector)
-            if selector:
-                clean_graph += graph.triples((selector, None, None))
-
-
-        for anno in itertools.chain(
-                graph.subjects(NS.oa.hasTarget, visited_resource),
-                graph.subjects(NS.oa.hasBody, visited_resource)
-            ):
-            clean_graph += graph.triples((anno, None, None))
-            for s, p, linked_resource in graph.triples_choices((anno, [NS.oa.hasBody, NS.oa.hasTarget], None)):
-                enqueue(linked_resource)
+    clean_graph = Graph()
+    clean_graph += (t for t in memory_graph if t[0] in reachable)
 
     return clean_graph
-
@@ -0,0 +1,348 @@
+"""
+An embedded, on-disk, context aware rdflib store.
+
+Quads are kept in a single SQLite file, used as an embedded key-value file rather than through
+an ORM: terms are interned to integer ids, and the quads table is stored clustered on
+(context, subject, predicate, object) with covering indexes on (context, predicate, object,
+subject) and (context, object, subject, predicate), so every triple pattern within a named
+graph is answered by a range scan of one of the SPO, POS or OSP permutations. A (subject,
+predicate, object, context) index serves patterns over all graphs.
+
+The file is memory mapped and written in WAL mode, so readers in other threads (each of which
+uses its own connection) are not blocked by a writer.
+"""
+from rdflib import URIRef, Literal, BNode
+from rdflib.graph import Graph
+from rdflib.store import Store, VALID_STORE, NO_STORE
+
+from contextlib import contextmanager
+import os
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS terms (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    datatype TEXT NOT NULL,
+    language TEXT NOT NULL,
+    UNIQUE (value, kind, datatype, language)
+);
+CREATE TABLE IF NOT EXISTS quads (
+    c INTEGER NOT NULL,
+    s INTEGER NOT NULL,
+    p INTEGER NOT NULL,
+    o INTEGER NOT NULL,
+    PRIMARY KEY (c, s, p, o)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS quads_pos ON quads (c, p, o, s);
+CREATE INDEX IF NOT EXISTS quads_osp ON quads (c, o, s, p);
+CREATE INDEX IF NOT EXISTS quads_spoc ON quads (s, p, o, c);
+CREATE TABLE IF NOT EXISTS namespaces (
+    prefix TEXT PRIMARY KEY,
+    uri TEXT NOT NULL
+);
+"""
+
+URI = 'U'
+BNODE = 'B'
+LITERAL = 'L'
+
+# Largest number of ids bound in a single IN clause (SQLite's default limit is 999 parameters)
+CHOICES_CHUNK_SIZE = 500
+
+# Number of ids kept in each direction of the term caches before they are emptied
+TERM_CACHE_SIZE = 100000
+
+def term_key(term):
+    """Returns the (value, kind, datatype, language) row which identifies an rdflib term"""
+    if isinstance(term, Literal):
+        return (unicode(term), LITERAL, unicode(term.datatype or ''), unicode(term.language or ''))
+    elif isinstance(term, BNode):
+        return (unicode(term), BNODE, u'', u'')
+    elif isinstance(term, URIRef):
+        return (unicode(term), URI, u'', u'')
+    else:
+        raise TypeError('Cannot store %r in a quad store' % (term,))
+
+def key_term((value, kind, datatype, language)):
+    if kind == URI:
+        return URIRef(value)
+    elif kind == BNODE:
+        return BNode(value)
+    else:
+        return Literal(value, datatype=URIRef(datatype) if datatype else None, lang=language or None)
+
+class QuadStore(Store):
+    """
+    An rdflib store keeping fully indexed quads in an embedded SQLite file.
+
+    `open` takes the path of the file (or ':memory:', in which case the store is private to
+    the thread which opened it).
+    """
+    context_aware = True
+    formula_aware = False
+    transaction_aware = False
+    graph_aware = False
+
+    mmap_size = 256 * 1024 * 1024
+
+    def __init__(self, configuration=None, identifier=None):
+        self.identifier = identifier
+        self.path = None
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+        self._ids = {}
+        self._terms = {}
+        super(QuadStore, self).__init__(configuration)
+
+    # Connections
+
+    def open(self, configuration, create=True):
+        path = unicode(configuration)
+        if path != ':memory:' and not create and not os.path.exists(path):
+            return NO_STORE
+
+        self.path = path
+        connection = self._connection()
+        with self._write_lock:
+            connection.executescript(SCHEMA)
+            connection.commit()
+        return VALID_STORE
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            if self.path is None:
+                raise ValueError('The quad store has not been opened')
+
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level='DEFERRED')
+            connection.text_factory = unicode
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('PRAGMA mmap_size=%d' % self.mmap_size)
+            self._local.connection = connection
+        return connection
+
+    def close(self, commit_pending_transaction=False):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            if commit_pending_transaction:
+                connection.commit()
+            connection.close()
+            self._local.connection = None
+
+    def destroy(self, configuration):
+        self.close()
+        path = unicode(configuration)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    @contextmanager
+    def transaction(self):
+        """Runs the writes made in the block in one SQLite transaction"""
+        connection = self._connection()
+        depth = getattr(self._local, 'depth', 0)
+
+        if depth == 0:
+            self._write_lock.acquire()
+        self._local.depth = depth + 1
+
+        try:
+            yield connection
+        except:
+            if depth == 0:
+                connection.rollback()
+                # Ids interned by the transaction no longer exist
+                self._ids.clear()
+                self._terms.clear()
+            raise
+        else:
+            if depth == 0:
+                connection.commit()
+        finally:
+            self._local.depth = depth
+            if depth == 0:
+                self._write_lock.release()
+
+    # Term dictionary
+
+    def _cache(self, key, term_id):
+        if len(self._ids) > TERM_CACHE_SIZE:
+            self._ids.clear()
+            self._terms.clear()
+        self._ids[key] = term_id
+        self._terms[term_id] = key
+
+    def _lookup_id(self, term):
+        """Returns the id of a term, or None if it has never been stored"""
+        if isinstance(term, Graph):
+            term = term.identifier
+
+        key = term_key(term)
+        term_id = self._ids.get(key)
+        if term_id is None:
+            row = self._connection().execute(
+                'SELECT id FROM terms WHERE value = ? AND kind = ? AND datatype = ? AND language = ?', key).fetchone()
+            if row is not None:
+                term_id = row[0]
+                self._cache(key, term_id)
+        return term_id
+
+    def _intern(self, connection, term):
+        """Returns the id of a term, storing it if needed (inside a transaction)"""
+        if isinstance(term, Graph):
+            term = term.identifier
+
+        term_id = self._lookup_id(term)
+        if term_id is None:
+            key = term_key(term)
+            term_id = connection.execute(
+                'INSERT INTO terms (value, kind, datatype, language) VALUES (?, ?, ?, ?)', key).lastrowid
+            self._cache(key, term_id)
+        return term_id
+
+    def _term(self, term_id):
+        key = self._terms.get(term_id)
+        if key is None:
+            key = tuple(self._connection().execute(
+                'SELECT value, kind, datatype, language FROM terms WHERE id = ?', (term_id,)).fetchone())
+            self._cache(key, term_id)
+        return key_term(key)
+
+    # Patterns
+
+    def _where(self, pattern, context):
+        """
+        Builds the WHERE clause matching a pattern of terms, lists of terms (choices) or None.
+        Returns None if a term of the pattern has never been stored, so nothing can match.
+        """
+        clauses = []
+        params = []
+
+        for column, term in zip(('s', 'p', 'o', 'c'), tuple(pattern) + (context,)):
+            if term is None:
+                continue
+            if isinstance(term, Graph):
+                term = term.identifier
+
+            if isinstance(term, list):
+                ids = [i for i in (self._lookup_id(t) for t in set(term) if t is not None) if i is not None]
+                if not ids:
+                    return None
+
+                chunks = [ids[i:i + CHOICES_CHUNK_SIZE] for i in range(0, len(ids), CHOICES_CHUNK_SIZE)]
+                clauses.append('(%s)' % ' OR '.join('%s IN (%s)' % (column, ','.join('?' * len(chunk))) for chunk in chunks))
+                for chunk in chunks:
+                    params.extend(chunk)
+            else:
+                term_id = self._lookup_id(term)
+                if term_id is None:
+                    return None
+                clauses.append('%s = ?' % column)
+                params.append(term_id)
+
+        return ' AND '.join(clauses) or '1', params
+
+    def _match(self, pattern, context):
+        where = self._where(pattern, context)
+        if where is None:
+            return
+
+        where, params = where
+        if context is not None:
+            # Rows are fetched up front, as committing a write on the same connection (e.g. when
+            # removing the matched triples while iterating) would reset an open cursor
+            rows = self._connection().execute('SELECT s, p, o FROM quads WHERE %s' % where, params).fetchall()
+            contexts = [context]
+            for s, p, o in rows:
+                yield (self._term(s), self._term(p), self._term(o)), iter(contexts)
+        else:
+            rows = self._connection().execute(
+                'SELECT s, p, o, c FROM quads WHERE %s ORDER BY s, p, o' % where, params).fetchall()
+
+            current, graphs = None, []
+            for s, p, o, c in rows:
+                if (s, p, o) != current:
+                    if current is not None:
+                        yield tuple(self._term(i) for i in current), iter(graphs)
+                    current, graphs = (s, p, o), []
+                graphs.append(Graph(self, self._term(c)))
+            if current is not None:
+                yield tuple(self._term(i) for i in current), iter(graphs)
+
+    def triples(self, (s, p, o), context=None):
+        for triple, contexts in self._match((s, p, o), context):
+            yield triple, contexts
+
+    def triples_choices(self, (s, p, o), context=None):
+        """Matches patterns with lists of choices using IN clauses, in a single scan"""
+        for term in (s, p, o):
+            if isinstance(term, list) and not term:
+                return
+        for triple, contexts in self._match((s, p, o), context):
+            yield triple, contexts
+
+    def __len__(self, context=None):
+        if context is not None:
+            where = self._where((None, None, None), context)
+            if where is None:
+                return 0
+            where, params = where
+            return self._connection().execute('SELECT COUNT(*) FROM quads WHERE %s' % where, params).fetchone()[0]
+        else:
+            return self._connection().execute(
+                'SELECT COUNT(*) FROM (SELECT DISTINCT s, p, o FROM quads)').fetchone()[0]
+
+    def contexts(self, triple=None):
+        where = self._where(triple or (None, None, None), None)
+        if where is None:
+            return
+
+        where, params = where
+        for (c,) in self._connection().execute('SELECT DISTINCT c FROM quads WHERE %s' % where, params).fetchall():
+            yield self._term(c)
+
+    # Writes
+
+    def add(self, triple, context=None, quoted=False):
+        self.addN([triple + (context,)])
+
+    def addN(self, quads):
+        with self.transaction() as connection:
+            rows = []
+            for s, p, o, context in quads:
+                rows.append((self._intern(connection, context if context is not None else self.identifier),
+                             self._intern(connection, s),
+                             self._intern(connection, p),
+                             self._intern(connection, o)))
+            connection.executemany('INSERT OR IGNORE INTO quads (c, s, p, o) VALUES (?, ?, ?, ?)', rows)
+
+    def remove(self, triple, context=None):
+        with self.transaction() as connection:
+            where = self._where(triple, context)
+            if where is not None:
+                where, params = where
+                connection.execute('DELETE FROM quads WHERE %s' % where, params)
+
+    # Namespaces
+
+    def bind(self, prefix, namespace):
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM namespaces WHERE uri = ?', (unicode(namespace),))
+            connection.execute('INSERT OR REPLACE INTO namespaces (prefix, uri) VALUES (?, ?)',
+                               (unicode(prefix), unicode(namespace)))
+
+    def namespace(self, prefix):
+        row = self._connection().execute('SELECT uri FROM namespaces WHERE prefix = ?', (unicode(prefix),)).fetchone()
+        return URIRef(row[0]) if row else None
+
+    def prefix(self, namespace):
+        row = self._connection().execute('SELECT prefix FROM namespaces WHERE uri = ?', (unicode(namespace),)).fetchone()
+        return row[0] if row else None
+
+    def namespaces(self):
+        for prefix, uri in self._connection().execute('SELECT prefix, uri FROM namespaces').fetchall():
+            yield prefix, URIRef(uri)
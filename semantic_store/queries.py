@@ -0,0 +1,395 @@
+"""
+A registry of the named, parameterised SPARQL queries run by semantic_store.
+
+Each query is registered once, at import time, with the types of its parameters, and is parsed
+up front in two forms:
+
+- an rdflib prepared query (`prepareQuery`), evaluated with its bindings by rdflib for graphs
+  held in memory or in the SQLAlchemy and embedded stores, which cannot run SPARQL themselves
+- a tokenised template for stores with a SPARQL endpoint (4store), into which the bindings are
+  substituted as validated n3 terms, rather than interpolated into the query text
+
+rdflib applies bindings to the solutions of a prepared query, after its FILTERs have been
+evaluated, so queries whose bound variables appear in FILTERs are registered with
+`always_substitute`, and are substituted for every graph. So are queries with `integer`
+parameters, which are substituted as the bare numbers of LIMIT and OFFSET clauses.
+
+Calls are made with typed bindings, and every query keeps statistics of how often it was run
+and how long it took.
+"""
+from rdflib import URIRef, Literal, Variable
+from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.stores.sparqlstore import SPARQLStore
+
+from semantic_store.namespaces import ns
+
+import re
+import threading
+import time
+
+TOKENS = re.compile(r'''
+    (?P<iri><[^<>"{}|^`\\\s]*>)
+  | (?P<string>"""(?:[^"\\]|\\.|"(?!""))*"""|\'\'\'(?:[^'\\]|\\.|'(?!''))*\'\'\'|"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')
+  | (?P<comment>\#[^\n]*)
+  | (?P<variable>[?$](?P<name>[A-Za-z0-9_]+))
+  | (?P<brace>\{)
+''', re.VERBOSE)
+
+UNSAFE_URI_CHARACTERS = re.compile(r'[<>"{}|^`\\\s]')
+PREFIXED_NAME = re.compile(r'^([A-Za-z][\w.-]*)?:([\w.-]*)$')
+
+class QueryError(Exception):
+    pass
+
+class BindingError(QueryError, ValueError):
+    """Raised when a query is called with a missing, unknown or unsafe binding"""
+    pass
+
+def uri(value):
+    """
+    Coerces a binding to a URIRef. Prefixed names of the namespaces in semantic_store.namespaces
+    (e.g. 'dc:title') are expanded.
+    """
+    if not isinstance(value, URIRef):
+        match = PREFIXED_NAME.match(value)
+        if match and match.group(1) in ns:
+            value = ns[match.group(1)][match.group(2)]
+        value = URIRef(value)
+
+    if UNSAFE_URI_CHARACTERS.search(value):
+        raise BindingError('%r cannot be bound as a URI' % value)
+    return value
+
+def literal(value):
+    """Coerces a binding to a Literal (plain, unless it already is a Literal)"""
+    if isinstance(value, Literal):
+        return value
+    return Literal(value)
+
+def integer(value):
+    """Coerces a binding to a non-negative integer, e.g. of a LIMIT clause"""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise BindingError('%r cannot be bound as an integer' % (value,))
+    if value < 0:
+        raise BindingError('%r cannot be bound as an integer' % (value,))
+    return value
+
+def term(value):
+    """A binding which may be either a URIRef or a Literal"""
+    if isinstance(value, Literal):
+        return value
+    return uri(value)
+
+def render_term(value):
+    """Returns the n3 form of a term which is safe to substitute into query text"""
+    if isinstance(value, Literal):
+        # Literal.n3 escapes quotes, backslashes and newlines in the lexical form
+        if value.datatype is not None:
+            uri(value.datatype)
+        return value.n3()
+    elif isinstance(value, URIRef):
+        return uri(value).n3()
+    elif isinstance(value, (int, long)) and not isinstance(value, bool):
+        return unicode(integer(value))
+    else:
+        raise BindingError('Only URIRefs and Literals can be bound in queries, not %r' % (value,))
+
+def tokenise(text):
+    """
+    Splits query text into literal text and the variables outside of IRIs, strings and comments.
+    Returns a list of unicode segments and Variables, and the index of the first segment after
+    the opening brace of the WHERE clause (before it, variables are projected).
+    """
+    segments = []
+    body = None
+    position = 0
+
+    for match in TOKENS.finditer(text):
+        if match.group('variable'):
+            segments.append(text[position:match.start()])
+            segments.append(Variable(match.group('name')))
+            position = match.end()
+        elif match.group('brace') and body is None:
+            segments.append(text[position:match.end()])
+            position = match.end()
+            body = len(segments)
+
+    segments.append(text[position:])
+    return segments, body if body is not None else len(segments)
+
+def substitute(segments, body, bindings):
+    """
+    Renders tokenised query text with each bound variable replaced by its n3 term. A bound
+    variable which is projected is selected as an expression, so it is still returned.
+    """
+    rendered = dict((Variable(name), render_term(value)) for name, value in bindings.items())
+
+    parts = []
+    for i, segment in enumerate(segments):
+        if isinstance(segment, Variable) and segment in rendered:
+            if i < body:
+                parts.append(u'(%s AS ?%s)' % (rendered[segment], segment))
+            else:
+                parts.append(rendered[segment])
+        elif isinstance(segment, Variable):
+            parts.append(u'?%s' % segment)
+        else:
+            parts.append(segment)
+
+    return u''.join(parts)
+
+def substitute_bindings(query, bindings):
+    """Substitutes initBindings into the text of a query which is not registered"""
+    segments, body = tokenise(unicode(query))
+    return substitute(segments, body, bindings)
+
+def has_sparql_endpoint(graph):
+    return isinstance(getattr(graph, 'store', None), SPARQLStore)
+
+class NamedQuery(object):
+    """
+    A registered query. `parameters` maps the name of each variable which must be bound when
+    the query is called to the function coercing its value (uri, literal or term). With
+    `always_substitute`, the bindings are substituted into the text for every graph.
+    """
+
+    def __init__(self, name, text, parameters, always_substitute=False):
+        self.name = name
+        self.text = text
+        self.parameters = parameters
+        self.always_substitute = always_substitute
+
+        self.segments, self.body = tokenise(text)
+
+        integers = [name for name, coerce in parameters.items() if coerce is integer]
+        if integers and not always_substitute:
+            raise QueryError('Query %s has integer parameters, so must always be substituted' % name)
+
+        # Integer parameters are not valid SPARQL until they are substituted
+        self.prepared = prepareQuery(substitute(self.segments, self.body, dict((name, 0) for name in integers)), initNs=ns)
+
+        variables = set(s for s in self.segments if isinstance(s, Variable))
+        for parameter in parameters:
+            if Variable(parameter) not in variables:
+                raise QueryError('Query %s has no variable ?%s' % (name, parameter))
+
+        self._lock = threading.Lock()
+        self._stats = {
+            'calls': 0,
+            'errors': 0,
+            'rows': 0,
+            'time': 0.0,
+            'max_time': 0.0,
+        }
+
+    def bindings(self, values):
+        missing = set(self.parameters) - set(values)
+        unknown = set(values) - set(self.parameters)
+        if missing or unknown:
+            raise BindingError('Query %s takes bindings for %s, not %s' % (
+                self.name, ', '.join(sorted(self.parameters)), ', '.join(sorted(values))))
+
+        return dict((name, self.parameters[name](value)) for name, value in values.items())
+
+    def render(self, **values):
+        """The text of the query, with the given bindings substituted"""
+        return substitute(self.segments, self.body, self.bindings(values))
+
+    def __call__(self, graph, **values):
+        """
+        Runs the query against graph with the given bindings, returning a list of the result
+        rows (which are read before the query is timed as finished)
+        """
+        bindings = self.bindings(values)
+
+        started = time.time()
+        try:
+            if has_sparql_endpoint(graph):
+                result = graph.query(substitute(self.segments, self.body, bindings), initNs=ns)
+            elif self.always_substitute:
+                result = graph.query(substitute(self.segments, self.body, bindings), initNs=ns, use_store_provided=False)
+            else:
+                result = graph.query(self.prepared, initNs=ns, use_store_provided=False, initBindings=dict(
+                    (Variable(name), value) for name, value in bindings.items()))
+            rows = list(result)
+        except Exception:
+            self._count(time.time() - started, 0, error=True)
+            raise
+
+        self._count(time.time() - started, len(rows))
+        return rows
+
+    def _count(self, elapsed, rows, error=False):
+        with self._lock:
+            self._stats['calls'] += 1
+            self._stats['rows'] += rows
+            self._stats['time'] += elapsed
+            self._stats['max_time'] = max(self._stats['max_time'], elapsed)
+            if error:
+                self._stats['errors'] += 1
+
+    def statistics(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['mean_time'] = stats['time'] / stats['calls'] if stats['calls'] else 0.0
+        return stats
+
+    def reset_statistics(self):
+        with self._lock:
+            for key in self._stats:
+                self._stats[key] = 0.0 if isinstance(self._stats[key], float) else 0
+
+registry = {}
+
+def register(name, text, always_substitute=False, **parameters):
+    if name in registry:
+        raise QueryError('A query named %s is already registered' % name)
+    registry[name] = NamedQuery(name, text, parameters, always_substitute)
+    return registry[name]
+
+def run(name, graph, **bindings):
+    """Runs the registered query `name` against graph, returning a list of result rows"""
+    try:
+        query = registry[name]
+    except KeyError:
+        raise QueryError('No query named %s is registered' % name)
+    return query(graph, **bindings)
+
+def statistics():
+    """Returns the statistics of each registered query, by name"""
+    return dict((name, query.statistics()) for name, query in registry.items())
+
+# Canvases
+
+register('canvas_images', """
+    SELECT ?image_anno ?image WHERE {
+        ?image_anno a oa:Annotation .
+        ?image_anno oa:hasTarget ?canvas .
+        ?image_anno oa:hasBody ?image .
+        ?image a ?type .
+        FILTER(?type = dcmitype:Image || ?type = dms:Image || ?type = dms:ImageChoice) .
+    }""", canvas=uri)
+
+register('all_canvases_and_images', """
+    SELECT DISTINCT ?canvas ?image_anno ?image WHERE {
+        ?canvas a ?canvasType .
+        ?image a ?imageType .
+        FILTER(?canvasType = sc:Canvas || ?canvasType = dms:Canvas) .
+        FILTER(?imageType = dcmitype:Image || ?imageType = dms:Image || ?imageType = dms:ImageChoice) .
+        ?image_anno a oa:Annotation .
+        ?image_anno oa:hasTarget ?canvas .
+        ?image_anno oa:hasBody ?image .
+    }""")
+
+# Users
+
+register('user_emails', """
+    SELECT ?user ?email WHERE {
+        ?user perm:hasPermissionOver ?project .
+        ?user foaf:mbox ?email .
+        ?user rdf:type foaf:Agent
+    }""")
+
+# Collections (manifests harvested by semantic_store.collection)
+
+register('find_resource', """
+    SELECT DISTINCT ?resource_uri ?resource_url WHERE {
+        ?manifest_uri ore:aggregates ?resource_uri .
+        ?resource_url ore:describes ?resource_uri .
+        ?resource_uri ?predicate ?object .
+    }""", manifest_uri=uri, predicate=uri, object=term)
+
+register('described_resource_urls', """
+    SELECT DISTINCT ?resource_url WHERE {
+        ?manifest_uri ore:aggregates ?resource_uri .
+        ?resource_url ore:describes ?resource_uri
+    }""", manifest_uri=uri)
+
+register('described_by_resource_urls', """
+    SELECT DISTINCT ?resource_url WHERE {
+        ?manifest_uri ore:aggregates ?resource_uri .
+        ?resource_uri ore:isDescribedBy ?resource_url
+    }""", manifest_uri=uri)
+
+register('described_resource_uris_urls', """
+    SELECT DISTINCT ?resource_uri ?resource_url WHERE {
+        ?manifest_uri ore:aggregates ?resource_uri .
+        ?resource_url ore:describes ?resource_uri
+    }""", manifest_uri=uri)
+
+register('described_by_resource_uris_urls', """
+    SELECT DISTINCT ?resource_uri ?resource_url WHERE {
+        ?manifest_uri ore:aggregates ?resource_uri .
+        ?resource_uri ore:isDescribedBy ?resource_url
+    }""", manifest_uri=uri)
+
+register('aggregated_uris_urls', """
+    SELECT DISTINCT ?resource_uri ?resource_url WHERE {
+        ?uri ore:aggregates ?resource_uri .
+        OPTIONAL { ?resource_url ore:describes ?resource_uri } .
+        OPTIONAL { ?resource_uri ore:isDescribedBy ?resource_url }
+    }""", uri=uri)
+
+register('image_annotations', """
+    SELECT DISTINCT ?resource_uri ?resource_url WHERE {
+        ?manifest_uri ore:aggregates ?resource_uri .
+        ?resource_uri rdf:type dms:ImageAnnotationList .
+        OPTIONAL { ?resource_url ore:describes ?resource_uri } .
+        OPTIONAL { ?resource_uri ore:isDescribedBy ?resource_url }
+    }""", manifest_uri=uri)
+
+register('aggregated_seq_uris_urls', """
+    SELECT DISTINCT ?resource_uri ?resource_url WHERE {
+        ?uri ore:aggregates ?resource_uri .
+        {?resource_uri a dms:Sequence} UNION {?resource_uri a sc:Sequence} .
+        OPTIONAL { ?resource_url ore:describes ?resource_uri } .
+        OPTIONAL { ?resource_uri ore:isDescribedBy ?resource_url }
+    }""", uri=uri)
+
+register('page_attributes', """
+    SELECT DISTINCT ?res_title ?title ?width ?height ?image WHERE {
+        {?res_uri dc:title ?res_title} UNION {?res_uri rdfs:label ?res_title} .
+        {?page_uri dc:title ?title} UNION {?page_uri rdfs:label ?title} .
+        ?page_uri exif:width ?width .
+        ?page_uri exif:height ?height .
+        ?anno oa:hasTarget ?page_uri .
+        ?anno oa:hasBody ?image .
+        ?image rdf:type dcmitype:Image .
+    }""", res_uri=uri, page_uri=uri)
+
+register('first_sequence', """
+    SELECT DISTINCT ?first ?rest ?sequence_uri WHERE {
+        ?res_uri ore:aggregates ?sequence_uri .
+        ?sequence_uri rdf:first ?first .
+        {?first a dms:Canvas} UNION {?first a sc:Canavas} .
+        ?sequence_uri rdf:rest ?rest
+    }""", res_uri=uri)
+
+# Project contents
+
+register('aggregates_after', """
+    SELECT DISTINCT ?resource_uri WHERE {
+        ?project_uri ore:aggregates ?resource_uri .
+        FILTER(STR(?resource_uri) > ?after)
+    } ORDER BY STR(?resource_uri) LIMIT ?limit""", always_substitute=True, project_uri=uri, after=literal, limit=integer)
+
+register('aggregates_of_type_after', """
+    SELECT DISTINCT ?resource_uri WHERE {
+        ?project_uri ore:aggregates ?resource_uri .
+        ?resource_uri rdf:type ?type .
+        FILTER(STR(?resource_uri) > ?after)
+    } ORDER BY STR(?resource_uri) LIMIT ?limit""", always_substitute=True, project_uri=uri, type=uri, after=literal,
+    limit=integer)
+
+register('aggregate_type_counts', """
+    SELECT ?type (COUNT(DISTINCT ?resource_uri) AS ?count) WHERE {
+        ?project_uri ore:aggregates ?resource_uri .
+        ?resource_uri rdf:type ?type .
+    } GROUP BY ?type""", project_uri=uri)
+
+register('aggregate_count', """
+    SELECT (COUNT(DISTINCT ?resource_uri) AS ?count) WHERE {
+        ?project_uri ore:aggregates ?resource_uri .
+    }""", project_uri=uri)
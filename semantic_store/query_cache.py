@@ -0,0 +1,331 @@
+"""
+A cache of decoded query and triple pattern results, invalidated by graph revisions.
+
+`CachingStore` is mixed into the rdflib stores of semantic_store.rdfstore, and answers repeated
+SPARQL queries, triples() and triples_choices() patterns and graph lengths from memory. Each result is cached under a normalised key (query text with insignificant whitespace
+removed, sorted bindings and namespaces), in an LRU bounded by an estimate of its memory use.
+
+Every named graph has a revision token, which is replaced whenever a write batch touching that
+graph has been written to the store; a global token is replaced on every write. A cached result
+records the tokens of the graphs it was read from, and is only used while they are unchanged.
+The tokens are kept in Django's cache, so when several processes share a store, a CACHES backend
+shared between them (e.g. memcached) lets writes made in one process invalidate results cached
+in the others. With a cache backend private to each process (the local memory or dummy caches,
+Django's default), stores are not cached unless they are given a budget explicitly.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+from rdflib import Graph
+from rdflib.query import Result
+
+from collections import OrderedDict
+import hashlib
+import logging
+import re
+import threading
+import uuid
+
+# Graph dependency of results which may read any graph
+ANY_GRAPH = '*'
+
+REVISION_KEY_PREFIX = 'semantic_store.revision:'
+
+# Revision tokens outlive any cached result which could depend on them
+REVISION_TIMEOUT = 30 * 24 * 60 * 60
+
+logger = logging.getLogger(__name__)
+
+# Rough memory overhead of a term in a cached result, in bytes, on top of its text
+TERM_OVERHEAD = 64
+
+QUERY_TOKENS = re.compile(r'''
+    (?P<iri><[^<>"{}|^`\\\s]*>)
+  | (?P<string>"""(?:[^"\\]|\\.|"(?!""))*"""|\'\'\'(?:[^'\\]|\\.|'(?!''))*\'\'\'|"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')
+  | (?P<space>(?:\s|\#[^\n]*)+)
+''', re.VERBOSE)
+
+GRAPH_CLAUSE = re.compile(r'\bGRAPH\s+(<[^>]*>|\S+)', re.IGNORECASE)
+
+def normalise_query(query):
+    """
+    Returns the text of a SPARQL query with comments removed and each run of whitespace outside
+    of IRIs and string literals collapsed to a single space
+    """
+    def replace(match):
+        if match.group('space'):
+            return u' '
+        return match.group(0)
+
+    return QUERY_TOKENS.sub(replace, unicode(query)).strip()
+
+def query_graphs(query, query_graph):
+    """
+    Returns the identifiers of the graphs a query reads: the named graph it is run against, or the
+    graphs named in its GRAPH clauses, or ANY_GRAPH if they cannot be known from the query text
+    """
+    clauses = GRAPH_CLAUSE.findall(query)
+    if clauses:
+        if all(clause.startswith('<') for clause in clauses):
+            return set(clause[1:-1] for clause in clauses)
+        return set([ANY_GRAPH])
+    elif query_graph is not None and query_graph != '__UNION__':
+        return set([unicode(query_graph)])
+    else:
+        return set([ANY_GRAPH])
+
+def context_graphs(context):
+    if context is None:
+        return set([ANY_GRAPH])
+    return set([unicode(getattr(context, 'identifier', context))])
+
+def term_size(term):
+    if term is None:
+        return TERM_OVERHEAD
+    return len(term) + TERM_OVERHEAD
+
+def revision_key(graph):
+    return REVISION_KEY_PREFIX + hashlib.md5(graph.encode('utf-8')).hexdigest()
+
+class GraphRevisions(object):
+    """Revision tokens of named graphs, kept in Django's cache"""
+
+    def current(self, graphs):
+        """Returns a dictionary of the current token of each graph"""
+        keys = dict((revision_key(graph), graph) for graph in graphs)
+        tokens = cache.get_many(keys.keys())
+
+        for key, graph in keys.items():
+            if key not in tokens:
+                cache.add(key, uuid.uuid4().hex, REVISION_TIMEOUT)
+                tokens[key] = cache.get(key)
+
+        return dict((keys[key], token) for key, token in tokens.items())
+
+    def bump(self, graphs):
+        cache.set_many(dict((revision_key(graph), uuid.uuid4().hex) for graph in set(graphs) | set([ANY_GRAPH])),
+                       REVISION_TIMEOUT)
+
+class QueryCache(object):
+    """
+    An LRU of results, bounded by `budget`, an estimate of their size in bytes. A single result
+    larger than `budget / max_entry_fraction` is not cached.
+    """
+    max_entry_fraction = 16
+
+    def __init__(self, budget, revisions=None):
+        self.budget = budget
+        self.revisions = revisions or GraphRevisions()
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'stale': 0,
+            'stores': 0,
+            'evictions': 0,
+            'too_large': 0,
+        }
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def get(self, key):
+        """Returns a cached value, or None if there is no result for the key which is still current"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = self._entries.pop(key)
+
+        if entry is None:
+            self._count('misses')
+            return None
+
+        value, size, tokens = entry
+        if self.revisions.current(tokens.keys()) != tokens:
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+                    self.size -= size
+            self._count('stale')
+            self._count('misses')
+            return None
+
+        self._count('hits')
+        return value
+
+    def tokens(self, graphs):
+        """The current tokens of the graphs a result is about to be read from"""
+        return self.revisions.current(graphs)
+
+    def put(self, key, value, size, tokens):
+        if size > self.budget / self.max_entry_fraction:
+            self._count('too_large')
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+
+            self._entries[key] = (value, size, tokens)
+            self.size += size
+            self._stats['stores'] += 1
+
+            while self.size > self.budget and self._entries:
+                evicted_key, (evicted, evicted_size, evicted_tokens) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self._stats['evictions'] += 1
+
+    def invalidate(self, graphs):
+        self.revisions.bump(graphs)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def statistics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        stats['bytes'] = self.size
+        stats['budget'] = self.budget
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / lookups if lookups else 0.0
+        return stats
+
+def revisions_are_shared():
+    """Whether the revision tokens are kept where every process sees them"""
+    return not isinstance(cache, (LocMemCache, DummyCache))
+
+class CachingStore(object):
+    """
+    Mixin for the BatchingStores in semantic_store.rdfstore, answering repeated reads from a
+    QueryCache. Writes invalidate the cache once they have been written.
+    """
+
+    def __init__(self, *args, **kwargs):
+        budget = kwargs.pop('cache_budget', None)
+        if budget is None:
+            budget = getattr(settings, 'RDF_QUERY_CACHE_BYTES', 32 * 1024 * 1024)
+            if budget and not revisions_are_shared():
+                # Writes made by other processes would never invalidate the results cached here
+                logger.warning('The query cache is disabled, as the %s cache backend is private to each process; '
+                               'configure a shared CACHES backend (e.g. memcached) to enable it', type(cache).__name__)
+                budget = 0
+
+        super(CachingStore, self).__init__(*args, **kwargs)
+
+        self.query_cache = QueryCache(budget)
+        self.write_listeners.append(self._written)
+
+    def _written(self, batch):
+        self.query_cache.invalidate(unicode(identifier) for identifier in batch.graph_identifiers() if identifier is not None)
+
+    def cache_statistics(self):
+        return self.query_cache.statistics()
+
+    def query(self, query, initNs={}, initBindings={}, queryGraph=None, **kwargs):
+        if not self.query_cache.budget:
+            return super(CachingStore, self).query(query, initNs, initBindings, queryGraph, **kwargs)
+
+        # Pending writes must be written (invalidating the cache) before the cache is read
+        self.flush_batch()
+
+        key = ('query', normalise_query(query),
+               tuple(sorted((unicode(prefix), unicode(namespace)) for prefix, namespace in initNs.items())),
+               tuple(sorted((unicode(var), value.n3()) for var, value in initBindings.items())),
+               unicode(queryGraph) if queryGraph is not None else None)
+
+        cached = self.query_cache.get(key)
+        if cached is not None:
+            return self._result(cached)
+
+        tokens = self.query_cache.tokens(query_graphs(query, queryGraph))
+        result = super(CachingStore, self).query(query, initNs, initBindings, queryGraph, **kwargs)
+
+        value, size = self._result_value(result)
+        self.query_cache.put(key, value, size, tokens)
+        return self._result(value)
+
+    def _result_value(self, result):
+        """Returns a decoded copy of a query result, and its estimated size"""
+        if result.type == 'SELECT':
+            bindings = [dict(b) for b in result.bindings]
+            size = sum(term_size(var) + term_size(value) for b in bindings for var, value in b.items())
+            return ('SELECT', list(result.vars or []), bindings, None), size + TERM_OVERHEAD
+        elif result.type == 'ASK':
+            return ('ASK', None, None, result.askAnswer), TERM_OVERHEAD
+        else:
+            triples = list(result.graph)
+            size = sum(term_size(s) + term_size(p) + term_size(o) for s, p, o in triples)
+            return (result.type, None, triples, None), size + TERM_OVERHEAD
+
+    def _result(self, (type_, variables, rows, ask_answer)):
+        result = Result(type_)
+        if type_ == 'SELECT':
+            result.vars = list(variables)
+            result.bindings = list(rows)
+        elif type_ == 'ASK':
+            result.askAnswer = ask_answer
+        else:
+            result.graph = Graph()
+            result.graph += rows
+        return result
+
+    def _cached_triples(self, key, context, read):
+        self.flush_batch()
+
+        cached = self.query_cache.get(key)
+        if cached is None:
+            tokens = self.query_cache.tokens(context_graphs(context))
+            cached = [(triple, list(contexts) if contexts is not None else None) for triple, contexts in read()]
+            size = sum(term_size(s) + term_size(p) + term_size(o) + TERM_OVERHEAD * len(contexts or ())
+                       for (s, p, o), contexts in cached)
+            self.query_cache.put(key, cached, size, tokens)
+
+        for triple, contexts in cached:
+            yield triple, iter(contexts) if contexts is not None else None
+
+    def _pattern_key(self, kind, pattern, context):
+        def term_key(term):
+            if isinstance(term, list):
+                return tuple(sorted(t.n3() for t in term if t is not None))
+            return term.n3() if term is not None else None
+
+        context_key = unicode(getattr(context, 'identifier', context)) if context is not None else None
+        return (kind, tuple(term_key(term) for term in pattern), context_key)
+
+    def triples(self, pattern, context=None):
+        if not self.query_cache.budget or tuple(pattern) == (None, None, None):
+            # Whole graph reads are streamed rather than cached
+            return super(CachingStore, self).triples(pattern, context)
+
+        return self._cached_triples(self._pattern_key('triples', pattern, context), context,
+                                    lambda: super(CachingStore, self).triples(pattern, context))
+
+    def triples_choices(self, pattern, context=None):
+        if not self.query_cache.budget:
+            return super(CachingStore, self).triples_choices(pattern, context)
+
+        return self._cached_triples(self._pattern_key('choices', pattern, context), context,
+                                    lambda: super(CachingStore, self).triples_choices(pattern, context))
+
+    def __len__(self, context=None):
+        if not self.query_cache.budget:
+            return super(CachingStore, self).__len__(context)
+
+        self.flush_batch()
+
+        key = self._pattern_key('len', (None, None, None), context)
+        cached = self.query_cache.get(key)
+        if cached is None:
+            tokens = self.query_cache.tokens(context_graphs(context))
+            cached = super(CachingStore, self).__len__(context)
+            self.query_cache.put(key, cached, TERM_OVERHEAD, tokens)
+        return cached
@@ -1,56 +1,103 @@
 from rdflib import plugin, URIRef, Literal, Graph, BNode, Variable
 from rdflib.store import Store
 from rdflib.query import Result
-from rdflib.plugins.stores.sparqlstore import SPARQLUpdateStore, TraverseSPARQLResultDOM
+from rdflib.plugins.stores.sparqlstore import SPARQLUpdateStore
+from rdflib_sqlalchemy.SQLAlchemy import SQLAlchemy
+from sqlalchemy.sql import expression
 from django.conf import settings
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+import itertools
 import re
+import time
 import urllib
-import httplib, requests
-
-from semantic_store import utils
-
-import sys
-if getattr(sys, 'pypy_version_info', None) is not None \
-    or sys.platform.startswith('java') \
-        or sys.version_info[:2] < (2, 6):
-    # import elementtree as etree
-    from elementtree import ElementTree
-    assert ElementTree
-else:
-    try:
-        from xml.etree import ElementTree
-        assert ElementTree
-    except ImportError:
-        from elementtree import ElementTree
+import requests
 
-from SPARQLWrapper import SPARQLWrapper
+from semantic_store import utils, sparql_results, batching, query_cache, queries, instrumentation, graph_catalog, changelog, canvas_views
+from semantic_store.namespaces import NS
+from semantic_store.connection_pool import HTTPConnectionPool
+from semantic_store.quadstore import QuadStore
 
-class FourStore(SPARQLUpdateStore):
+class FourStore(batching.BatchingStore, SPARQLUpdateStore):
     """
     An RDFLib store based around the rdflib 4.0.0 implementation of a SPARQLUpdateStore
     to deal with issues with named graphs
-    """
-    def inject_sparql_bindings(self, query, initBindings):
-        binds = ['BIND (%s AS ?%s)' % (value.n3(), var) for var, value in initBindings.items()]
 
-        i2 = query.rindex("}")
-        query = query[:i2] + '\n'.join(binds) + '\n' + query[i2:]
+    Both the SPARQL and UPDATE endpoints are accessed through pools of keep-alive connections,
+    so the store may be shared between the threads of a WSGI worker.
+    """
+    query_headers = {
+        'Content-type': 'application/x-www-form-urlencoded',
+        'Connection': 'Keep-alive',
+    }
+
+    # 4store can answer SELECTs as SPARQL JSON, which decodes faster than XML. Both are decoded
+    # incrementally; the format actually used is taken from the response's Content-Type.
+    if getattr(settings, 'FOUR_STORE_RESULTS_FORMAT', 'xml') == 'json':
+        results_accept = '%s, %s;q=0.9' % (sparql_results.JSON_MIMETYPE, sparql_results.XML_MIMETYPE)
+    else:
+        results_accept = sparql_results.XML_MIMETYPE
+
+    # The GraphCatalog of the store (see semantic_store.graph_catalog), if it has one
+    catalog = None
+
+    # Number of independent reads gather() runs at once against the store
+    fan_out_concurrency = getattr(settings, 'RDF_STORE_FAN_OUT_CONCURRENCY', 8)
+
+    def __init__(self, queryEndpoint=None, update_endpoint=None, pool_options=None, **kwargs):
+        super(FourStore, self).__init__(queryEndpoint, update_endpoint, **kwargs)
+
+        if pool_options is None:
+            pool_options = getattr(settings, 'FOUR_STORE_POOL_OPTIONS', {})
+
+        self.query_pool = HTTPConnectionPool(self.endpoint, **pool_options)
+        self.update_pool = HTTPConnectionPool(self.update_endpoint, **pool_options)
+
+    def pool_statistics(self):
+        """Returns a dictionary of connection pool statistics for the SPARQL and UPDATE endpoints"""
+        return {
+            'SPARQL': self.query_pool.statistics(),
+            'UPDATE': self.update_pool.statistics(),
+        }
+
+    def _do_query(self, query, accept=sparql_results.XML_MIMETYPE):
+        """Posts a query to the SPARQL endpoint, returning a file-like pooled response"""
+        body = urllib.urlencode({'query': unicode(query).encode('utf-8')})
+        headers = dict(self.query_headers, Accept=accept)
+
+        started = time.time()
+        response = self.query_pool.request('POST', body, headers)
+        instrumentation.record_response(instrumentation.QUERY, query, len(body), response, started)
+        if response.status != 200:
+            content = response.read()
+            raise FourStoreException("Query failed: %d %s\nQuery: %s\n%s" % (response.status, response.reason, query, content))
+
+        return response
 
-        return query
+    def inject_sparql_bindings(self, query, initBindings):
+        """Substitutes the bound variables of a query with their (validated) n3 terms"""
+        return queries.substitute_bindings(query, initBindings)
+
+    def prefixed(self, query, initNs=None):
+        """
+        Returns the query text with PREFIX declarations for the store's namespace bindings and
+        initNs. The text is built locally, since the store is shared between threads and the
+        query state of SPARQLWrapper (setQuery, queryString) is not.
+        """
+        bindings = dict(self.nsBindings)
+        bindings.update(initNs or {})
+        prefixes = ['PREFIX %s: <%s>' % (prefix, namespace) for prefix, namespace in bindings.items()]
+        return '\n'.join(prefixes + [query])
 
     def query(self, query,
               initNs={},
               initBindings={},
               queryGraph=None,
               DEBUG=False):
-        self.debug = DEBUG
         assert isinstance(query, basestring), 'Query is not a string'
-        self.setNamespaceBindings(initNs)
         if initBindings:
             query = self.inject_sparql_bindings(query, initBindings)
 
-        self.resetQuery()
-
         if self.context_aware and queryGraph and queryGraph != '__UNION__':
             # we care about context
 
@@ -64,32 +111,71 @@ class FourStore(SPARQLUpdateStore):
                 query = query[:i1] + ' GRAPH %s { ' % queryGraph.n3() + \
                     query[i1:i2] + ' } ' + query[i2:]
 
-        self.setQuery(query)
+        query = self.prefixed(query, initNs)
+        self.flush_batch()
 
-        return Result.parse(SPARQLWrapper.query(self).response)
+        return Result.parse(self._do_query(query))
 
     def _run_query(self, query):
-        self.setQuery(query)
-        response = SPARQLWrapper.query(self).response
+        """
+        Runs a SELECT query, returning a generator of (bindings, variables) tuples which are decoded
+        one at a time as the response arrives, rather than after parsing the whole result document.
+        """
+        query = self.prefixed(query)
+        self.flush_batch()
+        response = self._do_query(query, accept=self.results_accept)
 
         try:
-            doc = ElementTree.parse(response)
+            for result in sparql_results.iter_results(response, response.getheader('Content-Type')):
+                yield result
         except Exception as e:
-            if settings.DEBUG:
-                readable_response = requests.post(settings.FOUR_STORE_URIS['SPARQL'], data={'query': query})
-
-                response_text = utils.line_numbered_string(readable_response.text)
-
-                raise FourStoreException("Parsing Exception \"%s\"\nQuery: %s\nResponse:\n%s" % (e, query, response_text))
-            else:
-                raise FourStoreException("Parsing Exception \"%s\"\nQuery: %s" % (e, query))
+            response.close()
+            self._raise_parsing_exception(e, query)
+        finally:
+            response.close()
+
+    construct_accept = 'text/plain, application/rdf+xml;q=0.9'
+
+    CONSTRUCT_FORMATS = {
+        'text/plain': 'nt',
+        'text/turtle': 'turtle',
+        'application/x-turtle': 'turtle',
+        'application/rdf+xml': 'xml',
+    }
+
+    def construct(self, query, graph=None):
+        """
+        Runs a CONSTRUCT query on the server, returning the resulting triples parsed into an
+        in-memory graph (or added to the given graph)
+        """
+        if graph is None:
+            graph = Graph()
+
+        query = self.prefixed(query)
+        self.flush_batch()
+        response = self._do_query(query, accept=self.construct_accept)
+
+        content_type = (response.getheader('Content-Type') or '').split(';')[0].strip().lower()
+        format = self.CONSTRUCT_FORMATS.get(content_type, 'xml')
 
         try:
-            dom = TraverseSPARQLResultDOM(doc, asDictionary=True)
+            graph.parse(source=response, format=format)
         except Exception as e:
-            raise FourStoreException("SPARQL DOM Traversal Exception \"%s\"" % e)
+            self._raise_parsing_exception(e, query)
+        finally:
+            response.close()
 
-        return TraverseSPARQLResultDOM(doc, asDictionary=True)
+        return graph
+
+    def _raise_parsing_exception(self, e, query):
+        if settings.DEBUG:
+            readable_response = requests.post(settings.FOUR_STORE_URIS['SPARQL'], data={'query': query})
+
+            response_text = utils.line_numbered_string(readable_response.text)
+
+            raise FourStoreException("Parsing Exception \"%s\"\nQuery: %s\nResponse:\n%s" % (e, query, response_text))
+        else:
+            raise FourStoreException("Parsing Exception \"%s\"\nQuery: %s" % (e, query))
 
     def triples(self, (s, p, o), context=None):
         if ( isinstance(s, BNode) or
@@ -127,69 +213,108 @@ class FourStore(SPARQLUpdateStore):
                    rt.get(p, p),
                    rt.get(o, o)), None
 
-    def triples_choices(self, (s, p, o), context=None):
-        if ( isinstance(s, BNode) or
-             isinstance(p, BNode) or 
-             isinstance(o, BNode) ): 
-            raise Exception("SPARQLStore does not support Bnodes! See http://www.w3.org/TR/sparql11-query/#BGPsparqlBNodes")
-
-        vars = []
-        filter_bodies = []
-        if not s:
-            s = Variable('s')
-            vars.append(s)
-        elif isinstance(s, list):
-            filter_bodies.append(' || '.join('?s = %s' % s_choice.n3() for s_choice in s))
-            s = Variable('s')
-            vars.append(s)
-
-        if not p:
-            p = Variable('p')
-            vars.append(p)
-        elif isinstance(p, list):
-            filter_bodies.append(' || '.join('?p = %s' % p_choice.n3() for p_choice in p))
-            p = Variable('p')
-            vars.append(p)
-
-        if not o:
-            o = Variable('o')
-            vars.append(o)
-        elif isinstance(o, list):
-            filter_bodies.append(' || '.join('?o = %s' % o_choice.n3() for o_choice in o))
-            o = Variable('o')
-            vars.append(o)
-
-        if vars:
-            v = ' '.join([term.n3() for term in vars])
-        else:
-            v = '*'
+    # Choice lists longer than this are split across several queries, which are run concurrently
+    choices_chunk_size = getattr(settings, 'FOUR_STORE_CHOICES_CHUNK_SIZE', 100)
+    choices_concurrency = getattr(settings, 'FOUR_STORE_CHOICES_CONCURRENCY', 4)
+
+    def _choices_query(self, pattern, context):
+        """Builds a SELECT for a triple pattern whose terms are None, a single term or a list of terms"""
+        values = []
+        terms = []
+
+        for term, name in zip(pattern, ('s', 'p', 'o')):
+            if isinstance(term, list):
+                values.append('VALUES ?%s { %s }' % (name, ' '.join(choice.n3() for choice in term)))
+                term = Variable(name)
+            elif not term:
+                term = Variable(name)
+            terms.append(term)
+
+        # (A Graph is falsy when empty, and testing it would run a COUNT query)
+        query = "SELECT ?s ?p ?o WHERE { GRAPH %s { %s %s %s %s . } }" % (
+            context.identifier.n3() if context is not None else Variable('context').n3(),
+            ' '.join(values), terms[0].n3(), terms[1].n3(), terms[2].n3())
+
+        return query, terms
+
+    def _choices_chunks(self, pattern):
+        """Splits each choice list of a pattern into chunks, yielding every combination of chunks"""
+        size = self.choices_chunk_size
+        positions = []
+        for term in pattern:
+            if isinstance(term, list):
+                positions.append([term[i:i + size] for i in range(0, len(term), size)])
+            else:
+                positions.append([term])
+        return itertools.product(*positions)
 
-        query = "SELECT ?s ?p ?o WHERE { GRAPH %s { %s %s %s . %s} }" % \
-            (context.identifier.n3() if context else Variable('context').n3(),
-             s.n3(), p.n3(), o.n3(),
-             ''.join('FILTER(%s) .' % f for f in filter_bodies))
+    def _run_choices_query(self, (pattern, context)):
+        query, (s, p, o) = self._choices_query(pattern, context)
+        return [(rt.get(s, s), rt.get(p, p), rt.get(o, o)) for rt, vars in self._run_query(query)]
 
-        for rt, vars in self._run_query(query):
-            yield (rt.get(s, s),
-                   rt.get(p, p),
-                   rt.get(o, o)), None
+    def triples_choices(self, (s, p, o), context=None):
+        """
+        Matches a triple pattern in which any of the terms may be a list of choices. The choices
+        are given to the server as VALUES blocks; very long lists are split into chunks of
+        `choices_chunk_size`, whose queries are run concurrently and their results merged.
+        """
+        pattern = []
+        for term in (s, p, o):
+            if isinstance(term, list):
+                term = utils.unique(term)
+                if not term:
+                    return
+                if any(isinstance(choice, BNode) for choice in term):
+                    raise Exception("SPARQLStore does not support Bnodes! See http://www.w3.org/TR/sparql11-query/#BGPsparqlBNodes")
+            elif isinstance(term, BNode):
+                raise Exception("SPARQLStore does not support Bnodes! See http://www.w3.org/TR/sparql11-query/#BGPsparqlBNodes")
+            pattern.append(term)
+
+        # Worker threads have batches of their own, so pending writes must be flushed here
+        self.flush_batch()
+
+        chunks = [(chunk, context) for chunk in self._choices_chunks(pattern)]
+
+        for triples in concurrent_map(self._run_choices_query, chunks, self.choices_concurrency):
+            for triple in triples:
+                yield triple, None
 
     def __len__(self, context=None):
         if not self.sparql11:
             raise NotImplementedError(
                 "For performance reasons, this is not" +
                 "supported for sparql1.0 endpoints")
+        elif self.catalog is not None and context is not None:
+            # The catalog is told of pending writes once they are flushed
+            self.flush_batch()
+            return self.catalog.triples(context.identifier)
+        elif self.context_aware and context is not None:
+            return self.count_triples(context.identifier)
         else:
-            if self.context_aware and context is not None:
-                q = "SELECT (count(*) as ?c) WHERE { GRAPH %s {?s ?p ?o .}}" % (
-                    context.identifier.n3())
-            else:
-                q = "SELECT (count(*) as ?c) WHERE { GRAPH ?anygraph {?s ?p ?o .}}"
-            
+            q = "SELECT (count(*) as ?c) WHERE { GRAPH ?anygraph {?s ?p ?o .}}"
             rt, vars = iter(self._run_query(q)).next()
             return int(rt.get(Variable("c")))
 
+    def count_triples(self, identifier):
+        """Returns the number of triples in a named graph"""
+        query = "SELECT (count(*) as ?c) WHERE { GRAPH %s {?s ?p ?o .}}" % (
+            queries.render_term(URIRef(identifier)))
+        rt, vars = iter(self._run_query(query)).next()
+        return int(rt.get(Variable("c")))
+
+    def predicate_counts(self, identifier):
+        """Returns the number of triples of each predicate in a named graph"""
+        query = "SELECT ?p (count(*) as ?c) WHERE { GRAPH %s { ?s ?p ?o . } } GROUP BY ?p" % (
+            queries.render_term(URIRef(identifier)))
+        return dict((unicode(rt.get(Variable("p"))), int(rt.get(Variable("c")))) for rt, vars in self._run_query(query))
+
     def contexts(self, triple=None):
+        if not triple and self.catalog is not None and self.catalog.is_complete():
+            return iter(self.catalog.graphs())
+        return self.scan_contexts(triple)
+
+    def scan_contexts(self, triple=None):
+        """Lists the named graphs containing a triple pattern, by searching every graph in the store"""
         if triple:
             s, p, o = triple
         else:
@@ -203,30 +328,21 @@ class FourStore(SPARQLUpdateStore):
 
         return (rt.get(Variable("name")) for rt, vars in self._run_query(query))
 
-    def reset_connection(self):
-        self.connection = httplib.HTTPConnection(self.host, self.port)
-
     def _do_update(self, update):
-        update = urllib.urlencode({'update': unicode(update).encode('utf-8')})
+        body = urllib.urlencode({'update': unicode(update).encode('utf-8')})
 
-        # Trying to deal with inexplicable CannotSendRequest errors
-        try:
-            self.connection.request('POST', self.path, update, self.headers)
-            return self.connection.getresponse()
-        except httplib.ImproperConnectionState as e:
-            self.reset_connection()
-            self.connection.request('POST', self.path, update, self.headers)
-            return self.connection.getresponse()
+        started = time.time()
+        response = self.update_pool.request('POST', body, self.headers)
+        instrumentation.record_response(instrumentation.UPDATE, update, len(body), response, started)
+        return response
 
     def update(self, query,
                initNs={},
                initBindings={},
                queryGraph=None,
                DEBUG=False):
-        self.debug = DEBUG
         assert isinstance(query, basestring)
-        self.setNamespaceBindings(initNs)
-        query = self.injectPrefixes(query)
+        query = self.prefixed(query, initNs)
 
         if initBindings:
             query = self.inject_sparql_bindings(query, initBindings)
@@ -237,49 +353,372 @@ class FourStore(SPARQLUpdateStore):
         if r.status not in (200, 204):
             raise Exception("Could not update: %d %s\n%s" % (r.status, r.reason, content))
 
-    def addN(self, quads):
-        """ Add a list of quads to the store. """
-        if not self.connection:
-            raise Exception("UpdateEndpoint is not set - call 'open'")
-
-        data = list()
-        for subject, predicate, obj, context in quads:
-            if ( isinstance(subject, BNode) or
-                 isinstance(predicate, BNode) or
-                 isinstance(obj, BNode) ):
-                raise Exception("SPARQLStore does not support Bnodes! "
-                                "See http://www.w3.org/TR/sparql11-query/#BGPsparqlBNodes")
-
-            triple = "%s %s %s ." % (subject.n3(), predicate.n3(), obj.n3())
-            data.append("INSERT DATA { GRAPH <%s> { %s } };\n" % (context.identifier, triple))
-        r = self._do_update(''.join(data))
+    def _check_bnodes(self, triple):
+        if any(isinstance(term, BNode) for term in triple):
+            raise Exception("SPARQLStore does not support Bnodes! "
+                            "See http://www.w3.org/TR/sparql11-query/#BGPsparqlBNodes")
+
+    def _write_batch(self, batch):
+        """Writes all the operations in a batch as one SPARQL update request"""
+        operations = []
+
+        for kind, context, triples in batch.operations():
+            for triple in triples:
+                self._check_bnodes(triple)
+
+            if kind == batching.ADD:
+                data = '\n'.join('%s %s %s .' % (s.n3(), p.n3(), o.n3()) for s, p, o in triples)
+
+                if self.context_aware and context is not None:
+                    operations.append('INSERT DATA { GRAPH %s {\n%s\n} }' % (context.identifier.n3(), data))
+                else:
+                    operations.append('INSERT DATA {\n%s\n}' % data)
+            else:
+                if self.context_aware and any(batching.is_drop(t, context) for t in triples):
+                    # Dropping the graph removes every other triple of the run with it
+                    operations.append('DROP SILENT GRAPH %s' % context.identifier.n3())
+                    continue
+
+                ground = [t for t in triples if None not in t]
+                patterns = [t for t in triples if None in t]
+
+                if ground:
+                    data = '\n'.join('%s %s %s .' % (s.n3(), p.n3(), o.n3()) for s, p, o in ground)
+
+                    if self.context_aware and context is not None:
+                        operations.append('DELETE DATA { GRAPH %s {\n%s\n} }' % (context.identifier.n3(), data))
+                    else:
+                        operations.append('DELETE DATA {\n%s\n}' % data)
+
+                for s, p, o in patterns:
+                    triple = '%s %s %s .' % tuple((term if term is not None else Variable(name)).n3()
+                                             for term, name in ((s, 'S'), (p, 'P'), (o, 'O')))
+
+                    if self.context_aware and context is not None:
+                        operations.append('DELETE { GRAPH %s { %s } } WHERE { GRAPH %s { %s } }' % (
+                            context.identifier.n3(), triple, context.identifier.n3(), triple))
+                    else:
+                        operations.append('DELETE { %s } WHERE { %s }' % (triple, triple))
+
+        r = self._do_update(' ;\n'.join(operations))
+        content = r.read()
         if r.status not in (200, 204):
             raise Exception("Could not update: %d %s\n%s" % (
-                r.status, r.reason, r.read()))
+                r.status, r.reason, content))
 
 class FourStoreException(Exception):
     pass
 
+class SharedConnectionEngine(object):
+    """
+    Stands in for a SQLAlchemy engine, handing out one already open connection (which is left open
+    when released), so that every statement made through it runs in the same transaction
+    """
+    def __init__(self, engine, connection):
+        self.engine = engine
+        self.connection = connection
+
+    @contextmanager
+    def connect(self):
+        yield self.connection
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+class SQLAlchemyStore(batching.BatchingStore, SQLAlchemy):
+    """
+    The rdflib SQLAlchemy store, with write batches applied as a single bulk transaction
+    """
+    def _get_engine(self):
+        return getattr(self._batch_local, 'engine', None) or self._engine
+
+    def _set_engine(self, engine):
+        self._engine = engine
+        if engine is not None:
+            instrumentation.instrument_engine(engine)
+
+    engine = property(_get_engine, _set_engine)
+
+    # Choice lists longer than this are matched with several IN clauses, staying within the
+    # bound parameter limits of the database (999 for sqlite)
+    choices_chunk_size = 500
+
+    def _choices_clause(self, column, terms):
+        size = self.choices_chunk_size
+        clauses = [column.in_(terms[i:i + size]) for i in range(0, len(terms), size)]
+        return clauses[0] if len(clauses) == 1 else expression.or_(*clauses)
+
+    def _term_clause(self, build, column, term, table):
+        if isinstance(term, list):
+            return self._choices_clause(column, [t for t in term if t])
+        return build(self, term, table)
+
+    def buildSubjClause(self, subject, table):
+        return self._term_clause(SQLAlchemy.buildSubjClause, table.c.subject, subject, table)
+
+    def buildPredClause(self, predicate, table):
+        return self._term_clause(SQLAlchemy.buildPredClause, table.c.predicate, predicate, table)
+
+    def buildObjClause(self, obj, table):
+        return self._term_clause(SQLAlchemy.buildObjClause, table.c.object, obj, table)
+
+    def buildTypeMemberClause(self, subject, table):
+        return self._term_clause(SQLAlchemy.buildTypeMemberClause, table.c.member, subject, table)
+
+    def buildTypeClassClause(self, obj, table):
+        return self._term_clause(SQLAlchemy.buildTypeClassClause, table.c.klass, obj, table)
+
+    def triples_choices(self, (s, p, o), context=None):
+        """
+        Matches a triple pattern in which any of the terms may be a list of choices, with one
+        SELECT using IN clauses, rather than one SELECT per choice
+        """
+        pattern = []
+        for term in (s, p, o):
+            if isinstance(term, list):
+                term = utils.unique(t for t in term if t)
+                if not term:
+                    return
+                if len(term) == 1:
+                    term = term[0]
+            pattern.append(term)
+        s, p, o = pattern
+
+        self.flush_batch()
+
+        # rdf:type statements are kept in a table of their own, which the rdflib store only reads
+        # when the predicate is exactly rdf:type
+        if isinstance(p, list) and NS.rdf.type in p:
+            others = [choice for choice in p if choice != NS.rdf.type]
+            patterns = [(s, NS.rdf.type, o), (s, others[0] if len(others) == 1 else others, o)]
+        else:
+            patterns = [(s, p, o)]
+
+        for pattern in patterns:
+            for triple, contexts in SQLAlchemy.triples(self, pattern, context):
+                yield triple, contexts
+
+    def __len__(self, context=None):
+        """
+        Counts the statements of each table separately; the rdflib store combines the counts of
+        a context with UNION (rather than UNION ALL), so equal counts were only counted once
+        """
+        self.flush_batch()
+
+        tables = ['type_statements', 'asserted_statements', 'literal_statements']
+        if context is not None:
+            tables.append('quoted_statements')
+
+        with self.engine.connect() as connection:
+            return sum(connection.execute(self.tables[name].count(self.buildContextClause(context, self.tables[name]))).scalar()
+                       for name in tables)
+
+    def _write_batch(self, batch):
+        with self._engine.connect() as connection:
+            transaction = connection.begin()
+            self._batch_local.engine = SharedConnectionEngine(self._engine, connection)
+
+            try:
+                for kind, context, triples in batch.operations():
+                    if kind == batching.ADD:
+                        SQLAlchemy.addN(self, ((s, p, o, context) for s, p, o in triples))
+                    elif any(batching.is_drop(t, context) for t in triples):
+                        self._drop_context(connection, context)
+                    else:
+                        for triple in triples:
+                            SQLAlchemy.remove(self, triple, context)
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+            finally:
+                self._batch_local.engine = None
+
+    def _drop_context(self, connection, context):
+        """Deletes the statements of a graph from each table by their context column"""
+        for name in ('type_statements', 'asserted_statements', 'literal_statements', 'quoted_statements'):
+            table = self.tables[name]
+            connection.execute(table.delete(self.buildContextClause(context, table)))
+
+
+class EmbeddedStore(batching.BatchingStore, QuadStore):
+    """
+    The embedded on-disk quad store, with write batches applied as a single transaction
+    """
+    # Each thread reads through a connection of its own
+    fan_out_concurrency = getattr(settings, 'RDF_STORE_FAN_OUT_CONCURRENCY', 8)
+
+    def _write_batch(self, batch):
+        with self.transaction():
+            for kind, context, triples in batch.operations():
+                if kind == batching.ADD:
+                    QuadStore.addN(self, ((s, p, o, context) for s, p, o in triples))
+                else:
+                    for triple in triples:
+                        QuadStore.remove(self, triple, context)
+
+
+# The stores used by DM, which answer repeated reads from memory until a write changes the graphs
+# they read (see semantic_store.query_cache)
+
+class CachingFourStore(query_cache.CachingStore, FourStore):
+    pass
+
+class CachingSQLAlchemyStore(query_cache.CachingStore, SQLAlchemyStore):
+    pass
+
+class CachingEmbeddedStore(query_cache.CachingStore, EmbeddedStore):
+    pass
+
 
 plugin.register('SQLAlchemy', Store, 'rdflib_sqlalchemy.SQLAlchemy', 'SQLAlchemy')
 
 default_identifier = URIRef(settings.RDFLIB_STORE_GRAPH_URI)
 
-if not (hasattr(settings, 'FOUR_STORE_URIS') and 'SPARQL' in settings.FOUR_STORE_URIS and 'UPDATE' in settings.FOUR_STORE_URIS):
-    store = plugin.get('SQLAlchemy', Store)(identifier=default_identifier)
-    store.open(Literal(settings.RDFLIB_DB_URI))
-else:
-    store = FourStore(settings.FOUR_STORE_URIS['SPARQL'], settings.FOUR_STORE_URIS['UPDATE'])
+def configured_backend():
+    """
+    Returns the name of the store backend chosen in settings: 'fourstore', 'embedded' or
+    'sqlalchemy'. Without an explicit RDF_STORE_BACKEND setting, 4store is used when its
+    endpoints are configured, and SQLAlchemy otherwise.
+    """
+    backend = getattr(settings, 'RDF_STORE_BACKEND', None)
+    if backend is not None:
+        return backend
 
-    sqlalchemy_store = plugin.get('SQLAlchemy', Store)(identifier=default_identifier)
-    sqlalchemy_store.open(URIRef(settings.RDFLIB_DB_URI))
+    if hasattr(settings, 'FOUR_STORE_URIS') and 'SPARQL' in settings.FOUR_STORE_URIS and 'UPDATE' in settings.FOUR_STORE_URIS:
+        return 'fourstore'
+    else:
+        return 'sqlalchemy'
+
+def open_store(backend, caching=False):
+    """
+    Returns a store for one of the backends configured in settings ('fourstore', 'embedded' or
+    'sqlalchemy'), opened on its configured database. With `caching`, the store answers
+    repeated reads from memory (see semantic_store.query_cache). The store has no graph catalog,
+    so whatever writes through it bumps the revisions of the graphs it wrote (GraphCatalog.bump).
+    """
+    if backend == 'fourstore':
+        store_class = CachingFourStore if caching else FourStore
+        return store_class(settings.FOUR_STORE_URIS['SPARQL'], settings.FOUR_STORE_URIS['UPDATE'])
+    elif backend == 'embedded':
+        store = (CachingEmbeddedStore if caching else EmbeddedStore)(identifier=default_identifier)
+        store.open(settings.EMBEDDED_QUAD_STORE_PATH)
+        return store
+    elif backend == 'sqlalchemy':
+        store = (CachingSQLAlchemyStore if caching else SQLAlchemyStore)(identifier=default_identifier)
+        store.open(Literal(settings.RDFLIB_DB_URI))
+        return store
+    else:
+        raise ValueError('Unknown RDF_STORE_BACKEND "%s"' % backend)
+
+backend = configured_backend()
+
+store = open_store(backend, caching=True)
+store.catalog = graph_catalog.GraphCatalog(store)
+store.changelog = changelog.ProjectChangelog(store)
+store.canvas_views = canvas_views.CanvasViews(store)
+
+if backend == 'fourstore':
+    sqlalchemy_store = open_store('sqlalchemy')
 
 def rdfstore():
     return store
 
-def copy_to_store(old_store, new_store):
-    for context in old_store.contexts():
-        old_graph = Graph(old_store, context)
-        new_graph = Graph(new_store, context)
-        for t in old_graph:
-            new_graph.add(t)
+def concurrent_map(function, items, concurrency):
+    """
+    Returns [function(item) for item in items], calling function from up to `concurrency`
+    threads at once
+    """
+    items = list(items)
+    if len(items) <= 1 or concurrency <= 1:
+        return map(function, items)
+
+    pool = ThreadPool(min(len(items), concurrency))
+    try:
+        # The workers' round trips are counted as part of the calling thread's request
+        return pool.map(instrumentation.propagate(function), items)
+    finally:
+        pool.close()
+
+def gather(graph, reads, concurrency=None):
+    """
+    Runs independent reads of a store-backed graph concurrently, returning their results in
+    order. Each read is a function of no arguments, which should return its results fully read
+    (e.g. a list rather than a generator), so the reading happens in the worker thread.
+
+    Up to `concurrency` reads run at once (by default, the `fan_out_concurrency` of the graph's
+    store); reads of stores which cannot be read from several threads, and of in-memory graphs,
+    are run one after another.
+    """
+    store = getattr(graph, 'store', None)
+    if concurrency is None:
+        concurrency = getattr(store, 'fan_out_concurrency', 1)
+
+    # Worker threads have batches of their own, so pending writes must be flushed here
+    if hasattr(store, 'flush_batch'):
+        store.flush_batch()
+
+    return concurrent_map(lambda read: read(), reads, concurrency)
+
+def gather_triples(graph, patterns, concurrency=None):
+    """
+    Returns a list of the triples matching each of the given patterns, read concurrently.
+    Patterns containing a list of terms are matched with triples_choices.
+    """
+    def matcher(pattern):
+        if any(isinstance(term, list) for term in pattern):
+            return lambda: list(graph.triples_choices(pattern))
+        return lambda: list(graph.triples(pattern))
+
+    return gather(graph, [matcher(pattern) for pattern in patterns], concurrency)
+
+# Number of triples read from a graph and written to the new store at a time by copy_to_store
+COPY_CHUNK_SIZE = 5000
+
+def store_contexts(store):
+    """Returns the identifiers of the named graphs in a store"""
+    return utils.unique(getattr(context, 'identifier', context) for context in store.contexts())
+
+def copy_context(old_store, new_store, identifier, chunk_size=COPY_CHUNK_SIZE):
+    """
+    Streams the triples of one named graph from old_store to new_store, writing them in chunks of
+    `chunk_size`, each as a single bulk write. Returns the number of triples copied.
+
+    Adding a triple which is already in a graph has no effect, so a graph which was partly
+    copied can be copied again.
+    """
+    old_graph = Graph(old_store, identifier)
+    new_graph = Graph(new_store, identifier)
+
+    copied = 0
+    triples = old_graph.triples((None, None, None))
+    while True:
+        chunk = [(s, p, o, new_graph) for s, p, o in itertools.islice(triples, chunk_size)]
+        if not chunk:
+            break
+
+        if hasattr(new_store, 'batch'):
+            with new_store.batch():
+                new_graph.addN(chunk)
+        else:
+            new_graph.addN(chunk)
+        copied += len(chunk)
+
+    return copied
+
+def copy_to_store(old_store, new_store, contexts=None, chunk_size=COPY_CHUNK_SIZE, concurrency=1, copied=None):
+    """
+    Copies the named graphs of old_store (or the given graph identifiers) to new_store, up to
+    `concurrency` graphs at a time. `copied` is called with the identifier of each graph, and the
+    number of triples copied, once it has been copied.
+    """
+    if contexts is None:
+        contexts = store_contexts(old_store)
+
+    def copy(identifier):
+        count = copy_context(old_store, new_store, identifier, chunk_size)
+        if copied is not None:
+            copied(identifier, count)
+        return count
+
+    return sum(concurrent_map(copy, contexts, concurrency))
@@ -0,0 +1,141 @@
+"""
+Incremental decoders for SPARQL SELECT results.
+
+Both decoders read their source a chunk at a time and yield (bindings, variables) tuples as soon
+as each result has been read, in the same form as rdflib's TraverseSPARQLResultDOM with
+asDictionary=True. Decoded results are discarded as they are yielded, so memory use does not
+grow with the size of the result set.
+"""
+from rdflib import URIRef, Literal, BNode, Variable
+from rdflib.plugins.stores.sparqlstore import CastToTerm
+
+from xml.etree import ElementTree
+import codecs
+import json
+
+XML_MIMETYPE = 'application/sparql-results+xml'
+JSON_MIMETYPE = 'application/sparql-results+json'
+
+SPARQL_RESULTS_NS = 'http://www.w3.org/2005/sparql-results#'
+VARIABLE_TAG = '{%s}variable' % SPARQL_RESULTS_NS
+RESULTS_TAG = '{%s}results' % SPARQL_RESULTS_NS
+RESULT_TAG = '{%s}result' % SPARQL_RESULTS_NS
+BINDING_TAG = '{%s}binding' % SPARQL_RESULTS_NS
+
+CHUNK_SIZE = 16 * 1024
+
+class SPARQLResultsParseError(Exception):
+    pass
+
+def iter_xml_results(source):
+    """Decodes a SPARQL XML results document from a file-like object, one result at a time"""
+    variables = []
+    results_element = None
+
+    for event, element in ElementTree.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if element.tag == RESULTS_TAG:
+                results_element = element
+        elif element.tag == RESULT_TAG:
+            bindings = {}
+            for binding in element.findall(BINDING_TAG):
+                bindings[Variable(binding.attrib['name'])] = CastToTerm(binding[0])
+
+            yield bindings, variables
+
+            # Drop the decoded result so the tree never holds more than one at a time
+            results_element.clear()
+        elif element.tag == VARIABLE_TAG:
+            variables.append(Variable(element.attrib['name']))
+
+def json_term(value):
+    term_type = value['type']
+
+    if term_type == 'uri':
+        return URIRef(value['value'])
+    elif term_type == 'bnode':
+        return BNode(value['value'])
+    elif term_type in ('literal', 'typed-literal'):
+        if 'datatype' in value:
+            return Literal(value['value'], datatype=URIRef(value['datatype']))
+        elif 'xml:lang' in value:
+            return Literal(value['value'], lang=value['xml:lang'])
+        else:
+            return Literal(value['value'])
+    else:
+        raise SPARQLResultsParseError('Unknown term type "%s"' % term_type)
+
+def iter_json_results(source, chunk_size=CHUNK_SIZE):
+    """
+    Decodes a SPARQL JSON results document from a file-like object, one result at a time.
+
+    The "head" object is decoded whole, and the objects in the "results.bindings" array are then
+    decoded individually as soon as enough of the document has been read to contain them.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buf = u''
+
+    def fill():
+        chunk = source.read(chunk_size)
+        if not chunk:
+            return False
+        return text_decoder.decode(chunk) if isinstance(chunk, str) else chunk
+
+    def skip_whitespace(buf, index):
+        while index < len(buf) and buf[index] in u' \t\r\n,':
+            index += 1
+        return index
+
+    variables = []
+
+    # Read the head of the document (everything up to the start of the bindings array)
+    while True:
+        head_end = buf.find(u'"bindings"')
+        if head_end != -1:
+            array_start = buf.find(u'[', head_end)
+            if array_start != -1:
+                break
+
+        chunk = fill()
+        if chunk is False:
+            raise SPARQLResultsParseError('No "bindings" array found in SPARQL JSON results')
+        buf += chunk
+
+    head_start = buf.find(u'"head"')
+    if head_start != -1 and head_start < head_end:
+        try:
+            head, end = decoder.raw_decode(buf, skip_whitespace(buf, buf.index(u':', head_start) + 1))
+        except ValueError as e:
+            raise SPARQLResultsParseError('Could not decode SPARQL JSON head: %s' % e)
+        variables = [Variable(v) for v in head.get('vars', [])]
+
+    buf = buf[array_start + 1:]
+    index = 0
+
+    while True:
+        index = skip_whitespace(buf, index)
+
+        if index < len(buf) and buf[index] == u']':
+            return
+
+        try:
+            binding, end = decoder.raw_decode(buf, index)
+        except ValueError:
+            # The next binding has not been read completely yet
+            chunk = fill()
+            if chunk is False:
+                raise SPARQLResultsParseError('Unexpected end of SPARQL JSON results')
+            buf = buf[index:] + chunk
+            index = 0
+            continue
+
+        yield dict((Variable(name), json_term(value)) for name, value in binding.iteritems()), variables
+        index = end
+
+def iter_results(source, content_type=None):
+    """Chooses an incremental decoder based on the Content-Type of a SPARQL results response"""
+    if content_type and content_type.split(';')[0].strip().lower() == JSON_MIMETYPE:
+        return iter_json_results(source)
+    else:
+        return iter_xml_results(source)
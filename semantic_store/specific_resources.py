@@ -1,13 +1,12 @@
 from django.db import transaction
 
 from rdflib import Literal, URIRef, Graph
-from rdflib.plugins.sparql import prepareQuery
 
 from semantic_store.rdfstore import rdfstore
 from semantic_store.namespaces import NS, ns, bind_namespaces
 from semantic_store.utils import metadata_triples
 from semantic_store.annotations import resource_annotation_subgraph
-from semantic_store import uris
+from semantic_store import uris, subgraphs, deltas
 
 import itertools
 
@@ -28,6 +27,7 @@ def specific_resource_subgraph(graph, specific_resource):
     return specific_resource_graph
 
 def specific_resources_subgraph(graph, source_uri, project_uri):
+    graph = subgraphs.specific_resources(graph, source_uri)
     specific_resources_graph = Graph()
 
     if (source_uri, NS.rdf.type, NS.sc.Canvas) in graph:
@@ -77,15 +77,18 @@ def read_specific_resource(project_uri, specific_resource, source):
     return return_graph
 
 def update_specific_resource(graph, project_uri, specific_resource_uri):
+    """
+    Writes the changes a graph makes to a specific resource and its selectors (whose values it
+    replaces) to the project graph. Returns the Delta written.
+    """
     project_identifier = uris.uri('semantic_store_projects', uri=project_uri)
     db_project_graph = Graph(store=rdfstore(), identifier=project_identifier)
 
-    for t in specific_resource_subgraph(graph, specific_resource_uri):
-        db_project_graph.add(t)
+    input_graph = specific_resource_subgraph(graph, specific_resource_uri)
+    replaced = [(selector, p) for selector in graph.objects(specific_resource_uri, NS.oa.hasSelector)
+                for p in graph.predicates(selector, None)]
 
-        for selector in graph.objects(specific_resource_uri, NS.oa.hasSelector):
-            for i in graph.triples((selector, None, None)):
-                db_project_graph.set(i)
+    return deltas.patch(db_project_graph, input_graph, replaced)
 
 def blank_specific_resources(graph):
     for uri in graph.subjects(NS.rdf.type, NS.oa.SpecificResource):
@@ -0,0 +1,349 @@
+"""
+Server side extraction of the subgraphs read by the canvas, text, annotation and specific
+resource views.
+
+Building those views from a store-backed graph takes one store round trip for every triples(),
+value() and `in` probe. Instead, each read shape is described here as a small set of
+parameterised CONSTRUCT blocks, which are combined into one (or, for annotation lists, a few)
+queries returning every triple the view could read. The view code then runs unchanged against
+that in-memory copy.
+
+Stores which cannot run CONSTRUCT queries server side (the SQLAlchemy store) fall back to
+running the view code directly against the store.
+"""
+from rdflib import Graph, URIRef
+from rdflib.namespace import RDF
+
+from semantic_store.namespaces import NS
+
+import itertools
+import re
+
+PREFIXES = {
+    'rdf': NS.rdf,
+    'oa': NS.oa,
+    'foaf': NS.foaf,
+    'sc': NS.sc,
+}
+
+# Number of list cells fetched per query when following rdf:rest chains
+LIST_DEPTH = 8
+
+# Number of canvases whose subgraphs are read by each query, when reading several
+CANVASES_PER_QUERY = 10
+
+UNSAFE_URI_CHARACTERS = re.compile(r'[<>"{}|^`\\\s]')
+
+def sparql_term(term):
+    """Returns the n3 form of a URIRef, refusing any which could break out of a query"""
+    if not is_safe_uri(term):
+        raise ValueError('Only URIRefs without unsafe characters may be bound in subgraph queries, not %r' % term)
+    return term.n3()
+
+# Each block is a (construct template, where pattern) pair. %(v)s is replaced with a prefix which is
+# unique to the block, so that the variables of different blocks (which are UNIONed) never collide.
+
+RESOURCE_TRIPLES = (
+    '%(resource)s ?%(v)sp ?%(v)so .',
+    '%(resource)s ?%(v)sp ?%(v)so .'
+)
+
+ANNOTATION_ON_RESOURCE = '{ ?%(v)sanno oa:hasTarget %(resource)s } UNION { ?%(v)sanno oa:hasBody %(resource)s } . '
+ANNOTATION_RESOURCE = '{ %(anno)s oa:hasTarget ?%(v)sres } UNION { %(anno)s oa:hasBody ?%(v)sres } . '
+
+ANNOTATION_BLOCKS = (
+    # The annotation
+    ('%(anno)s ?%(v)sp ?%(v)so .',
+     '%(anno)s ?%(v)sp ?%(v)so .'),
+    # Its bodies and targets
+    ('?%(v)sres ?%(v)sp ?%(v)so .',
+     ANNOTATION_RESOURCE + '?%(v)sres ?%(v)sp ?%(v)so .'),
+    # The sources of bodies and targets which are specific resources
+    ('?%(v)ssource ?%(v)sp ?%(v)so .',
+     ANNOTATION_RESOURCE + '?%(v)sres oa:hasSource ?%(v)ssource . ?%(v)ssource ?%(v)sp ?%(v)so .'),
+    # ... and their selectors
+    ('?%(v)sselector ?%(v)sp ?%(v)so .',
+     ANNOTATION_RESOURCE + '?%(v)sres oa:hasSelector ?%(v)sselector . ?%(v)sselector ?%(v)sp ?%(v)so .'),
+)
+
+SPECIFIC_RESOURCE_BLOCKS = (
+    # Specific resources with the resource as their source
+    ('?%(v)ssr ?%(v)sp ?%(v)so .',
+     '?%(v)ssr oa:hasSource %(resource)s . ?%(v)ssr ?%(v)sp ?%(v)so .'),
+    # ... and their selectors
+    ('?%(v)sselector ?%(v)sp ?%(v)so .',
+     '?%(v)ssr oa:hasSource %(resource)s . ?%(v)ssr oa:hasSelector ?%(v)sselector . ?%(v)sselector ?%(v)sp ?%(v)so .'),
+)
+
+IMAGE_DERIVATIVES = (
+    # The thumbnails and tile pyramids of the images painted on the resource
+    ('?%(v)sderivative ?%(v)sp ?%(v)so .',
+     '?%(v)sanno oa:hasTarget %(resource)s . ?%(v)sanno oa:hasBody ?%(v)simage . '
+     '{ ?%(v)simage foaf:thumbnail ?%(v)sderivative } UNION { ?%(v)simage sc:hasRelatedService ?%(v)sderivative } . '
+     '?%(v)sderivative ?%(v)sp ?%(v)so .'),
+)
+
+class ConstructQuery(object):
+    """Accumulates blocks, and renders them as one CONSTRUCT over a single named graph"""
+
+    def __init__(self, graph_identifier):
+        self.graph_identifier = graph_identifier
+        self.blocks = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def add(self, block, **bindings):
+        v = 'b%d_' % self._counter.next()
+        # Bindings may themselves be variables of the block
+        bindings = dict((name, value.replace('%(v)s', v)) for name, value in bindings.items())
+        bindings['v'] = v
+        template, pattern = block
+        self.blocks.append((template % bindings, pattern % bindings))
+
+    def add_resource(self, resource):
+        self.add(RESOURCE_TRIPLES, resource=sparql_term(resource))
+
+    def add_annotations_on(self, resource):
+        """Annotations with the resource as a body or target, with everything annotation_subgraph reads about them"""
+        resource = sparql_term(resource)
+        for template, pattern in ANNOTATION_BLOCKS:
+            self.add((template, ANNOTATION_ON_RESOURCE + pattern), resource=resource, anno='?%(v)sanno')
+
+    def add_annotation(self, anno):
+        """A known annotation, with everything annotation_subgraph reads about it"""
+        anno = sparql_term(anno)
+        for block in ANNOTATION_BLOCKS:
+            self.add(block, anno=anno)
+
+    def add_image_derivatives_of(self, resource):
+        resource = sparql_term(resource)
+        for block in IMAGE_DERIVATIVES:
+            self.add(block, resource=resource)
+
+    def add_specific_resources_of(self, resource):
+        resource = sparql_term(resource)
+        for block in SPECIFIC_RESOURCE_BLOCKS:
+            self.add(block, resource=resource)
+
+    def add_list(self, start, path, depth=LIST_DEPTH):
+        """
+        The `depth` list cells reached by following `path` (a sequence of predicates) from the
+        URIRef start, then rdf:rest. List cells are usually blank nodes, which cannot be named in
+        a later query, so every query walks to the cells from a URIRef.
+        """
+        start = sparql_term(start)
+        v = 'b%d_' % self._counter.next()
+
+        walk = []
+        node = start
+        for i, predicate in enumerate(path):
+            walk.append('%s %s ?%sw%d .' % (node, predicate.n3(), v, i))
+            node = '?%sw%d' % (v, i)
+
+        for i in range(depth):
+            template = '%s ?%sp%d ?%so%d .' % (node, v, i, v, i)
+            self.blocks.append((template, ' '.join(walk + [template])))
+
+            walk.append('%s rdf:rest ?%sc%d .' % (node, v, i))
+            node = '?%sc%d' % (v, i)
+
+    def __unicode__(self):
+        prefixes = u'\n'.join(u'PREFIX %s: <%s>' % (prefix, namespace) for prefix, namespace in PREFIXES.items())
+        template = u'\n    '.join(template for template, pattern in self.blocks)
+        where = u'\n    UNION\n    '.join(u'{ %s }' % pattern for template, pattern in self.blocks)
+
+        return u'%s\nCONSTRUCT {\n    %s\n} WHERE { GRAPH %s {\n    %s\n} }' % (
+            prefixes, template, self.graph_identifier.n3(), where)
+
+    def run(self, store, graph=None):
+        return store.construct(unicode(self), graph)
+
+def is_safe_uri(term):
+    return isinstance(term, URIRef) and not UNSAFE_URI_CHARACTERS.search(term)
+
+def supports_construct(graph, uri):
+    """
+    True for graphs held in a store which can run CONSTRUCT queries server side, when uri can be
+    bound in a query safely
+    """
+    return (hasattr(graph, 'store') and hasattr(graph.store, 'construct') and
+            is_safe_uri(graph.identifier) and is_safe_uri(URIRef(uri)))
+
+def _list_frontier(local, start, predicate, length=None):
+    """
+    Walks the list which is the `predicate` of `start` as far as it has been fetched into local.
+    Returns (uri, path) leading from the last URIRef on the way to the first cell not fetched yet,
+    or None if the whole list (or its first `length` cells) has been fetched.
+    """
+    uri, path = start, [predicate]
+    seen = set()
+    cell = local.value(start, predicate)
+
+    while cell is not None and cell != RDF.nil and cell not in seen:
+        if (cell, None, None) not in local:
+            return uri, path
+        seen.add(cell)
+        if length is not None and len(seen) >= length:
+            return None
+
+        if isinstance(cell, URIRef):
+            uri, path = cell, [RDF.rest]
+        else:
+            path = path + [RDF.rest]
+        cell = local.value(cell, RDF.rest)
+
+    if cell is None and not seen:
+        # The list head itself is not known yet
+        return uri, path
+    return None
+
+def fetch_lists(graph, local, lists, length=None):
+    """
+    Fetches the cells of every list in `lists`, given as (uri, predicate) pairs, into local,
+    LIST_DEPTH cells per list per query. With `length`, only the first `length` cells of each list
+    are needed, so no more queries are run for a list once they have been fetched.
+    """
+    if length is not None and length <= 0:
+        return
+
+    frontiers = {}
+    for start, predicate in lists:
+        frontier = _list_frontier(local, start, predicate, length)
+        if frontier is not None:
+            frontiers[(start, predicate)] = frontier
+
+    while frontiers:
+        query = ConstructQuery(graph.identifier)
+        for uri, path in frontiers.values():
+            query.add_list(uri, path)
+        size = len(local)
+        query.run(graph.store, local)
+
+        if len(local) == size:
+            # Nothing more to fetch (the lists end in cells with no triples)
+            break
+
+        for key, previous in frontiers.items():
+            frontier = _list_frontier(local, *key, length=length)
+            if frontier is None or frontier == previous:
+                del frontiers[key]
+            else:
+                frontiers[key] = frontier
+
+def list_items(local, head):
+    if head is None:
+        return []
+    return list(local.items(head))
+
+def fetch_annotation_lists(graph, local, canvas_uri):
+    """Fetches the sc:hasLists annotation lists of a canvas, and the annotations they contain"""
+    fetch_canvases_annotation_lists(graph, local, [canvas_uri])
+
+def fetch_canvases_annotation_lists(graph, local, canvas_uris):
+    """Fetches the annotation lists of several canvases, and their annotations, together"""
+    canvas_uris = [c for c in canvas_uris if local.value(c, NS.sc.hasLists) is not None]
+    if not canvas_uris:
+        return
+
+    fetch_lists(graph, local, [(c, NS.sc.hasLists) for c in canvas_uris])
+
+    anno_lists = []
+    for c in canvas_uris:
+        anno_lists.extend(l for l in list_items(local, local.value(c, NS.sc.hasLists))
+                          if isinstance(l, URIRef) and l not in anno_lists)
+    if anno_lists:
+        query = ConstructQuery(graph.identifier)
+        for anno_list in anno_lists:
+            query.add_resource(anno_list)
+        query.run(graph.store, local)
+
+    fetch_lists(graph, local, [(l, NS.sc.hasAnnotations) for l in anno_lists if (l, NS.sc.hasAnnotations, None) in local])
+    annotation_heads = [local.value(l, NS.sc.hasAnnotations) for l in anno_lists]
+
+    annos = set()
+    for head in annotation_heads:
+        annos.update(a for a in list_items(local, head) if isinstance(a, URIRef))
+
+    if annos:
+        query = ConstructQuery(graph.identifier)
+        for anno in annos:
+            query.add_annotation(anno)
+        query.run(graph.store, local)
+
+def resource_annotations(graph, resource_uri):
+    """
+    Returns an in-memory graph with everything annotations.resource_annotation_subgraph reads
+    for the given resource (or the graph itself, if it cannot be queried server side)
+    """
+    if not supports_construct(graph, resource_uri):
+        return graph
+
+    query = ConstructQuery(graph.identifier)
+    query.add_annotations_on(URIRef(resource_uri))
+    return query.run(graph.store)
+
+def specific_resources(graph, source_uri):
+    """Everything specific_resources.specific_resources_subgraph reads for the given source"""
+    if not supports_construct(graph, source_uri):
+        return graph
+
+    query = ConstructQuery(graph.identifier)
+    query.add_resource(URIRef(source_uri))
+    query.add_specific_resources_of(URIRef(source_uri))
+    return query.run(graph.store)
+
+def text(graph, text_uri):
+    """Everything project_texts.read_project_text reads from the project graph for the given text"""
+    if not supports_construct(graph, text_uri):
+        return graph
+
+    text_uri = URIRef(text_uri)
+
+    query = ConstructQuery(graph.identifier)
+    query.add_resource(text_uri)
+    query.add_annotations_on(text_uri)
+    query.add_specific_resources_of(text_uri)
+    return query.run(graph.store)
+
+def canvases(graph, canvas_uris):
+    """
+    Everything canvases.canvas_subgraph reads for each of the canvases, read together, with one
+    query for every CANVASES_PER_QUERY canvases
+    """
+    canvas_uris = [URIRef(c) for c in canvas_uris]
+    if not all(supports_construct(graph, c) for c in canvas_uris):
+        return graph
+
+    local = Graph()
+    for i in range(0, len(canvas_uris), CANVASES_PER_QUERY):
+        query = ConstructQuery(graph.identifier)
+        for canvas_uri in canvas_uris[i:i + CANVASES_PER_QUERY]:
+            query.add_resource(canvas_uri)
+            query.add_annotations_on(canvas_uri)
+            query.add_image_derivatives_of(canvas_uri)
+            query.add_specific_resources_of(canvas_uri)
+        query.run(graph.store, local)
+
+    fetch_canvases_annotation_lists(graph, local, canvas_uris)
+
+    return local
+
+def canvas(graph, canvas_uri):
+    """Everything canvases.canvas_subgraph reads for the given canvas"""
+    if not supports_construct(graph, canvas_uri):
+        return graph
+
+    canvas_uri = URIRef(canvas_uri)
+
+    query = ConstructQuery(graph.identifier)
+    query.add_resource(canvas_uri)
+    query.add_annotations_on(canvas_uri)
+    query.add_image_derivatives_of(canvas_uri)
+    query.add_specific_resources_of(canvas_uri)
+    local = query.run(graph.store)
+
+    fetch_annotation_lists(graph, local, canvas_uri)
+
+    return local
@@ -1,16 +1,33 @@
 import os
+import sys
+import shutil
+import tempfile
 
 import uuid
+import json
+import threading
+import logging
+import time
+import datetime
+from StringIO import StringIO
+import urlparse
+import BaseHTTPServer
+import SocketServer
 
 from django.utils import unittest
 from django.test.client import Client
 from django.core.urlresolvers import reverse
 
 from rdflib.graph import ConjunctiveGraph, Graph
+import rdflib
 from rdflib import URIRef, Literal, BNode, Namespace
 from .namespaces import NS, ns, bind_namespaces
 import rdfstore
 from semantic_store.namespaces import update_oa
+from semantic_store.connection_pool import HTTPConnectionPool, ConnectionPoolError
+from semantic_store import sparql_results, query_cache, queries
+from rdflib.plugins.memory import IOMemory
+from rdflib.collection import Collection
 
 annotations_url = reverse('semantic_store_annotations', kwargs=dict())
 project_annotations_url = reverse('semantic_store_project_annotations',
@@ -327,3 +344,2000 @@ class TestDataUpdate(unittest.TestCase):
         new_graph = update_oa(old_graph)
 
         self.assertTrue(new_graph.isomorphic(correct_graph))
+
+
+SPARQL_XML_RESULTS = """<?xml version="1.0"?>
+<sparql xmlns="http://www.w3.org/2005/sparql-results#">
+  <head><variable name="s"/><variable name="p"/><variable name="o"/></head>
+  <results>
+%s
+  </results>
+</sparql>"""
+
+SPARQL_XML_RESULT = """    <result>
+      <binding name="s"><uri>%s</uri></binding>
+      <binding name="p"><uri>%s</uri></binding>
+      <binding name="o"><literal>%s</literal></binding>
+    </result>"""
+
+class StandInSPARQLServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A local keep-alive HTTP server which answers every SPARQL query with the same result set
+    (or with the rows returned by `answer` for the query), and records the queries and updates
+    it receives
+    """
+    daemon_threads = True
+
+    def __init__(self, rows=(), answer=None):
+        self.rows = list(rows)
+        self.answer = answer
+        self.queries = []
+        self.updates = []
+        self.connections = 0
+
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                server.connections += 1
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                params = urlparse.parse_qs(body)
+
+                if 'update' in params:
+                    server.updates.append(params['update'][0])
+                    content = ''
+                    status = 200
+                else:
+                    server.queries.append(params['query'][0])
+                    content = server.results(params['query'][0])
+                    status = 200
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/sparql-results+xml')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+
+    def results(self, query=None):
+        rows = self.answer(query) if self.answer else self.rows
+        return (SPARQL_XML_RESULTS % u'\n'.join(SPARQL_XML_RESULT % row for row in rows)).encode('utf-8')
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+class YieldingFourStore(rdfstore.FourStore):
+    """A FourStore which lets other threads run between building a query and sending it"""
+    def flush_batch(self):
+        time.sleep(0.001)
+        return super(YieldingFourStore, self).flush_batch()
+
+class TestFourStoreConnectionPool(unittest.TestCase):
+    rows = [
+        ('http://example.org/a', 'http://purl.org/dc/elements/1.1/title', 'A'),
+        ('http://example.org/b', 'http://purl.org/dc/elements/1.1/title', 'B'),
+    ]
+
+    def four_store(self, server, **pool_options):
+        return rdfstore.FourStore(server.url + 'sparql/', server.url + 'update/', pool_options=pool_options)
+
+    def test_reads_reuse_connections(self):
+        with StandInSPARQLServer(self.rows) as server:
+            store = self.four_store(server)
+            g = Graph(store, identifier=URIRef('http://example.org/graph'))
+
+            for i in range(10):
+                self.assertEqual(len(list(g.triples((None, None, None)))), 2)
+
+            stats = store.pool_statistics()['SPARQL']
+            self.assertEqual(stats['requests'], 10)
+            self.assertEqual(stats['created'], 1)
+            self.assertEqual(stats['in_use'], 0)
+            self.assertEqual(server.connections, 1)
+
+    def test_updates_reuse_connections(self):
+        with StandInSPARQLServer() as server:
+            store = self.four_store(server)
+            g = Graph(store, identifier=URIRef('http://example.org/graph'))
+
+            for i in range(5):
+                g.add((URIRef('http://example.org/a'), NS.dc.title, Literal(i)))
+
+            self.assertEqual(len(server.updates), 5)
+            self.assertEqual(store.pool_statistics()['UPDATE']['created'], 1)
+
+    def test_pool_is_bounded_across_threads(self):
+        with StandInSPARQLServer(self.rows) as server:
+            store = self.four_store(server, max_size=2)
+            g = Graph(store, identifier=URIRef('http://example.org/graph'))
+            errors = []
+
+            def read():
+                try:
+                    for i in range(5):
+                        list(g.triples((None, None, None)))
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=read) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            stats = store.pool_statistics()['SPARQL']
+            self.assertEqual(errors, [])
+            self.assertEqual(stats['requests'], 40)
+            self.assertTrue(stats['created'] <= 2)
+
+    def test_concurrent_queries_keep_their_own_text(self):
+        a = URIRef('http://example.org/a')
+        b = URIRef('http://example.org/b')
+
+        def answer(query):
+            subject = a if a.n3() in query else b
+            return [(subject, 'http://purl.org/dc/elements/1.1/title', subject[-1].upper())]
+
+        with StandInSPARQLServer(answer=answer) as server:
+            store = YieldingFourStore(server.url + 'sparql/', server.url + 'update/')
+            g = Graph(store, identifier=URIRef('http://example.org/graph'))
+
+            def read(subject):
+                return lambda: [o for s, p, o in g.triples((subject, None, None))]
+
+            subjects = [a, b] * 20
+            results = rdfstore.gather(g, [read(subject) for subject in subjects], concurrency=8)
+
+            self.assertEqual(results, [[Literal(subject[-1].upper())] for subject in subjects])
+            self.assertEqual(len(server.queries), 40)
+
+    def test_retries_with_backoff(self):
+        pool = HTTPConnectionPool('http://127.0.0.1:1/', max_retries=2, backoff=0)
+
+        self.assertRaises(ConnectionPoolError, pool.request, 'GET')
+        stats = pool.statistics()
+        self.assertEqual(stats['retries'], 2)
+        self.assertEqual(stats['failures'], 1)
+        self.assertEqual(stats['in_use'], 0)
+
+class TestSPARQLResultDecoding(unittest.TestCase):
+    rows = [
+        ('http://example.org/%d' % i, 'http://purl.org/dc/elements/1.1/title', u'Title \u00e9 %d' % i)
+        for i in range(50)
+    ]
+
+    def expected(self):
+        return [
+            {rdflib.Variable('s'): URIRef(s), rdflib.Variable('p'): URIRef(p), rdflib.Variable('o'): Literal(o)}
+            for s, p, o in self.rows
+        ]
+
+    def test_xml_results(self):
+        document = SPARQL_XML_RESULTS % '\n'.join(SPARQL_XML_RESULT % row for row in self.rows)
+        results = list(sparql_results.iter_xml_results(StringIO(document.encode('utf-8'))))
+
+        self.assertEqual([bindings for bindings, variables in results], self.expected())
+        self.assertEqual(results[0][1], [rdflib.Variable('s'), rdflib.Variable('p'), rdflib.Variable('o')])
+
+    def test_json_results_in_small_chunks(self):
+        document = json.dumps({
+            'head': {'vars': ['s', 'p', 'o']},
+            'results': {'bindings': [
+                {
+                    's': {'type': 'uri', 'value': s},
+                    'p': {'type': 'uri', 'value': p},
+                    'o': {'type': 'literal', 'value': o},
+                } for s, p, o in self.rows
+            ]}
+        }, ensure_ascii=False).encode('utf-8')
+
+        results = list(sparql_results.iter_json_results(StringIO(document), chunk_size=7))
+
+        self.assertEqual([bindings for bindings, variables in results], self.expected())
+        self.assertEqual(results[0][1], [rdflib.Variable('s'), rdflib.Variable('p'), rdflib.Variable('o')])
+
+    def test_json_typed_and_language_literals(self):
+        document = json.dumps({
+            'head': {'vars': ['o']},
+            'results': {'bindings': [
+                {'o': {'type': 'typed-literal', 'value': '5', 'datatype': 'http://www.w3.org/2001/XMLSchema#integer'}},
+                {'o': {'type': 'literal', 'value': 'chat', 'xml:lang': 'fr'}},
+            ]}
+        })
+
+        results = [b[rdflib.Variable('o')] for b, v in sparql_results.iter_json_results(StringIO(document))]
+        self.assertEqual(results, [Literal(5), Literal('chat', lang='fr')])
+
+    def test_empty_results(self):
+        document = json.dumps({'head': {'vars': ['s']}, 'results': {'bindings': []}})
+        self.assertEqual(list(sparql_results.iter_json_results(StringIO(document))), [])
+        self.assertEqual(list(sparql_results.iter_xml_results(StringIO(SPARQL_XML_RESULTS % ''))), [])
+
+    def test_store_streams_and_releases_connections(self):
+        with StandInSPARQLServer(self.rows) as server:
+            store = rdfstore.FourStore(server.url + 'sparql/', server.url + 'update/')
+            g = Graph(store, identifier=URIRef('http://example.org/graph'))
+
+            # Abandoning a partially read result should still return the connection to the pool
+            self.assertTrue((URIRef(self.rows[0][0]), None, None) in g)
+            self.assertEqual(len(list(g.triples((None, None, None)))), len(self.rows))
+
+            stats = store.pool_statistics()['SPARQL']
+            self.assertEqual(stats['in_use'], 0)
+            self.assertEqual(stats['requests'], 2)
+
+class TestWriteBatching(unittest.TestCase):
+    graph_uri = URIRef('http://example.org/graph')
+
+    def triples(self, count):
+        return [(URIRef('http://example.org/%d' % i), NS.dc.title, Literal('Title %d' % i)) for i in range(count)]
+
+    def test_four_store_batch_is_one_update(self):
+        with StandInSPARQLServer() as server:
+            store = rdfstore.FourStore(server.url + 'sparql/', server.url + 'update/')
+            g = Graph(store, identifier=self.graph_uri)
+
+            with store.batch():
+                for t in self.triples(500):
+                    g.add(t)
+                g.set((URIRef('http://example.org/0'), NS.dc.title, Literal('New title')))
+
+            self.assertEqual(len(server.updates), 1)
+            update = server.updates[0]
+            self.assertEqual(update.count('INSERT DATA'), 2)
+            self.assertEqual(update.count('DELETE {'), 1)
+            self.assertTrue(update.index('DELETE {') < update.rindex('INSERT DATA'))
+
+    def test_four_store_add_n_is_one_update(self):
+        with StandInSPARQLServer() as server:
+            store = rdfstore.FourStore(server.url + 'sparql/', server.url + 'update/')
+            g = Graph(store, identifier=self.graph_uri)
+
+            g += self.triples(100)
+
+            self.assertEqual(len(server.updates), 1)
+            self.assertEqual(server.updates[0].count('INSERT DATA'), 1)
+
+    def test_four_store_reads_flush_batch(self):
+        with StandInSPARQLServer() as server:
+            store = rdfstore.FourStore(server.url + 'sparql/', server.url + 'update/')
+            g = Graph(store, identifier=self.graph_uri)
+
+            with store.batch():
+                g.add(self.triples(1)[0])
+                list(g.triples((None, None, None)))
+                self.assertEqual(len(server.updates), 1)
+                g.add(self.triples(2)[1])
+
+            self.assertEqual(len(server.updates), 2)
+
+    def test_four_store_batch_discarded_on_exception(self):
+        with StandInSPARQLServer() as server:
+            store = rdfstore.FourStore(server.url + 'sparql/', server.url + 'update/')
+            g = Graph(store, identifier=self.graph_uri)
+
+            try:
+                with store.batch():
+                    g += self.triples(10)
+                    raise ValueError()
+            except ValueError:
+                pass
+
+            self.assertEqual(server.updates, [])
+            self.assertEqual(store.current_batch(), None)
+
+    def test_sqlalchemy_batch(self):
+        store = rdfstore.SQLAlchemyStore(identifier=URIRef('http://example.org/store'))
+        store.open(Literal('sqlite://'))
+        g = Graph(store, identifier=self.graph_uri)
+
+        with store.batch():
+            g += self.triples(500)
+            g.set((URIRef('http://example.org/0'), NS.dc.title, Literal('New title')))
+            self.assertEqual(len(g), 500)
+
+        self.assertEqual(len(g), 500)
+        self.assertEqual(g.value(URIRef('http://example.org/0'), NS.dc.title), Literal('New title'))
+
+        try:
+            with store.batch():
+                g.remove((None, NS.dc.title, None))
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertEqual(len(g), 500)
+
+class TestTriplesChoices(unittest.TestCase):
+    graph_uri = URIRef('http://example.org/graph')
+
+    def subjects(self, count):
+        return [URIRef('http://example.org/subjects/%d' % i) for i in range(count)]
+
+    def test_four_store_values_in_concurrent_chunks(self):
+        rows = [('http://example.org/a', 'http://purl.org/dc/elements/1.1/title', 'A')]
+        with StandInSPARQLServer(rows) as server:
+            store = rdfstore.FourStore(server.url + 'sparql/', server.url + 'update/')
+            store.choices_chunk_size = 100
+            g = Graph(store, identifier=self.graph_uri)
+
+            triples = list(g.triples_choices((self.subjects(250), [NS.dc.title, NS.rdfs.label], None)))
+
+            self.assertEqual(len(server.queries), 3)
+            self.assertEqual(len(triples), 3)
+            for query in server.queries:
+                self.assertTrue('VALUES ?s {' in query and 'VALUES ?p {' in query)
+                self.assertFalse('FILTER' in query)
+            self.assertEqual(sum(query.count('<http://example.org/subjects/') for query in server.queries), 250)
+
+            self.assertEqual(list(g.triples_choices(([], NS.dc.title, None))), [])
+            self.assertEqual(len(server.queries), 3)
+
+    def test_sqlalchemy_in_clauses(self):
+        store = rdfstore.SQLAlchemyStore(identifier=URIRef('http://example.org/store'))
+        store.open(Literal('sqlite://'))
+        g = Graph(store, identifier=self.graph_uri)
+
+        subjects = self.subjects(1200)
+        for s in subjects:
+            g.add((s, NS.rdf.type, NS.sc.Canvas))
+            g.add((s, NS.dc.title, Literal(s)))
+            g.add((s, NS.dc.description, Literal(s)))
+
+        chosen = subjects[::2]
+        triples = set(g.triples_choices((chosen, [NS.rdf.type, NS.dc.title], None)))
+
+        expected = set()
+        for s in chosen:
+            expected.update([(s, NS.rdf.type, NS.sc.Canvas), (s, NS.dc.title, Literal(s))])
+        self.assertEqual(triples, expected)
+
+        self.assertEqual(set(g.triples_choices((None, NS.dc.title, [Literal(subjects[0]), Literal(subjects[1])]))),
+                         set([(subjects[0], NS.dc.title, Literal(subjects[0])), (subjects[1], NS.dc.title, Literal(subjects[1]))]))
+        self.assertEqual(list(g.triples_choices((None, [], None))), [])
+
+class StoreBehaviour(object):
+    """Behaviour shared by every store backend; mixed into a TestCase per backend"""
+    graph_uri = URIRef('http://example.org/graph')
+    other_graph_uri = URIRef('http://example.org/other')
+
+    def make_store(self):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.store = self.make_store()
+        self.g = Graph(self.store, identifier=self.graph_uri)
+        self.other = Graph(self.store, identifier=self.other_graph_uri)
+
+        self.a, self.b, self.c = [URIRef('http://example.org/%s' % name) for name in 'abc']
+        self.g.add((self.a, NS.rdf.type, NS.sc.Canvas))
+        self.g.add((self.a, NS.dc.title, Literal('A', lang='en')))
+        self.g.add((self.a, NS.exif.width, Literal(100)))
+        self.g.add((self.a, NS.sc.hasLists, self.b))
+        self.g.add((self.b, NS.dc.title, Literal('B')))
+        self.other.add((self.a, NS.dc.title, Literal('Other A')))
+
+    def test_patterns(self):
+        self.assertEqual(len(self.g), 5)
+        self.assertEqual(len(list(self.g.triples((self.a, None, None)))), 4)
+        self.assertEqual(set(self.g.subjects(NS.dc.title, None)), set([self.a, self.b]))
+        self.assertEqual(self.g.value(self.a, NS.exif.width), Literal(100))
+        self.assertEqual(self.g.value(self.a, NS.dc.title), Literal('A', lang='en'))
+        self.assertTrue((self.a, NS.rdf.type, NS.sc.Canvas) in self.g)
+        self.assertEqual(list(self.g.objects(self.c, None)), [])
+
+    def test_contexts_are_separate(self):
+        self.assertEqual(list(self.other.objects(self.a, NS.dc.title)), [Literal('Other A')])
+        self.assertEqual(set(self.store.contexts()) >= set([self.graph_uri, self.other_graph_uri]), True)
+
+        conjunctive = ConjunctiveGraph(self.store)
+        self.assertEqual(set(conjunctive.objects(self.a, NS.dc.title)), set([Literal('A', lang='en'), Literal('Other A')]))
+
+    def test_remove(self):
+        self.g.remove((self.a, NS.dc.title, None))
+        self.assertEqual(self.g.value(self.a, NS.dc.title), None)
+        self.assertEqual(self.other.value(self.a, NS.dc.title), Literal('Other A'))
+
+        for t in self.g.triples((None, None, None)):
+            self.g.remove(t)
+        self.assertEqual(len(self.g), 0)
+        self.assertEqual(len(self.other), 1)
+
+    def test_triples_choices(self):
+        triples = set(self.g.triples_choices(([self.a, self.b], [NS.dc.title, NS.rdf.type], None)))
+        self.assertEqual(triples, set([
+            (self.a, NS.rdf.type, NS.sc.Canvas),
+            (self.a, NS.dc.title, Literal('A', lang='en')),
+            (self.b, NS.dc.title, Literal('B')),
+        ]))
+
+    def test_batch(self):
+        with self.store.batch():
+            self.g.add((self.c, NS.dc.title, Literal('C')))
+            self.g.remove((self.b, None, None))
+            self.assertEqual(self.g.value(self.c, NS.dc.title), Literal('C'))
+
+        self.assertEqual(self.g.value(self.b, NS.dc.title), None)
+
+        try:
+            with self.store.batch():
+                self.g.remove((None, None, None))
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(len(self.g), 5)
+
+    def test_drop_graph(self):
+        with self.store.batch():
+            self.g.add((self.c, NS.dc.title, Literal('C')))
+            self.store.drop_graph(self.g)
+
+        self.assertEqual(len(self.g), 0)
+        self.assertEqual(len(self.other), 1)
+
+    def test_sparql_query(self):
+        rows = list(self.g.query("SELECT ?title WHERE { ?canvas a sc:Canvas . ?canvas sc:hasLists ?l . ?l dc:title ?title }", initNs=ns))
+        self.assertEqual([row[0] for row in rows], [Literal('B')])
+
+class TestSQLAlchemyStoreBehaviour(StoreBehaviour, unittest.TestCase):
+    def make_store(self):
+        store = rdfstore.SQLAlchemyStore(identifier=URIRef('http://example.org/store'))
+        store.open(Literal('sqlite://'))
+        return store
+
+class EmbeddedStoreFixture(object):
+    """
+    Opens an embedded store (self.store) in a temporary directory for each test, and destroys it
+    afterwards; mixed into the TestCases of what is written to a store
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = rdfstore.EmbeddedStore(identifier=URIRef('http://example.org/store'))
+        self.store.open(os.path.join(self.directory, 'quads.db'))
+        super(EmbeddedStoreFixture, self).setUp()
+
+    def tearDown(self):
+        super(EmbeddedStoreFixture, self).tearDown()
+        self.store.destroy(self.store.path)
+        shutil.rmtree(self.directory)
+
+class TestEmbeddedStoreBehaviour(EmbeddedStoreFixture, StoreBehaviour, unittest.TestCase):
+    def make_store(self):
+        return self.store
+
+    def test_persists_and_reads_across_threads(self):
+        path = self.store.path
+        self.store.close()
+
+        reopened = rdfstore.EmbeddedStore(identifier=URIRef('http://example.org/store'))
+        reopened.open(path, create=False)
+        results = []
+        thread = threading.Thread(target=lambda: results.append(len(Graph(reopened, identifier=self.graph_uri))))
+        thread.start()
+        thread.join()
+        self.assertEqual(results, [5])
+
+class TestQueryCache(unittest.TestCase):
+    graph_uri = URIRef('http://example.org/graph')
+    other_graph_uri = URIRef('http://example.org/other')
+    rows = [('http://example.org/a', 'http://purl.org/dc/elements/1.1/title', 'A')]
+
+    def test_normalised_queries(self):
+        self.assertEqual(query_cache.normalise_query('SELECT ?s  WHERE {\n  ?s ?p "a  b" . # comment\n}'),
+                         query_cache.normalise_query('SELECT ?s WHERE { ?s ?p "a  b" . }'))
+        self.assertNotEqual(query_cache.normalise_query('SELECT ?s WHERE { ?s ?p "a  b" }'),
+                            query_cache.normalise_query('SELECT ?s WHERE { ?s ?p "a b" }'))
+        self.assertEqual(query_cache.query_graphs('SELECT * WHERE { ?s ?p ?o }', self.graph_uri), set([unicode(self.graph_uri)]))
+        self.assertEqual(query_cache.query_graphs('SELECT * WHERE { GRAPH ?g { ?s ?p ?o } }', self.graph_uri),
+                         set([query_cache.ANY_GRAPH]))
+
+    def test_queries_invalidated_by_writes_to_their_graph(self):
+        with StandInSPARQLServer(self.rows) as server:
+            store = rdfstore.CachingFourStore(server.url + 'sparql/', server.url + 'update/', cache_budget=1024 * 1024)
+            g = Graph(store, identifier=self.graph_uri)
+            other = Graph(store, identifier=self.other_graph_uri)
+            query = 'SELECT ?s ?p ?o WHERE { ?s ?p ?o }'
+
+            self.assertEqual(len(list(g.query(query))), 1)
+            self.assertEqual(len(list(g.query('SELECT ?s ?p ?o\nWHERE {  ?s ?p ?o  }'))), 1)
+            self.assertEqual(len(server.queries), 1)
+
+            other.add((URIRef('http://example.org/b'), NS.dc.title, Literal('B')))
+            self.assertEqual(len(list(g.query(query))), 1)
+            self.assertEqual(len(server.queries), 1)
+
+            g.add((URIRef('http://example.org/b'), NS.dc.title, Literal('B')))
+            self.assertEqual(len(list(g.query(query))), 1)
+            self.assertEqual(len(server.queries), 2)
+
+            stats = store.cache_statistics()
+            self.assertEqual(stats['hits'], 2)
+            self.assertEqual(stats['stale'], 1)
+
+    def test_not_cached_without_a_shared_cache_backend(self):
+        # The tests run with Django's default local memory cache, private to the process
+        self.assertFalse(query_cache.revisions_are_shared())
+        store = rdfstore.CachingEmbeddedStore(identifier=URIRef('http://example.org/store'))
+        self.assertEqual(store.query_cache.budget, 0)
+
+    def test_triples_invalidated_by_batches(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = rdfstore.CachingEmbeddedStore(identifier=URIRef('http://example.org/store'), cache_budget=1024 * 1024)
+            store.open(os.path.join(directory, 'quads.db'))
+            g = Graph(store, identifier=self.graph_uri)
+            a = URIRef('http://example.org/a')
+
+            g.add((a, NS.dc.title, Literal('A')))
+            self.assertEqual(g.value(a, NS.dc.title), Literal('A'))
+            self.assertEqual(g.value(a, NS.dc.title), Literal('A'))
+            self.assertEqual(store.cache_statistics()['hits'], 1)
+
+            with store.batch():
+                g.set((a, NS.dc.title, Literal('New A')))
+                self.assertEqual(g.value(a, NS.dc.title), Literal('New A'))
+            self.assertEqual(g.value(a, NS.dc.title), Literal('New A'))
+            self.assertEqual(len(g), 1)
+
+            store.destroy(store.path)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_memory_budget(self):
+        cache = query_cache.QueryCache(budget=1000)
+        tokens = cache.tokens([query_cache.ANY_GRAPH])
+        for i in range(20):
+            cache.put(i, i, 60, tokens)
+
+        stats = cache.statistics()
+        self.assertTrue(cache.size <= 1000)
+        self.assertEqual(stats['entries'], 16)
+        self.assertEqual(stats['evictions'], 4)
+        self.assertEqual(cache.get(0), None)
+        self.assertEqual(cache.get(19), 19)
+
+        cache.put('large', 'large', 500, tokens)
+        self.assertEqual(cache.statistics()['too_large'], 1)
+
+class ConstructingMemoryStore(IOMemory):
+    """An in-memory store which answers CONSTRUCT queries like FourStore.construct"""
+
+    def __init__(self, *args, **kwargs):
+        super(ConstructingMemoryStore, self).__init__(*args, **kwargs)
+        self.constructs = []
+
+    def construct(self, query, graph=None):
+        self.constructs.append(query)
+        if graph is None:
+            graph = Graph()
+        # rdflib's SPARQL parser recurses once per UNION
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(20000)
+        try:
+            graph += ConjunctiveGraph(self).query(query)
+        finally:
+            sys.setrecursionlimit(limit)
+        return graph
+
+class TestSubgraphExtraction(unittest.TestCase):
+    project_uri = URIRef('urn:example:project')
+
+    def setUp(self):
+        from semantic_store import uris
+        self.store = ConstructingMemoryStore()
+        self.graph = Graph(self.store, identifier=uris.uri('semantic_store_projects', uri=self.project_uri))
+        self.canvas = URIRef('urn:example:canvas')
+        self.text = URIRef('urn:example:text')
+
+        g = self.graph
+        g.add((self.canvas, NS.rdf.type, NS.sc.Canvas))
+        g.add((self.canvas, NS.dc.title, Literal('Canvas')))
+        g.add((self.text, NS.rdf.type, NS.dcmitype.Text))
+        g.add((self.text, NS.dc.title, Literal('Text')))
+
+        image_anno, image = URIRef('urn:example:image-anno'), URIRef('urn:example:image')
+        g.add((image_anno, NS.rdf.type, NS.oa.Annotation))
+        g.add((image_anno, NS.oa.hasTarget, self.canvas))
+        g.add((image_anno, NS.oa.hasBody, image))
+        g.add((image, NS.rdf.type, NS.dcmitype.Image))
+
+        # An annotation linking a region of the canvas to a range of the text
+        anno = URIRef('urn:example:link')
+        g.add((anno, NS.rdf.type, NS.oa.Annotation))
+        for i, (source, selector_type) in enumerate([(self.canvas, NS.oa.SvgSelector), (self.text, NS.oa.TextQuoteSelector)]):
+            sr, selector = URIRef('urn:example:sr%d' % i), URIRef('urn:example:selector%d' % i)
+            g.add((anno, NS.oa.hasTarget, sr))
+            g.add((sr, NS.rdf.type, NS.oa.SpecificResource))
+            g.add((sr, NS.oa.hasSource, source))
+            g.add((sr, NS.oa.hasSelector, selector))
+            g.add((selector, NS.rdf.type, selector_type))
+
+        # Annotation lists, longer than can be fetched in one round
+        anno_lists = []
+        for i in range(12):
+            anno_list = URIRef('urn:example:list%d' % i)
+            anno_lists.append(anno_list)
+            annos = []
+            for j in range(3):
+                list_anno = URIRef('urn:example:list%d/anno%d' % (i, j))
+                annos.append(list_anno)
+                g.add((list_anno, NS.rdf.type, NS.oa.Annotation))
+                g.add((list_anno, NS.oa.hasTarget, self.canvas))
+                g.add((list_anno, NS.oa.hasBody, Literal('Note %d' % j)))
+            g.add((anno_list, NS.rdf.type, NS.sc.AnnotationList))
+            g.add((anno_list, NS.sc.hasAnnotations, Collection(g, BNode(), annos).uri))
+        g.add((self.canvas, NS.sc.hasLists, Collection(g, BNode(), anno_lists).uri))
+
+    def assertSameTriples(self, a, b):
+        self.assertEqual(set(a), set(b))
+        self.assertTrue(len(a) > 0)
+
+    def in_memory_copy(self):
+        copy = Graph(identifier=self.graph.identifier)
+        copy += self.graph
+        return copy
+
+    def test_canvas_subgraph(self):
+        from semantic_store.canvases import canvas_subgraph
+
+        extracted = canvas_subgraph(self.graph, self.canvas, self.project_uri)
+        expected = canvas_subgraph(self.in_memory_copy(), self.canvas, self.project_uri)
+
+        self.assertSameTriples(extracted, expected)
+        self.assertTrue(len(self.store.constructs) < 10)
+
+    def test_text_and_specific_resource_subgraphs(self):
+        from semantic_store.annotations import resource_annotation_subgraph
+        from semantic_store.specific_resources import specific_resources_subgraph
+
+        sr = URIRef('urn:example:sr1')
+        self.assertSameTriples(resource_annotation_subgraph(self.graph, sr),
+                               resource_annotation_subgraph(self.in_memory_copy(), sr))
+        self.assertSameTriples(specific_resources_subgraph(self.graph, self.text, self.project_uri),
+                               specific_resources_subgraph(self.in_memory_copy(), self.text, self.project_uri))
+        self.assertEqual(len(self.store.constructs), 2)
+
+    def test_unsafe_uris_are_not_queried(self):
+        from semantic_store import subgraphs
+
+        self.assertTrue(subgraphs.resource_annotations(self.graph, 'http://example.org/> } DROP ALL {') is self.graph)
+        self.assertEqual(self.store.constructs, [])
+
+    def test_lists_are_fetched_as_far_as_needed(self):
+        from semantic_store import manuscripts, subgraphs
+
+        sequence = URIRef('urn:example:sequence')
+        canvases = [URIRef('urn:example:canvas%d' % i) for i in range(subgraphs.LIST_DEPTH * 3)]
+        self.graph.add((sequence, NS.sc.hasCanvases, Collection(self.graph, BNode(), canvases).uri))
+
+        local = Graph()
+        local += self.graph.triples((sequence, NS.sc.hasCanvases, None))
+        subgraphs.fetch_lists(self.graph, local, [(sequence, NS.sc.hasCanvases)], length=2)
+        self.assertEqual(len(self.store.constructs), 1)
+        self.assertEqual(list(local.items(local.value(sequence, NS.sc.hasCanvases)))[:2], canvases[:2])
+
+        del self.store.constructs[:]
+        self.assertEqual(manuscripts.sequence_canvas_range(self.graph, sequence, subgraphs.LIST_DEPTH + 1, 2),
+                         canvases[subgraphs.LIST_DEPTH + 1:subgraphs.LIST_DEPTH + 3])
+        self.assertEqual(len(self.store.constructs), 2)
+        self.assertEqual(manuscripts.sequence_canvas_range(self.graph, sequence), canvases)
+
+class TestQueryRegistry(unittest.TestCase):
+    def setUp(self):
+        self.graph = Graph()
+        self.manifest = URIRef('urn:example:manifest')
+        for i, title in enumerate(['First', 'Quoted " } title']):
+            resource, url = URIRef('urn:example:resource%d' % i), URIRef('urn:example:resource%d.xml' % i)
+            self.graph.add((self.manifest, NS.ore.aggregates, resource))
+            self.graph.add((url, NS.ore.describes, resource))
+            self.graph.add((resource, NS.dc.title, Literal(title)))
+
+    def test_find_resource(self):
+        from semantic_store import collection
+
+        rows = collection.find_resource(self.manifest, self.graph, 'dc:title', 'Quoted " } title')
+        self.assertEqual(rows, [(URIRef('urn:example:resource1'), URIRef('urn:example:resource1.xml'))])
+        self.assertEqual(collection.find_resource(self.manifest, self.graph, 'dc:title', 'Missing'), [])
+
+    def test_rendered_bindings_cannot_break_out(self):
+        query = queries.registry['find_resource']
+        rendered = query.render(manifest_uri=self.manifest, predicate='dc:title', object=Literal('"} DROP ALL {"'))
+
+        self.assertIn(u'<urn:example:manifest> ore:aggregates ?resource_uri', rendered)
+        self.assertIn(u'?resource_uri <http://purl.org/dc/elements/1.1/title> "\\"} DROP ALL {\\""', rendered)
+        self.assertRaises(queries.BindingError, query.render, manifest_uri='urn:example:a> } DROP ALL { <urn:b',
+                          predicate='dc:title', object='x')
+
+    def test_projected_bindings_are_selected(self):
+        rendered = queries.substitute_bindings('SELECT ?a ?b WHERE { ?a ?p ?b . FILTER(?b != "?a") }', {'a': self.manifest})
+        self.assertEqual(rendered, u'SELECT (<urn:example:manifest> AS ?a) ?b WHERE { <urn:example:manifest> ?p ?b . FILTER(?b != "?a") }')
+
+    def test_bindings_are_checked(self):
+        query = queries.registry['aggregated_uris_urls']
+        self.assertRaises(queries.BindingError, query, self.graph)
+        self.assertRaises(queries.BindingError, query, self.graph, uri=self.manifest, other=self.manifest)
+
+    def test_statistics(self):
+        query = queries.registry['aggregated_uris_urls']
+        query.reset_statistics()
+
+        self.assertEqual(len(queries.run('aggregated_uris_urls', self.graph, uri=self.manifest)), 2)
+        stats = queries.statistics()['aggregated_uris_urls']
+        self.assertEqual(stats['calls'], 1)
+        self.assertEqual(stats['rows'], 2)
+        self.assertTrue(stats['max_time'] >= stats['mean_time'] >= 0)
+
+class TestFanOut(EmbeddedStoreFixture, unittest.TestCase):
+    def setUp(self):
+        super(TestFanOut, self).setUp()
+        self.graph = Graph(self.store, identifier=URIRef('http://example.org/manuscript-graph'))
+
+    def test_gather_runs_reads_concurrently_in_order(self):
+        lock = threading.Lock()
+        active = [0, 0]
+
+        def read(i):
+            def f():
+                with lock:
+                    active[0] += 1
+                    active[1] = max(active)
+                time.sleep(0.05)
+                with lock:
+                    active[0] -= 1
+                return i
+            return f
+
+        self.assertEqual(rdfstore.gather(self.graph, [read(i) for i in range(8)], concurrency=4), range(8))
+        self.assertEqual(active[1], 4)
+
+        # In-memory graphs are read one after another
+        active[1] = 0
+        self.assertEqual(rdfstore.gather(Graph(), [read(i) for i in range(3)]), range(3))
+        self.assertEqual(active[1], 1)
+
+    def test_gather_sees_pending_writes(self):
+        a = URIRef('urn:example:a')
+        with self.store.batch():
+            self.graph.add((a, NS.rdf.type, NS.sc.Canvas))
+            self.assertEqual(rdfstore.gather_triples(self.graph, [(a, None, None), ([a], [NS.rdf.type], None)]),
+                             [[(a, NS.rdf.type, NS.sc.Canvas)]] * 2)
+
+    def test_manuscript_subgraph(self):
+        from semantic_store.manuscripts import manuscript_subgraph
+
+        manuscript = URIRef('urn:example:manuscript')
+        sequences = []
+        for i in range(3):
+            sequence = URIRef('urn:example:sequence%d' % i)
+            canvases = [URIRef('urn:example:sequence%d/canvas%d' % (i, j)) for j in range(5)]
+            for canvas in canvases:
+                self.graph.add((canvas, NS.rdf.type, NS.sc.Canvas))
+                self.graph.add((canvas, NS.dc.title, Literal(canvas)))
+            self.graph.add((sequence, NS.rdf.type, NS.sc.Sequence))
+            self.graph.add((sequence, NS.sc.hasCanvases, Collection(self.graph, BNode(), canvases).uri))
+            sequences.append(sequence)
+        self.graph.add((manuscript, NS.rdf.type, NS.sc.Manifest))
+        self.graph.add((manuscript, NS.sc.hasSequences, Collection(self.graph, BNode(), sequences).uri))
+
+        in_memory = Graph()
+        in_memory += self.graph
+
+        subgraph = manuscript_subgraph(self.graph, manuscript)
+        self.assertEqual(set(subgraph), set(manuscript_subgraph(in_memory, manuscript)))
+        self.assertEqual(len(set(subgraph.subjects(NS.dc.title, None))), 15)
+
+class TestInstrumentation(unittest.TestCase):
+    graph_uri = URIRef('http://example.org/graph')
+
+    def setUp(self):
+        from semantic_store import instrumentation
+        self.instrumentation = instrumentation
+        self.logged = []
+
+        class Handler(logging.Handler):
+            def emit(handler, record):
+                self.logged.append(json.loads(record.getMessage()))
+
+        self.handler = Handler()
+        instrumentation.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.instrumentation.logger.removeHandler(self.handler)
+
+    def test_four_store_round_trips(self):
+        subjects = [URIRef('http://example.org/subjects/%d' % i) for i in range(250)]
+        rows = [('http://example.org/a', 'http://purl.org/dc/elements/1.1/title', 'A')]
+
+        with StandInSPARQLServer(rows) as server:
+            store = rdfstore.FourStore(server.url + 'sparql/', server.url + 'update/')
+            store.choices_chunk_size = 100
+            g = Graph(store, identifier=self.graph_uri)
+
+            with self.instrumentation.collecting() as statistics:
+                # The chunks are queried from worker threads
+                list(g.triples_choices((subjects, NS.dc.title, None)))
+                g.add((subjects[0], NS.dc.title, Literal('A')))
+
+        stats = statistics.as_dict()
+        self.assertEqual(stats['queries'], 3)
+        self.assertEqual(stats['updates'], 1)
+        self.assertTrue(stats['bytes_sent'] > 250 * len('<http://example.org/subjects/0>'))
+        self.assertTrue(stats['bytes_received'] > 0)
+        self.assertEqual(sum(stats['latency_histogram'].values()), 4)
+
+    def test_sqlalchemy_statements(self):
+        store = rdfstore.SQLAlchemyStore(identifier=URIRef('http://example.org/store'))
+        store.open(Literal('sqlite://'))
+        g = Graph(store, identifier=self.graph_uri)
+
+        with self.instrumentation.collecting() as statistics:
+            g.add((URIRef('http://example.org/a'), NS.dc.title, Literal('A')))
+            list(g.triples((None, NS.dc.title, None)))
+
+        self.assertTrue(statistics.updates >= 1)
+        self.assertTrue(statistics.queries >= 1)
+
+    def test_slow_query_log(self):
+        from django.test.utils import override_settings
+
+        with override_settings(RDF_SLOW_QUERY_SECONDS=0.5):
+            self.instrumentation.record(self.instrumentation.QUERY, 'SELECT * WHERE { ?s ?p ?o }', 0.1)
+            self.instrumentation.record(self.instrumentation.QUERY, 'SELECT ?slow WHERE { ?slow ?p ?o }', 0.6)
+
+        self.assertEqual([entry['text'] for entry in self.logged], ['SELECT ?slow WHERE { ?slow ?p ?o }'])
+        self.assertEqual(self.logged[0]['type'], 'slow_query')
+
+    def test_middleware(self):
+        from django.test.client import RequestFactory
+        from django.http import HttpResponse
+
+        middleware = self.instrumentation.StoreInstrumentationMiddleware()
+        request = RequestFactory().get('/store/projects')
+
+        middleware.process_request(request)
+        self.instrumentation.record(self.instrumentation.QUERY, 'SELECT ...', 0.002, 100, 1000)
+        self.instrumentation.record(self.instrumentation.UPDATE, 'INSERT DATA ...', 0.02, 500)
+        response = middleware.process_response(request, HttpResponse('ok'))
+
+        self.assertEqual(response['X-Store-Queries'], '1')
+        self.assertEqual(response['X-Store-Updates'], '1')
+        self.assertEqual(response['X-Store-Bytes'], '1600')
+        self.assertTrue(self.instrumentation.current() is None)
+
+        [entry] = self.logged
+        self.assertEqual((entry['type'], entry['path'], entry['queries'], entry['status']), ('request', '/store/projects', 1, 200))
+        self.assertEqual(entry['latency_histogram']['<=0.005s'], 1)
+        self.assertEqual(entry['latency_histogram']['<=0.05s'], 1)
+
+    def test_middleware_streaming_response(self):
+        from django.test.client import RequestFactory
+        from django.http import StreamingHttpResponse
+
+        middleware = self.instrumentation.StoreInstrumentationMiddleware()
+        request = RequestFactory().get('/store/projects/export')
+
+        def view(request):
+            def content():
+                for i in range(3):
+                    # The body reads the store as it is sent
+                    self.instrumentation.record(self.instrumentation.QUERY, 'SELECT ...', 0.002, 100, 1000)
+                    yield 'chunk %d\n' % i
+            return StreamingHttpResponse(content())
+
+        middleware.process_request(request)
+        self.instrumentation.record(self.instrumentation.QUERY, 'SELECT ...', 0.002, 100, 1000)
+        response = middleware.process_response(request, view(request))
+
+        self.assertTrue(self.instrumentation.current() is None)
+        self.assertEqual(self.logged, [])
+        self.assertFalse(response.has_header('X-Store-Queries'))
+
+        self.assertEqual(''.join(response.streaming_content), 'chunk 0\nchunk 1\nchunk 2\n')
+        self.assertTrue(self.instrumentation.current() is None)
+
+        [entry] = self.logged
+        self.assertEqual((entry['type'], entry['path'], entry['queries'], entry['bytes_received']),
+                         ('request', '/store/projects/export', 4, 4000))
+
+class TestCopyToStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.old_store = rdfstore.SQLAlchemyStore(identifier=URIRef('http://example.org/store'))
+        self.old_store.open(Literal('sqlite:///%s' % os.path.join(self.directory, 'old.db')))
+        self.new_store = rdfstore.EmbeddedStore(identifier=URIRef('http://example.org/store'))
+        self.new_store.open(os.path.join(self.directory, 'new.db'))
+
+        self.identifiers = [URIRef('http://example.org/graphs/%d' % i) for i in range(4)]
+        for i, identifier in enumerate(self.identifiers):
+            g = Graph(self.old_store, identifier)
+            with self.old_store.batch():
+                for j in range(25 * (i + 1)):
+                    g.add((URIRef('http://example.org/s/%d' % j), NS.dc.title, Literal('%d in %d' % (j, i))))
+
+    def tearDown(self):
+        self.old_store.close()
+        self.new_store.destroy(self.new_store.path)
+        shutil.rmtree(self.directory)
+
+    def test_copies_graphs_in_chunks(self):
+        batches = []
+        self.new_store.write_listeners.append(batches.append)
+        copied = {}
+
+        total = rdfstore.copy_to_store(self.old_store, self.new_store, chunk_size=10, concurrency=2,
+                                       copied=lambda identifier, count: copied.__setitem__(identifier, count))
+
+        self.assertEqual(total, 250)
+        self.assertEqual(copied, dict((identifier, 25 * (i + 1)) for i, identifier in enumerate(self.identifiers)))
+        self.assertEqual(len(batches), 3 + 5 + 8 + 10)
+        for identifier in self.identifiers:
+            self.assertEqual(set(Graph(self.new_store, identifier)), set(Graph(self.old_store, identifier)))
+
+    def test_copying_again_is_harmless(self):
+        rdfstore.copy_to_store(self.old_store, self.new_store, self.identifiers[:1])
+        rdfstore.copy_to_store(self.old_store, self.new_store)
+
+        self.assertEqual(set(rdfstore.store_contexts(self.new_store)), set(self.identifiers))
+        self.assertEqual([len(Graph(self.new_store, identifier)) for identifier in self.identifiers], [25, 50, 75, 100])
+
+class TestGraphCatalog(EmbeddedStoreFixture, unittest.TestCase):
+    def setUp(self):
+        from semantic_store.graph_catalog import GraphCatalog
+        from semantic_store.models import GraphStatistics
+
+        GraphStatistics.objects.all().delete()
+        super(TestGraphCatalog, self).setUp()
+        self.catalog = GraphCatalog(self.store)
+
+        self.a = Graph(self.store, URIRef('http://example.org/graphs/a'))
+        self.b = Graph(self.store, URIRef('http://example.org/graphs/b'))
+        with self.store.batch():
+            for i in range(3):
+                self.a.add((URIRef('http://example.org/s/%d' % i), NS.dc.title, Literal(i)))
+            self.a.add((URIRef('http://example.org/s/0'), NS.rdf.type, NS.sc.Canvas))
+            self.b.add((URIRef('http://example.org/s/0'), NS.dc.title, Literal('b')))
+
+    def tearDown(self):
+        from semantic_store.models import GraphStatistics
+
+        GraphStatistics.objects.all().delete()
+        super(TestGraphCatalog, self).tearDown()
+
+    def test_counts_are_recounted_after_writes(self):
+        statistics = self.catalog.statistics(self.a.identifier)
+        self.assertEqual(statistics['triples'], 4)
+        self.assertEqual(statistics['predicates'], {unicode(NS.dc.title): 3, unicode(NS.rdf.type): 1})
+        self.assertTrue(statistics['modified'] is not None)
+
+        self.a.remove((None, NS.dc.title, None))
+        self.assertEqual(self.catalog.triples(self.a.identifier), 1)
+        self.assertEqual(self.catalog.triples(self.b.identifier), 1)
+
+    def test_predicates_are_only_counted_when_asked_for(self):
+        predicate_counts = self.catalog.predicate_counts
+        counted = []
+        def counting(identifier):
+            counted.append(identifier)
+            return predicate_counts(identifier)
+        self.catalog.predicate_counts = counting
+
+        self.assertEqual(self.catalog.triples(self.a.identifier), 4)
+        self.assertEqual(counted, [])
+
+        statistics = self.catalog.statistics(self.a.identifier)
+        self.assertEqual(statistics['predicates'], {unicode(NS.dc.title): 3, unicode(NS.rdf.type): 1})
+        self.assertEqual(len(counted), 1)
+
+        self.a.remove((None, NS.rdf.type, None))
+        self.assertEqual(self.catalog.triples(self.a.identifier), 3)
+        self.assertEqual(len(counted), 1)
+        self.assertEqual(self.catalog.statistics(self.a.identifier)['predicates'], {unicode(NS.dc.title): 3})
+        self.assertEqual(self.catalog.statistics(self.a.identifier)['triples'], 3)
+        self.assertEqual(len(counted), 2)
+
+    def test_concurrent_first_writes_share_an_entry(self):
+        from semantic_store.models import GraphStatistics
+
+        # As if another process created the entry after this one found none to update
+        mark_written = self.catalog._mark_written
+        calls = []
+        def racing(identifier, now):
+            calls.append(identifier)
+            return 0 if len(calls) == 1 else mark_written(identifier, now)
+        self.catalog._mark_written = racing
+
+        self.a.add((URIRef('http://example.org/s/3'), NS.dc.title, Literal(3)))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(list(GraphStatistics.objects.filter(identifier=unicode(self.a.identifier))
+                              .values_list('revision', flat=True)), [2])
+
+    def test_writes_while_counting_leave_the_counts_stale(self):
+        from semantic_store.models import GraphStatistics
+
+        count_triples = self.catalog.count_triples
+        def racing(identifier):
+            triples = count_triples(identifier)
+            # A write to the graph between counting it and saving the count
+            self.a.add((URIRef('http://example.org/s/3'), NS.dc.title, Literal(3)))
+            return triples
+        self.catalog.count_triples = racing
+
+        self.assertEqual(self.catalog.triples(self.a.identifier), 4)
+        self.assertTrue(GraphStatistics.objects.get(identifier=unicode(self.a.identifier)).stale)
+
+        self.catalog.count_triples = count_triples
+        self.assertEqual(self.catalog.triples(self.a.identifier), 5)
+
+    def test_lists_graphs_once_rebuilt(self):
+        self.assertFalse(self.catalog.is_complete())
+        self.catalog.rebuild(rdfstore.store_contexts(self.store))
+        self.assertTrue(self.catalog.is_complete())
+        self.assertEqual(self.catalog.graphs(), [self.a.identifier, self.b.identifier])
+
+        self.b.remove((None, None, None))
+        self.assertEqual(self.catalog.graphs(), [self.a.identifier])
+
+        rows = [('http://example.org/a', 'http://purl.org/dc/elements/1.1/title', 'A')]
+        with StandInSPARQLServer(rows) as server:
+            four_store = rdfstore.FourStore(server.url + 'sparql/', server.url + 'update/')
+            four_store.catalog = self.catalog
+
+            self.assertEqual(list(four_store.contexts()), [self.a.identifier])
+            self.assertEqual(len(Graph(four_store, self.a.identifier)), 4)
+            self.assertEqual(server.queries, [])
+
+class TestProjectMetadataMaintenance(EmbeddedStoreFixture, unittest.TestCase):
+    def setUp(self):
+        from semantic_store import project_metadata
+
+        super(TestProjectMetadataMaintenance, self).setUp()
+        self.project = URIRef('urn:uuid:%s' % uuid.uuid4())
+        self.canvas = URIRef('http://example.org/canvas')
+        self.image_anno = URIRef('http://example.org/image_anno')
+        self.image = URIRef('http://example.org/image')
+        self.metadata = project_metadata.ProjectMetadata(self.project, self.store)
+
+        with project_metadata.maintaining(self.project, self.store):
+            g = self.metadata.project_graph
+            g.add((self.project, NS.rdf.type, NS.dm.Project))
+            g.add((self.project, NS.dc.title, Literal('Project')))
+            g.add((self.project, NS.dcterms.created, Literal('today')))
+            g.add((self.project, NS.ore.aggregates, self.canvas))
+            g.add((self.canvas, NS.rdf.type, NS.sc.Canvas))
+            g.add((self.canvas, NS.dc.title, Literal('Canvas')))
+            g.add((self.image_anno, NS.rdf.type, NS.oa.Annotation))
+            g.add((self.image_anno, NS.oa.hasTarget, self.canvas))
+            g.add((self.image_anno, NS.oa.hasBody, self.image))
+            g.add((self.image, NS.rdf.type, NS.dcmitype.Image))
+
+    def assertConsistent(self):
+        self.assertEqual(self.metadata.check(), (set(), set()))
+
+    def test_writes_are_applied_to_the_metadata(self):
+        from semantic_store import project_metadata
+
+        metadata_graph = self.metadata.metadata_graph
+        self.assertConsistent()
+        self.assertTrue((self.project, NS.dc.title, Literal('Project')) in metadata_graph)
+        self.assertFalse((self.project, NS.dcterms.created, None) in metadata_graph)
+        self.assertTrue((self.image, NS.rdf.type, NS.dcmitype.Image) in metadata_graph)
+
+        with project_metadata.maintaining(self.project, self.store):
+            self.metadata.project_graph.set((self.image, NS.exif.width, Literal(100)))
+        self.assertTrue((self.image, NS.exif.width, Literal(100)) in metadata_graph)
+
+        with project_metadata.maintaining(self.project, self.store):
+            self.metadata.project_graph.remove((self.project, NS.ore.aggregates, self.canvas))
+        self.assertConsistent()
+        self.assertEqual(list(metadata_graph.triples((self.canvas, None, None))), [])
+        self.assertEqual(list(metadata_graph.triples((self.image, None, None))), [])
+
+    def test_only_drifted_triples_are_repaired(self):
+        metadata_graph = self.metadata.metadata_graph
+        metadata_graph.remove((self.canvas, NS.dc.title, None))
+        metadata_graph.add((self.canvas, NS.dc.title, Literal('Stale')))
+
+        missing, extra = self.metadata.check()
+        self.assertEqual(missing, set([(self.canvas, NS.dc.title, Literal('Canvas'))]))
+        self.assertEqual(extra, set([(self.canvas, NS.dc.title, Literal('Stale'))]))
+
+        batches = []
+        self.store.write_listeners.append(batches.append)
+        self.assertEqual(self.metadata.repair(), (1, 1))
+        self.assertEqual(len(batches), 1)
+        self.assertConsistent()
+        self.assertEqual(self.metadata.repair(), (0, 0))
+
+class TestStreamingExport(unittest.TestCase):
+    def setUp(self):
+        from semantic_store import uris
+
+        self.project = URIRef('urn:uuid:%s' % uuid.uuid4())
+        self.project_graph = Graph(rdfstore.rdfstore(), uris.uri('semantic_store_projects', uri=self.project))
+
+        self.g = graph()
+        self.g.add((self.project, NS.rdf.type, NS.dm.Project))
+        self.g.add((self.project, NS.dc.title, Literal(u'Caf\xe9 "project"\n')))
+        self.g.add((self.project, NS.dcterms.description, Literal('Description', lang='en')))
+        for i in range(30):
+            canvas = URIRef('http://example.org/canvas/%d' % i)
+            self.g.add((self.project, NS.ore.aggregates, canvas))
+            self.g.add((canvas, NS.exif.width, Literal(i)))
+        with rdfstore.rdfstore().batch():
+            self.project_graph += self.g
+
+    def tearDown(self):
+        self.project_graph.remove((None, None, None))
+
+    def parse(self, chunks, format):
+        g = Graph()
+        g.parse(data=''.join(chunks), format=format)
+        return g
+
+    def test_formats_round_trip(self):
+        from semantic_store import exports
+
+        for format in ('nt', 'turtle'):
+            chunks = list(exports.stream_project_export(self.project, format, buffer_size=256))
+            self.assertTrue(len(chunks) > 1)
+            self.assertEqual(set(self.parse(chunks, format)), set(self.g))
+
+        quads = ConjunctiveGraph()
+        quads.parse(data=''.join(exports.stream_project_export(self.project, 'nquads')), format='nquads')
+        self.assertEqual(set(quads.get_context(self.project_graph.identifier)), set(self.g))
+
+    def test_metadata_and_texts(self):
+        from django.contrib.auth.models import User
+        from semantic_store import exports, uris
+        from semantic_store.models import Text
+        from semantic_store.project_texts import overwrite_text_graph_from_model
+
+        metadata_graph = Graph(rdfstore.rdfstore(), uris.project_metadata_graph_identifier(self.project))
+        stale = (self.project, NS.dc.title, Literal('Stale'))
+        with rdfstore.rdfstore().batch():
+            metadata_graph += self.g.triples((self.project, None, None))
+            metadata_graph.add(stale)
+
+        user = User.objects.create(username='exporter-%s' % uuid.uuid4().hex[:20])
+        text = Text.objects.create(identifier='urn:uuid:%s' % uuid.uuid4(), project=self.project, last_user=user,
+                                   title='Text', content='<p>Text</p>')
+        try:
+            lines = ''.join(exports.stream_project_export(self.project, 'nt')).splitlines()
+            self.assertEqual(len(lines), len(set(lines)))
+            exported = self.parse('\n'.join(lines), 'nt')
+            self.assertEqual(set(exported) - set(self.g) - set([stale]),
+                             set(overwrite_text_graph_from_model(URIRef(text.identifier), self.project, Graph())))
+
+            quads = ConjunctiveGraph()
+            quads.parse(data=''.join(exports.stream_project_export(self.project, 'nquads')), format='nquads')
+            self.assertEqual(set(quads.get_context(metadata_graph.identifier)), set(metadata_graph))
+        finally:
+            metadata_graph.remove((None, None, None))
+            text.delete()
+            user.delete()
+
+    def test_gzip(self):
+        from semantic_store import exports
+        import zlib
+
+        compressed = ''.join(exports.stream_project_export(self.project, 'nt', compress=True))
+        data = zlib.decompress(compressed, 16 + zlib.MAX_WBITS)
+        self.assertEqual(data, ''.join(exports.stream_project_export(self.project, 'nt')))
+
+class TestConditionalGet(unittest.TestCase):
+    def setUp(self):
+        from semantic_store.models import GraphStatistics
+
+        GraphStatistics.objects.all().delete()
+        self.graph = Graph(rdfstore.rdfstore(), URIRef('urn:uuid:%s' % uuid.uuid4()))
+        self.graph.add((URIRef('http://example.org/s'), NS.dc.title, Literal('Title')))
+        self.calls = []
+
+    def tearDown(self):
+        from semantic_store.models import GraphStatistics
+
+        self.graph.remove((None, None, None))
+        GraphStatistics.objects.all().delete()
+
+    def get(self, **headers):
+        from django.test.client import RequestFactory
+        from django.http import HttpResponse
+        from semantic_store.conditional import conditional
+
+        @conditional(lambda request: ([self.graph.identifier], []))
+        def view(request):
+            self.calls.append(request)
+            return HttpResponse('graph')
+
+        return view(RequestFactory().get('/', **headers))
+
+    def test_not_modified_until_written(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.get(HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        self.assertEqual(len(self.calls), 1)
+
+        self.assertNotEqual(self.get(HTTP_ACCEPT='text/turtle')['ETag'], etag)
+
+        self.graph.add((URIRef('http://example.org/s'), NS.rdfs.label, Literal('Label')))
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_if_modified_since_is_ignored_with_if_none_match(self):
+        response = self.get()
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag, HTTP_IF_MODIFIED_SINCE='Thu, 01 Jan 1970 00:00:00 GMT')
+                         .status_code, 304)
+
+        # Written within the second of the last modification time
+        self.graph.add((URIRef('http://example.org/s'), NS.rdfs.label, Literal('Label')))
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 200)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"other"', HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 200)
+
+    def test_writes_through_other_stores_change_the_etag(self):
+        etag = self.get()['ETag']
+        rdfstore.rdfstore().catalog.bump([self.graph.identifier])
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+class TestProjectContents(unittest.TestCase):
+    def setUp(self):
+        from semantic_store.project_metadata import ProjectMetadata
+
+        self.project = URIRef('urn:uuid:%s' % uuid.uuid4())
+        self.metadata_graph = ProjectMetadata(self.project).metadata_graph
+        self.canvases = [URIRef('http://example.org/canvas/%d' % i) for i in range(5)]
+        self.text = URIRef('http://example.org/text')
+
+        with rdfstore.rdfstore().batch():
+            self.metadata_graph.add((self.project, NS.dc.title, Literal('Project')))
+            for canvas in self.canvases:
+                self.metadata_graph.add((self.project, NS.ore.aggregates, canvas))
+                self.metadata_graph.add((canvas, NS.rdf.type, NS.sc.Canvas))
+                self.metadata_graph.add((canvas, NS.dc.title, Literal(canvas[-1])))
+            self.metadata_graph.add((self.project, NS.ore.aggregates, self.text))
+            self.metadata_graph.add((self.text, NS.rdf.type, NS.dcmitype.Text))
+
+    def tearDown(self):
+        self.metadata_graph.remove((None, None, None))
+
+    def test_pages_follow_cursors(self):
+        from semantic_store.project_contents import contents_page
+
+        pages = []
+        cursor = None
+        while True:
+            graph, cursor = contents_page(self.project, cursor, limit=2)
+            pages.append(sorted(graph.objects(self.project, NS.ore.aggregates)))
+            if cursor is None:
+                break
+
+        self.assertEqual(pages, [self.canvases[0:2], self.canvases[2:4], [self.canvases[4], self.text]])
+        self.assertEqual(graph.value(self.text, NS.rdf.type), NS.dcmitype.Text)
+        self.assertEqual(graph.value(self.canvases[4], NS.dc.title), Literal('4'))
+        self.assertFalse((self.canvases[0], None, None) in graph)
+
+        graph, cursor = contents_page(self.project, types=[NS.dcmitype.Text])
+        self.assertEqual(list(graph.objects(self.project, NS.ore.aggregates)), [self.text])
+        self.assertEqual(cursor, None)
+
+    def test_aggregates_are_limited_in_the_query(self):
+        from semantic_store.project_contents import aggregates_after
+
+        self.assertTrue('LIMIT 3' in queries.registry['aggregates_after'].render(
+            project_uri=self.project, after=Literal(''), limit=3))
+        self.assertEqual(aggregates_after(self.metadata_graph, self.project, Literal(''), 3), self.canvases[0:3])
+        self.assertEqual(aggregates_after(self.metadata_graph, self.project, Literal(self.canvases[3]), 3,
+                                          [NS.sc.Canvas, NS.dcmitype.Text]), [self.canvases[4], self.text])
+        self.assertRaises(queries.BindingError, aggregates_after, self.metadata_graph, self.project, Literal(''), -1)
+
+    def test_summary_counts(self):
+        from semantic_store.project_contents import contents_summary
+
+        graph = contents_summary(self.project)
+        self.assertEqual(graph.value(self.project, NS.dc.title), Literal('Project'))
+        self.assertEqual(graph.value(self.project, NS.void.entities).toPython(), 6)
+
+        counts = dict((graph.value(partition, NS.void['class']), graph.value(partition, NS.void.entities).toPython())
+                      for partition in graph.objects(self.project, NS.void.classPartition))
+        self.assertEqual(counts, {NS.sc.Canvas: 5, NS.dcmitype.Text: 1})
+
+class TestProjectChangelog(EmbeddedStoreFixture, unittest.TestCase):
+    def setUp(self):
+        from semantic_store import uris
+        from semantic_store.changelog import ProjectChangelog
+        from semantic_store.models import ProjectChange
+
+        ProjectChange.objects.all().delete()
+        super(TestProjectChangelog, self).setUp()
+        self.changelog = ProjectChangelog(self.store)
+
+        self.project = URIRef('urn:uuid:%s' % uuid.uuid4())
+        self.graph = Graph(self.store, uris.uri('semantic_store_projects', uri=self.project))
+        self.metadata_graph = Graph(self.store, uris.project_metadata_graph_identifier(self.project))
+        self.canvas = URIRef('http://example.org/canvas')
+
+    def tearDown(self):
+        from semantic_store.models import ProjectChange
+
+        ProjectChange.objects.all().delete()
+        super(TestProjectChangelog, self).tearDown()
+
+    def apply(self, graph, patch):
+        for line in patch.splitlines():
+            if line.startswith('A ') or line.startswith('D '):
+                g = Graph()
+                g.parse(data=line[2:].encode('utf-8'), format='nt')
+                for t in g:
+                    if line.startswith('A '):
+                        graph.add(t)
+                    else:
+                        graph.remove(t)
+
+    def test_delta_brings_a_copy_up_to_date(self):
+        from semantic_store import changelog
+
+        self.graph.add((self.canvas, NS.dc.title, Literal('First')))
+        revision, patch = self.changelog.changes_since(self.project, 0)
+        self.assertEqual(revision, self.changelog.revision(self.project))
+        copy = Graph()
+        self.apply(copy, patch)
+
+        with self.store.batch():
+            self.graph.set((self.canvas, NS.dc.title, Literal('Second')))
+            self.graph.add((self.canvas, NS.exif.width, Literal(100)))
+            self.metadata_graph.add((self.canvas, NS.dc.title, Literal('Second')))
+
+        new_revision, patch = self.changelog.changes_since(self.project, revision)
+        self.assertTrue(new_revision > revision)
+        self.assertEqual(patch.count('TX .'), 1)
+        self.apply(copy, patch)
+        self.assertEqual(set(copy), set(self.graph))
+
+        self.assertEqual(self.changelog.changes_since(self.project, new_revision), (new_revision, u''))
+
+        self.graph.remove((None, None, None))
+        self.assertRaises(changelog.ChangesTruncated, self.changelog.changes_since, self.project, new_revision)
+
+    def test_compaction_truncates_old_revisions(self):
+        from semantic_store import changelog
+        from django.utils import timezone
+
+        for i in range(3):
+            self.graph.add((self.canvas, NS.exif.width, Literal(i)))
+        revision = self.changelog.revision(self.project)
+
+        self.assertEqual(self.changelog.compact(timezone.now() + datetime.timedelta(seconds=1)), 2)
+        self.assertEqual(self.changelog.changes_since(self.project, revision), (revision, u''))
+        self.assertRaises(changelog.ChangesTruncated, self.changelog.changes_since, self.project, revision - 1)
+
+    def test_writes_to_a_project_are_logged_one_at_a_time(self):
+        events, threads = [], []
+        def writing(batch):
+            # Another writer of the project waits until this write has been logged
+            def write():
+                with self.changelog.locked(batch):
+                    events.append('other write')
+            thread = threading.Thread(target=write)
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+            threads.append(thread)
+        self.store.before_write_listeners.insert(0, writing)
+        self.store.write_listeners.append(lambda batch: events.append('logged'))
+
+        self.graph.add((self.canvas, NS.exif.width, Literal(1)))
+        threads[0].join(5)
+        self.assertEqual(events, ['logged', 'other write'])
+        self.assertEqual(self.changelog.changes_since(self.project, 0)[1].count('TX .'), 1)
+
+class TestProjectGarbageCollection(EmbeddedStoreFixture, unittest.TestCase):
+    def setUp(self):
+        from semantic_store import uris
+        from semantic_store.graph_catalog import GraphCatalog
+        from semantic_store.models import GraphStatistics, ProjectCollection
+
+        GraphStatistics.objects.all().delete()
+        ProjectCollection.objects.all().delete()
+        super(TestProjectGarbageCollection, self).setUp()
+        self.store.catalog = GraphCatalog(self.store)
+
+        self.project = URIRef('urn:uuid:%s' % uuid.uuid4())
+        self.graph = Graph(self.store, uris.uri('semantic_store_projects', uri=self.project))
+
+        canvas = URIRef('http://example.org/canvas')
+        self.graph.add((self.project, NS.ore.aggregates, canvas))
+        self.graph.add((canvas, NS.rdf.type, NS.sc.Canvas))
+        self.kept, anno, body, target = annotation(graph(), URIRef('http://example.org/anno'), canvas)
+        self.kept, resource, selector = svg_specific_resource(canvas, self.kept,
+                                                              URIRef('http://example.org/resource'),)
+        self.graph += self.kept
+
+        self.orphans, anno, body, target = annotation(graph(), URIRef('http://example.org/orphan'),
+                                                      URIRef('http://example.org/deleted'))
+        self.orphans, resource, selector = svg_specific_resource(URIRef('http://example.org/deleted'), self.orphans,
+                                                                 URIRef('http://example.org/orphaned_resource'))
+        self.graph += self.orphans
+
+    def tearDown(self):
+        from semantic_store.models import GraphStatistics, ProjectCollection
+
+        GraphStatistics.objects.all().delete()
+        ProjectCollection.objects.all().delete()
+        super(TestProjectGarbageCollection, self).tearDown()
+
+    def test_reports_then_removes_orphans(self):
+        from semantic_store import project_gc
+
+        self.assertTrue(project_gc.is_due(self.project, self.store))
+        orphans, removed = project_gc.collect(self.project, store=self.store)
+        self.assertEqual(len(orphans), len(self.orphans))
+        self.assertEqual(removed, 0)
+        self.assertEqual(len(self.graph), len(self.kept) + len(self.orphans) + 2)
+
+        orphans, removed = project_gc.collect(self.project, delete=True, batch_size=2, store=self.store)
+        self.assertEqual(removed, len(self.orphans))
+        self.assertEqual(len(self.graph), len(self.kept) + 2)
+        self.assertFalse(project_gc.is_due(self.project, self.store))
+
+        self.graph.add((self.project, NS.dc.title, Literal('Written')))
+        self.assertTrue(project_gc.is_due(self.project, self.store))
+
+    def test_collects_highlights_removed_from_a_text(self):
+        from django.contrib.auth.models import User
+        from semantic_store import project_gc
+        from semantic_store.models import Text
+
+        text = URIRef('http://example.org/text')
+        highlighted = URIRef('http://example.org/highlighted')
+        removed = URIRef('http://example.org/removed')
+
+        highlights = graph()
+        highlights.add((self.project, NS.ore.aggregates, text))
+        highlights.add((text, NS.rdf.type, NS.dctypes.Text))
+        highlights, kept_resource, kept_selector = specific_resource(text, highlights, res=URIRef('http://example.org/kept_highlight'),
+                                                                     selector=highlighted)
+        highlights, removed_resource, removed_selector = specific_resource(text, highlights,
+                                                                           res=URIRef('http://example.org/removed_highlight'),
+                                                                           selector=removed)
+        for selector in (highlighted, removed):
+            highlights.add((selector, NS.rdf.type, NS.oa.TextQuoteSelector))
+        highlights, anno, body, target = annotation(highlights, URIRef('http://example.org/highlight_anno'), removed_resource)
+        self.graph += highlights
+
+        user = User.objects.create(username='highlighter-%s' % uuid.uuid4().hex[:20])
+        Text.objects.create(identifier=text, project=self.project, last_user=user,
+                            content='<p>A <span class="atb-editor-textannotation" about="%s">highlight</span></p>' % highlighted)
+        try:
+            orphans = set(project_gc.orphaned_triples(self.graph, self.project))
+        finally:
+            Text.objects.filter(identifier=text).delete()
+            user.delete()
+
+        self.assertEqual(set(t[0] for t in orphans) - set(t[0] for t in self.orphans),
+                         set([removed_resource, removed, anno]))
+        self.assertFalse(any(t[0] in (text, kept_resource, highlighted) for t in orphans))
+
+class TestProjectDeletion(EmbeddedStoreFixture, unittest.TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from semantic_store import uris
+        from semantic_store.models import ProjectPermission, Text
+
+        super(TestProjectDeletion, self).setUp()
+
+        self.project = URIRef('urn:uuid:%s' % uuid.uuid4())
+        self.user = User.objects.create(username='deleter-%s' % uuid.uuid4().hex[:20])
+        ProjectPermission.objects.create(identifier=self.project, user=self.user, permission='a')
+        for i in range(3):
+            Text.objects.create(identifier='urn:uuid:%s' % uuid.uuid4(), project=self.project, last_user=self.user,
+                                content='<html><body>Text %d</body></html>' % i)
+
+        self.graph = Graph(self.store, uris.uri('semantic_store_projects', uri=self.project))
+        self.metadata_graph = Graph(self.store, uris.project_metadata_graph_identifier(self.project))
+        self.other = Graph(self.store, URIRef('http://example.org/other'))
+        canvas = URIRef('http://example.org/canvas')
+        for graph in (self.graph, self.metadata_graph):
+            graph.add((self.project, NS.ore.aggregates, canvas))
+            graph.add((canvas, NS.rdf.type, NS.sc.Canvas))
+        self.other.add((canvas, NS.rdf.type, NS.sc.Canvas))
+
+    def tearDown(self):
+        from semantic_store.models import ProjectPermission, ProjectDeletion, Text
+
+        Text.objects.filter(project=self.project).delete()
+        ProjectPermission.objects.filter(identifier=self.project).delete()
+        ProjectDeletion.objects.filter(identifier=self.project).delete()
+        self.user.delete()
+        super(TestProjectDeletion, self).tearDown()
+
+    def test_deletion_cascades_in_steps(self):
+        from semantic_store import project_deletion
+        from semantic_store.models import ProjectPermission, ProjectDeletion, Text
+
+        deletion = ProjectDeletion.objects.create(identifier=self.project, requested_by=self.user)
+        deletion = project_deletion.run(deletion, self.store)
+
+        self.assertEqual(deletion.state, ProjectDeletion.DONE, deletion.error)
+        self.assertEqual(deletion.completed_steps, len(project_deletion.STEPS))
+        status = project_deletion.status(deletion)
+        self.assertEqual(status['removed']['texts'], 3)
+        self.assertEqual(status['removed']['graphs'], 4)
+        self.assertEqual(status['removed']['permissions'], 1)
+
+        self.assertEqual(len(self.graph), 0)
+        self.assertEqual(len(self.metadata_graph), 0)
+        self.assertEqual(len(self.other), 1)
+        self.assertFalse(Text.objects.filter(project=self.project).exists())
+        self.assertFalse(ProjectPermission.objects.filter(identifier=self.project).exists())
+
+    def test_failed_deletion_resumes_from_its_step(self):
+        from semantic_store import project_deletion
+        from semantic_store.models import ProjectDeletion
+
+        def fail(project_uri, store, report):
+            raise ValueError('Interrupted')
+
+        steps = list(project_deletion.STEPS)
+        project_deletion.STEPS.insert(3, ('failing', fail))
+        try:
+            deletion = project_deletion.run(ProjectDeletion.objects.create(identifier=self.project), self.store)
+        finally:
+            project_deletion.STEPS[:] = steps
+
+        self.assertEqual(deletion.state, ProjectDeletion.FAILED)
+        self.assertEqual(deletion.completed_steps, 3)
+        self.assertTrue('Interrupted' in deletion.error)
+        self.assertEqual(len(self.graph), 2)
+
+        deletion = project_deletion.run(deletion, self.store)
+        self.assertEqual(deletion.state, ProjectDeletion.DONE, deletion.error)
+        self.assertEqual(len(self.graph), 0)
+
+class TestDeltaWrites(EmbeddedStoreFixture, unittest.TestCase):
+    def setUp(self):
+        super(TestDeltaWrites, self).setUp()
+        self.batches = []
+        self.store.write_listeners.append(self.batches.append)
+
+        self.graph = Graph(self.store, URIRef('http://example.org/project'))
+        self.canvas = URIRef('http://example.org/canvas')
+        self.input = Graph()
+        self.input.add((self.canvas, NS.rdf.type, NS.sc.Canvas))
+        self.input.add((self.canvas, NS.dc.title, Literal('First')))
+        self.input.add((self.canvas, NS.exif.width, Literal(100)))
+
+    def test_unchanged_graph_is_not_written(self):
+        from semantic_store import deltas
+
+        delta = deltas.patch(self.graph, self.input)
+        self.assertEqual((len(delta.added), len(delta.removed)), (3, 0))
+        self.assertEqual(len(self.batches), 1)
+
+        delta = deltas.patch(self.graph, self.input, [(self.canvas, NS.dc.title)])
+        self.assertEqual(len(delta), 0)
+        self.assertEqual(len(self.batches), 1)
+
+    def test_replaced_values_are_removed(self):
+        from semantic_store import deltas
+
+        deltas.patch(self.graph, self.input)
+        self.graph.add((self.canvas, NS.rdfs.label, Literal('Label')))
+
+        changed = Graph()
+        changed.add((self.canvas, NS.dc.title, Literal('Second')))
+        changed.add((self.canvas, NS.exif.width, Literal(100)))
+        delta = deltas.patch(self.graph, changed, [(self.canvas, NS.dc.title), (self.canvas, NS.rdfs.label)])
+
+        self.assertEqual(delta.added, [(self.canvas, NS.dc.title, Literal('Second'))])
+        self.assertEqual(delta.removed, [(self.canvas, NS.dc.title, Literal('First'))])
+        self.assertEqual(self.graph.value(self.canvas, NS.rdfs.label), Literal('Label'))
+        self.assertEqual(len(self.graph), 4)
+
+class TestProjectUsers(unittest.TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from semantic_store.models import ProjectPermission
+
+        self.project = URIRef('urn:uuid:%s' % uuid.uuid4())
+        self.users = [User.objects.create(username='member-%s' % uuid.uuid4().hex[:20], first_name='Member')
+                      for i in range(2)]
+        for permission in 'rwa':
+            ProjectPermission.objects.create(identifier=self.project, user=self.users[0], permission=permission)
+        ProjectPermission.objects.create(identifier=self.project, user=self.users[1], permission='r')
+
+    def tearDown(self):
+        from semantic_store.models import ProjectPermission
+
+        ProjectPermission.objects.filter(identifier=self.project).delete()
+        for user in self.users:
+            user.delete()
+
+    def test_permissions_are_grouped_by_user(self):
+        from semantic_store import users
+
+        by_user = users.permissions_by_user(self.project)
+        self.assertEqual(sorted(by_user.values()), [['a', 'r', 'w'], ['r']])
+
+        graph = users.project_users_graph(self.project, by_user)
+        owner = users.user_uri(user=self.users[0])
+        self.assertEqual(set(graph.predicates(owner, self.project)),
+                         set([NS.perm.hasPermissionOver, NS.perm.mayRead, NS.perm.mayUpdate, NS.perm.mayAdminister]))
+        self.assertEqual(len(list(graph.triples((owner, NS.rdf.type, None)))), 1)
+
+    def test_cached_metadata_is_forgotten_on_save(self):
+        from semantic_store import users
+
+        owner = users.user_uri(user=self.users[0])
+        triples = users.cached_user_metadata(self.users)[0]
+        self.assertTrue((owner, NS.foaf.firstName, Literal('Member')) in triples)
+
+        self.users[0].first_name = 'Renamed'
+        self.users[0].save()
+        triples = users.cached_user_metadata(self.users)[0]
+        self.assertTrue((owner, NS.foaf.firstName, Literal('Renamed')) in triples)
+
+class TestCanvasViews(EmbeddedStoreFixture, unittest.TestCase):
+    def setUp(self):
+        from semantic_store import uris, canvas_views
+        from semantic_store.project_metadata import ProjectMetadata
+
+        super(TestCanvasViews, self).setUp()
+        canvas_views.CanvasViews(self.store)
+
+        self.project = URIRef('urn:uuid:%s' % uuid.uuid4())
+        self.canvas = URIRef('http://example.org/canvas')
+        self.graph = Graph(self.store, uris.uri('semantic_store_projects', uri=self.project))
+        self.view_graph = Graph(self.store, uris.canvas_view_graph_identifier(self.project, self.canvas))
+
+        g, anno, body, target = annotation(graph(), URIRef('http://example.org/image_anno'), self.canvas,
+                                           URIRef('http://example.org/image'))
+        g.add((self.project, NS.ore.aggregates, self.canvas))
+        g.add((self.canvas, NS.rdf.type, NS.sc.Canvas))
+        g.add((self.canvas, NS.dc.title, Literal('Canvas')))
+        g.add((URIRef('http://example.org/other'), NS.dc.title, Literal('Other')))
+        self.graph += g
+        ProjectMetadata(self.project, self.store).repair()
+
+    def tearDown(self):
+        from semantic_store.models import CanvasView
+
+        for view in CanvasView.objects.filter(project=self.project):
+            view.resources.all().delete()
+            view.delete()
+        super(TestCanvasViews, self).tearDown()
+
+    def is_materialised(self):
+        from semantic_store.models import CanvasView
+
+        return CanvasView.objects.filter(project=self.project, canvas=self.canvas).exists()
+
+    def test_views_are_served_until_a_write_touches_them(self):
+        from semantic_store import canvas_views
+
+        view = canvas_views.read(self.project, self.canvas, self.store)
+        self.assertTrue((self.canvas, NS.dc.title, Literal('Canvas')) in view)
+        self.assertTrue(self.is_materialised())
+        self.assertEqual(set(self.view_graph), set(view))
+
+        self.graph.set((URIRef('http://example.org/other'), NS.dc.title, Literal('Changed')))
+        self.assertTrue(self.is_materialised())
+
+        new_anno = URIRef('http://example.org/new_anno')
+        self.graph += annotation(graph(), new_anno, self.canvas, URIRef('http://example.org/comment'))[0]
+        self.assertFalse(self.is_materialised())
+        self.assertEqual(len(self.view_graph), 0)
+
+        view = canvas_views.read(self.project, self.canvas, self.store)
+        self.assertTrue((new_anno, NS.oa.hasTarget, self.canvas) in view)
+
+        self.graph.set((URIRef('http://example.org/comment'), NS.dc.title, Literal('Comment')))
+        self.assertFalse(self.is_materialised())
+
+    def test_views_dropped_while_read_are_built_again(self):
+        from semantic_store import canvas_views
+
+        canvas_views.read(self.project, self.canvas, self.store)
+        # As a reader sees a view between its record being checked and its graph being dropped
+        self.store.drop_graph(self.view_graph)
+        self.assertTrue(self.is_materialised())
+
+        view = canvas_views.read(self.project, self.canvas, self.store)
+        self.assertTrue((self.canvas, NS.dc.title, Literal('Canvas')) in view)
+        self.assertEqual(set(self.view_graph), set(view))
+
+        self.store.drop_graph(self.view_graph)
+        [(canvas, batch_view)] = canvas_views.read_many(self.project, [self.canvas], self.store)
+        self.assertEqual(set(batch_view), set(view))
+
+    def test_views_are_only_stored_for_held_canvases(self):
+        from semantic_store import canvas_views
+        from semantic_store.models import CanvasView
+
+        other = URIRef('http://example.org/other')
+        view = canvas_views.read(self.project, other, self.store)
+        self.assertTrue((other, NS.dc.title, Literal('Other')) in view)
+        canvas_views.read_many(self.project, [self.canvas, other, URIRef('http://example.org/missing')], self.store)
+        self.assertEqual(list(CanvasView.objects.filter(project=self.project).values_list('canvas', flat=True)),
+                         [unicode(self.canvas)])
+
+class TestCanvasBatch(EmbeddedStoreFixture, unittest.TestCase):
+    def setUp(self):
+        from semantic_store import uris, canvas_views
+        from semantic_store.project_metadata import ProjectMetadata
+
+        super(TestCanvasBatch, self).setUp()
+        canvas_views.CanvasViews(self.store)
+
+        self.project = URIRef('urn:uuid:%s' % uuid.uuid4())
+        self.graph = Graph(self.store, uris.uri('semantic_store_projects', uri=self.project))
+
+        self.manuscript = URIRef('http://example.org/manuscript')
+        self.sequence = URIRef('http://example.org/sequence')
+        self.canvases = [URIRef('http://example.org/canvas/%d' % i) for i in range(5)]
+
+        g = graph()
+        g.add((self.manuscript, NS.sc.hasSequences, Collection(g, BNode(), [self.sequence]).uri))
+        g.add((self.sequence, NS.sc.hasCanvases, Collection(g, BNode(), self.canvases).uri))
+        for i, canvas in enumerate(self.canvases):
+            g.add((self.project, NS.ore.aggregates, canvas))
+            g.add((canvas, NS.rdf.type, NS.sc.Canvas))
+            g.add((canvas, NS.dc.title, Literal('Page %d' % i)))
+            annotation(g, URIRef('http://example.org/anno/%d' % i), canvas, URIRef('http://example.org/body/%d' % i))
+        self.graph += g
+        ProjectMetadata(self.project, self.store).repair()
+
+    def tearDown(self):
+        from semantic_store.models import CanvasView
+
+        for view in CanvasView.objects.filter(project=self.project):
+            view.resources.all().delete()
+            view.delete()
+        super(TestCanvasBatch, self).tearDown()
+
+    def test_batches_read_the_same_graphs_as_single_canvases(self):
+        from semantic_store import canvas_views
+        from semantic_store.canvases import generate_canvas_graph
+        from semantic_store.models import CanvasView
+
+        # One view is stored already, the rest are built together
+        canvas_views.read(self.project, self.canvases[2], self.store)
+
+        views = list(canvas_views.iter_views(self.project, self.canvases, 2, self.store))
+        self.assertEqual([canvas for canvas, view in views], self.canvases)
+        for canvas, view in views:
+            self.assertEqual(set(view), set(generate_canvas_graph(self.project, canvas, self.store)))
+        self.assertEqual(CanvasView.objects.filter(project=self.project).count(), len(self.canvases))
+
+        self.graph.set((self.canvases[0], NS.dc.title, Literal('Changed')))
+        views = canvas_views.read_many(self.project, self.canvases[:2], self.store)
+        self.assertTrue((self.canvases[0], NS.dc.title, Literal('Changed')) in views[0][1])
+
+    def test_sequence_ranges(self):
+        from semantic_store import manuscripts
+
+        self.assertEqual(manuscripts.first_sequence(self.graph, self.manuscript), self.sequence)
+        self.assertEqual(manuscripts.sequence_canvas_range(self.graph, self.sequence, 1, 2), self.canvases[1:3])
+        self.assertEqual(manuscripts.sequence_canvas_range(self.graph, self.sequence, 3), self.canvases[3:])
+        self.assertEqual(manuscripts.sequence_canvas_range(self.graph, self.sequence, 10, 2), [])
+
+class TestImageDerivatives(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_pyramid_and_thumbnails(self):
+        from semantic_store import image_derivatives
+        from PIL import Image
+
+        description = image_derivatives.generate(Image.new('RGB', (600, 300)), self.directory, 256, (100, 400))
+        self.assertEqual(description['scale_factors'], [1, 2, 4])
+        self.assertEqual(description['thumbnails'], {100: (100, 50), 400: (400, 200)})
+
+        tiles = dict((factor, sorted(os.listdir(os.path.join(self.directory, 'tiles', str(factor)))))
+                     for factor in description['scale_factors'])
+        self.assertEqual(tiles, {
+            1: ['0_0.jpg', '0_1.jpg', '1_0.jpg', '1_1.jpg', '2_0.jpg', '2_1.jpg'],
+            2: ['0_0.jpg', '1_0.jpg'],
+            4: ['0_0.jpg'],
+        })
+        self.assertEqual(Image.open(os.path.join(self.directory, 'tiles', '1', '2_1.jpg')).size, (88, 44))
+        self.assertEqual(Image.open(os.path.join(self.directory, 'thumbnails', '400.jpg')).size, (400, 200))
+
+    def test_derivatives_are_described_with_the_canvas(self):
+        from semantic_store import image_derivatives, uris
+        from semantic_store.canvases import generate_canvas_graph
+
+        store = rdfstore.EmbeddedStore(identifier=URIRef('http://example.org/store'))
+        store.open(os.path.join(self.directory, 'quads.db'))
+        try:
+            project = URIRef('urn:uuid:%s' % uuid.uuid4())
+            canvas, image = URIRef('http://example.org/canvas'), URIRef('http://example.org/image.jpg')
+            project_graph = Graph(store, uris.uri('semantic_store_projects', uri=project))
+
+            g = annotation(graph(), URIRef('http://example.org/image_anno'), canvas, image)[0]
+            g.add((canvas, NS.rdf.type, NS.sc.Canvas))
+            g.add((image, NS.rdf.type, NS.dcmitype.Image))
+            project_graph += g
+
+            base_uri = 'http://example.org/derived/1/'
+            description = {'width': 600, 'height': 300, 'tile_size': 256, 'scale_factors': [1, 2, 4],
+                           'thumbnails': {100: (100, 50)}}
+            image_derivatives.record(image, image_derivatives.description_graph(image, base_uri, description),
+                                     base_uri, store)
+            description['scale_factors'] = [1, 2]
+            image_derivatives.record(image, image_derivatives.description_graph(image, base_uri, description),
+                                     base_uri, store)
+
+            pyramid = URIRef(base_uri + 'tiles/')
+            canvas_graph = generate_canvas_graph(project, canvas, store)
+            self.assertTrue((image, NS.foaf.thumbnail, URIRef(base_uri + 'thumbnails/100.jpg')) in canvas_graph)
+            self.assertTrue((URIRef(base_uri + 'thumbnails/100.jpg'), NS.exif.width, Literal(100)) in canvas_graph)
+            self.assertTrue((image, NS.sc.hasRelatedService, pyramid) in canvas_graph)
+            self.assertEqual(sorted(canvas_graph.objects(pyramid, NS.dm.scaleFactor)), [Literal(1), Literal(2)])
+        finally:
+            store.destroy(store.path)
+
+    def test_generations_running_too_long_are_requested_again(self):
+        from django.contrib.auth.models import User
+        from django.test.utils import override_settings
+        from django.utils import timezone
+        from semantic_store import image_derivatives
+        from semantic_store.models import ImageDerivatives, UploadedImage
+
+        owner = User.objects.create(username='uploader-%s' % uuid.uuid4().hex[:20])
+        uploaded_image = UploadedImage.objects.create(imagefile='user_images/uploaded_images/%s.jpg' % uuid.uuid4(),
+                                                      owner=owner)
+        derivatives = ImageDerivatives.objects.create(image=uploaded_image, state=ImageDerivatives.RUNNING,
+                                                      started=timezone.now())
+        try:
+            with override_settings(IMAGE_DERIVATIVES_IN_BACKGROUND=False, IMAGE_DERIVATIVES_TIMEOUT=60):
+                self.assertEqual(image_derivatives.request_derivatives(uploaded_image).state, ImageDerivatives.RUNNING)
+                self.assertFalse(image_derivatives.retryable().filter(pk=derivatives.pk).exists())
+
+                ImageDerivatives.objects.filter(pk=derivatives.pk).update(
+                    started=timezone.now() - datetime.timedelta(seconds=61))
+                self.assertTrue(image_derivatives.retryable().filter(pk=derivatives.pk).exists())
+                self.assertEqual(image_derivatives.request_derivatives(uploaded_image).state, ImageDerivatives.PENDING)
+        finally:
+            ImageDerivatives.objects.filter(pk=derivatives.pk).delete()
+            uploaded_image.delete()
+            owner.delete()
+
+class TestIIIFImageServer(unittest.TestCase):
+    def setUp(self):
+        from PIL import Image
+
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'image.jpg')
+        image = Image.new('RGB', (600, 300), (255, 0, 0))
+        image.paste((0, 0, 255), (300, 0, 600, 300))
+        image.save(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def render(self, derivatives, *parameters):
+        from semantic_store import iiif
+        from PIL import Image
+        import StringIO
+
+        request = iiif.ImageRequest(600, 300, *parameters)
+        return Image.open(StringIO.StringIO(iiif.render(self.path, derivatives, request)))
+
+    def test_parameters(self):
+        from semantic_store import iiif
+
+        self.assertEqual(iiif.parse_region('full', 600, 300), (0, 0, 600, 300))
+        self.assertEqual(iiif.parse_region('500,100,200,100', 600, 300), (500, 100, 100, 100))
+        self.assertEqual(iiif.parse_region('pct:50,0,50,50', 600, 300), (300, 0, 300, 150))
+        self.assertRaises(iiif.ImageRequestError, iiif.parse_region, '700,0,10,10', 600, 300)
+
+        self.assertEqual(iiif.parse_size('150,', 600, 300), (150, 75))
+        self.assertEqual(iiif.parse_size(',100', 600, 300), (200, 100))
+        self.assertEqual(iiif.parse_size('pct:10', 600, 300), (60, 30))
+        self.assertEqual(iiif.parse_size('!100,100', 600, 300), (100, 50))
+        self.assertRaises(iiif.ImageRequestError, iiif.parse_size, '!100,', 600, 300)
+        self.assertEqual(iiif.parse_size('!1000,1000', 600, 300), (600, 300))
+        self.assertRaises(iiif.UnsupportedParameter, iiif.parse_size, '100000,100000', 600, 300)
+        self.assertRaises(iiif.UnsupportedParameter, iiif.parse_size, 'pct:200', 600, 300)
+        self.assertRaises(iiif.ImageRequestError, iiif.parse_size, 'full', 600, 300, 500, 500)
+
+        self.assertEqual(iiif.parse_rotation('!90'), (True, 90))
+        self.assertRaises(iiif.ImageRequestError, iiif.parse_rotation, '400')
+        self.assertRaises(iiif.UnsupportedParameter, iiif.ImageRequest, 600, 300, 'full', 'full', '0', 'default', 'jp2')
+
+    def test_images_are_read_from_derivatives_or_the_original(self):
+        from semantic_store import image_derivatives
+        from PIL import Image
+
+        derivatives_directory = os.path.join(self.directory, 'derived')
+        description = image_derivatives.generate(Image.open(self.path), derivatives_directory, 256, (100,))
+
+        for derivatives in (None, (derivatives_directory, description)):
+            image = self.render(derivatives, '300,0,300,300', '30,', '90', 'default', 'png')
+            self.assertEqual(image.size, (30, 30))
+            self.assertEqual(image.convert('RGB').getpixel((15, 15))[2] > 200, True)
+
+            image = self.render(derivatives, 'full', '100,', '0', 'gray', 'jpg')
+            self.assertEqual((image.size, image.mode), ((100, 50), 'L'))
+
+            image = self.render(derivatives, '0,0,300,300', 'full', '!0', 'default', 'jpg')
+            self.assertEqual(image.size, (300, 300))
+            self.assertTrue(image.getpixel((150, 150))[0] > 200)
+
+    def test_private_images_are_read_through_projects(self):
+        from django.contrib.auth.models import User, AnonymousUser
+        from semantic_store import iiif, uris
+        from semantic_store.models import ProjectPermission, UploadedImage
+
+        store = rdfstore.EmbeddedStore(identifier=URIRef('http://example.org/store'))
+        store.open(os.path.join(self.directory, 'quads.db'))
+        owner, reader, stranger = [User.objects.create(username='%s-%s' % (name, uuid.uuid4().hex[:20]))
+                                   for name in ('owner', 'reader', 'stranger')]
+        uploaded_image = UploadedImage.objects.create(imagefile='user_images/uploaded_images/%s.jpg' % uuid.uuid4(),
+                                                      owner=owner)
+        project = URIRef('urn:uuid:%s' % uuid.uuid4())
+        try:
+            Graph(store, uris.uri('semantic_store_projects', uri=project)).add(
+                (uris.absolutize(uploaded_image.imagefile.url), NS.rdf.type, NS.dcmitype.Image))
+            ProjectPermission.objects.create(identifier=project, user=reader, permission='r')
+
+            self.assertEqual(iiif.image_projects(uploaded_image, store), [unicode(project)])
+            self.assertTrue(iiif.may_read(uploaded_image, owner, store))
+            self.assertTrue(iiif.may_read(uploaded_image, reader, store))
+            self.assertFalse(iiif.may_read(uploaded_image, stranger, store))
+            self.assertFalse(iiif.may_read(uploaded_image, AnonymousUser(), store))
+
+            uploaded_image.isPublic = True
+            self.assertTrue(iiif.may_read(uploaded_image, AnonymousUser(), store))
+        finally:
+            ProjectPermission.objects.filter(identifier=project).delete()
+            uploaded_image.delete()
+            for user in (owner, reader, stranger):
+                user.delete()
+            store.destroy(store.path)
+
+    def test_least_recently_used_responses_are_evicted(self):
+        from semantic_store import iiif
+
+        cache = iiif.DerivativeCache(os.path.join(self.directory, 'cache'), 250)
+        cache.put(1, 'a', 'a' * 100)
+        cache.put(1, 'b', 'b' * 100)
+        os.utime(cache.path(1, 'a'), (0, 0))
+        os.utime(cache.path(1, 'b'), (1, 1))
+        self.assertEqual(cache.get(1, 'a'), 'a' * 100)
+
+        cache.put(2, 'c', 'c' * 100)
+        self.assertEqual(cache.get(1, 'b'), None)
+        self.assertEqual(cache.get(1, 'a'), 'a' * 100)
+        self.assertEqual(cache.get(2, 'c'), 'c' * 100)
+
+        cache.forget(1)
+        self.assertEqual(cache.get(1, 'a'), None)
@@ -3,6 +3,7 @@ from urlparse import urljoin
 from django.core.urlresolvers import reverse
 from django.conf import settings
 from django.utils.http import urlquote
+from urllib import unquote
 from semantic_store.namespaces import NS
 
 from rdflib import URIRef
@@ -27,6 +28,23 @@ def uuid():
 def project_metadata_graph_identifier(project_uri):
     return URIRef(uri('semantic_store_projects', uri=project_uri) + '/metadata')
 
+_project_graph_prefix = []
+
+def project_of_graph(identifier):
+    """The uri of the project whose project graph has the identifier, or None if it is not a project graph"""
+    if not _project_graph_prefix:
+        _project_graph_prefix.append(unicode(uri('semantic_store_projects', uri='x'))[:-1])
+    prefix = _project_graph_prefix[0]
+
+    # The uris of project graphs end with the project uri, which cannot contain a slash
+    identifier = unicode(identifier)
+    if identifier.startswith(prefix) and '/' not in identifier[len(prefix):]:
+        return URIRef(unquote(identifier[len(prefix):].encode('utf-8')).decode('utf-8'))
+    return None
+
+def canvas_view_graph_identifier(project_uri, canvas_uri):
+    return uri('semantic_store_project_canvases', project_uri=project_uri, canvas_uri=canvas_uri)
+
 def add_is_described_bys(graph, project_uri):
     for uri in graph.subjects(NS.rdf.type, NS.sc.Canvas):
         canvas_url = url('semantic_store_project_canvases', project_uri=project_uri, canvas_uri=uri)
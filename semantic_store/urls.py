@@ -39,6 +39,22 @@ urlpatterns = patterns('',
         semantic_store.views.project_canvases,
         name="semantic_store_project_canvases"),
 
+    url(r'^images/(?P<identifier>\d+)/?$',
+        semantic_store.views.IIIFImageService.as_view(),
+        name="semantic_store_iiif_service"),
+
+    url(r'^images/(?P<identifier>\d+)/info\.json$',
+        semantic_store.views.IIIFImageInfo.as_view(),
+        name="semantic_store_iiif_info"),
+
+    url(r'^images/(?P<identifier>\d+)/(?P<region>[^/]+)/(?P<size>[^/]+)/(?P<rotation>[^/]+)/(?P<quality>[^/.]+)\.(?P<format>\w+)$',
+        semantic_store.views.IIIFImage.as_view(),
+        name="semantic_store_iiif_image"),
+
+    url(r'^projects/(?P<project_uri>[^/]+)/canvas_batch/?$',
+        semantic_store.views.ProjectCanvasBatch.as_view(),
+        name="semantic_store_project_canvas_batch"),
+
     url(r'^projects/(?P<project_uri>[^/]+)/manuscripts(?:/(?P<manuscript_uri>.+))?/?$',
         semantic_store.views.Manuscript.as_view(),
         name="semantic_store_project_manuscripts"),
@@ -51,6 +67,22 @@ urlpatterns = patterns('',
         semantic_store.views.remove_project_triples,
         name="semantic_store_projects_remove_triples"),
 
+    url(r'^projects/(?P<project_uri>[^/]+)/contents/?$',
+        semantic_store.views.ProjectContents.as_view(),
+        name="semantic_store_project_contents"),
+
+    url(r'^projects/(?P<project_uri>[^/]+)/changes/?$',
+        semantic_store.views.ProjectChanges.as_view(),
+        name="semantic_store_project_changes"),
+
+    url(r'^projects/(?P<project_uri>[^/]+)/deletion/?$',
+        semantic_store.views.ProjectDeletionStatus.as_view(),
+        name="semantic_store_project_deletion"),
+
+    url(r'^projects/(?P<project_uri>[^/]+)/summary/?$',
+        semantic_store.views.ProjectSummary.as_view(),
+        name="semantic_store_project_summary"),
+
     url(r'^projects(?:/(?P<project_uri>[^/]+))/download\.(?P<extension>[\w\d]+)$',
         semantic_store.views.ProjectDownload.as_view(),
         name="semantic_store_projects_download"),
@@ -1,4 +1,7 @@
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
 from django.db import transaction, IntegrityError
 from django.http import HttpResponse, HttpResponseNotFound, HttpResponseForbidden
@@ -6,7 +9,7 @@ from django.http import HttpResponse, HttpResponseNotFound, HttpResponseForbidde
 from rdflib import Graph, URIRef, ConjunctiveGraph, Literal
 from rdflib.exceptions import ParserError
 
-from semantic_store.rdfstore import rdfstore
+from semantic_store.rdfstore import rdfstore, gather
 from semantic_store.namespaces import bind_namespaces,NS
 from semantic_store import uris
 from semantic_store.utils import NegotiatedGraphResponse, parse_request_into_graph, metadata_triples
@@ -23,8 +26,13 @@ from semantic_store.permissions import (
     revoke_permission_by_uri
 )
 
+from collections import OrderedDict
+
 USER_GRAPH_IDENTIFIER = URIRef('http://dm.drew.edu/store/users')
 
+# Cached user metadata is removed when the user is saved, so this only bounds the size of the cache
+USER_METADATA_CACHE_TIMEOUT = 24 * 60 * 60
+
 def user_uri(username=None, user=None):
     if user is None:
         user = User.objects.get(username=username)
@@ -55,6 +63,62 @@ def user_metadata_graph(username=None, user=None):
 
     return graph
 
+def user_metadata_cache_key(pk):
+    return 'semantic_store.user_metadata.%d' % pk
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_user_metadata(sender, instance, **kwargs):
+    cache.delete(user_metadata_cache_key(instance.pk))
+
+def cached_user_metadata(users):
+    """
+    Returns the triples of each user's metadata graph, in order, from the cache, building (and
+    caching) those of the users which are not cached, with a single cache round trip each way
+    """
+    keys = [user_metadata_cache_key(user.pk) for user in users]
+    cached = cache.get_many(keys)
+
+    missing = {}
+    for user, key in zip(users, keys):
+        if key not in cached:
+            missing[key] = cached[key] = list(user_metadata_graph(user=user))
+    if missing:
+        cache.set_many(missing, USER_METADATA_CACHE_TIMEOUT)
+
+    return [cached[key] for key in keys]
+
+def permissions_by_user(project_uri):
+    """
+    Reads the permissions over a project, with their users, in one joined query. Returns an
+    OrderedDict of {user: [permission model values]}.
+    """
+    by_user = OrderedDict()
+    by_pk = {}
+    for permission in (ProjectPermission.objects.filter(identifier=project_uri).select_related('user')
+                       .order_by('user__username', 'permission')):
+        user = by_pk.setdefault(permission.user_id, permission.user)
+        by_user.setdefault(user, []).append(permission.permission)
+    return by_user
+
+def project_users_graph(project_uri, user_permissions):
+    """
+    Returns a graph of the metadata of the users with permissions over a project, and of their
+    permissions, given the OrderedDict of permissions_by_user
+    """
+    project_uri = URIRef(project_uri)
+    graph = Graph()
+
+    for (user, model_values), triples in zip(user_permissions.items(), cached_user_metadata(list(user_permissions))):
+        user_uri = URIRef(uris.uri('semantic_store_users', username=user.username))
+
+        graph += triples
+        graph.add((user_uri, NS.perm.hasPermissionOver, project_uri))
+        for model_value in model_values:
+            graph.add((user_uri, PERMISSION_URIS_BY_MODEL_VALUE[model_value], project_uri))
+
+    return graph
+
 def user_graph(request, username=None, user=None):
     if user is None:
         user = User.objects.get(username=username)
@@ -66,7 +130,7 @@ def user_graph(request, username=None, user=None):
     user_uri = URIRef(uris.uri('semantic_store_users', username=username))
     graph = Graph()
 
-    graph += user_metadata_graph(user=user)
+    graph += cached_user_metadata([user])[0]
 
     graph += user_graph.triples((user_uri, NS.dm.lastOpenProject, None))
 
@@ -77,15 +141,20 @@ def user_graph(request, username=None, user=None):
         graph.add((user_uri, NS.perm.hasPermissionOver, project_uri))
         graph.add((user_uri, perm_uri, project_uri))
 
-    # Add metadata info about projects
-    for project in graph.objects(user_uri, NS.perm.hasPermissionOver):
+    # Add metadata info about projects, reading the project graphs concurrently
+    projects = list(graph.objects(user_uri, NS.perm.hasPermissionOver))
+
+    def project_metadata(project):
         project_graph_identifier = URIRef(uris.uri('semantic_store_projects', uri=project))
         project_graph = Graph(store=rdfstore(), identifier=project_graph_identifier)
 
+        return lambda: list(metadata_triples(project_graph, project))
+
+    for project, triples in zip(projects, gather(user_graph, [project_metadata(project) for project in projects])):
         project_url = uris.url("semantic_store_projects", uri=project)
         graph.add((project, NS.ore.isDescribedBy, URIRef(project_url)))
 
-        for t in metadata_triples(project_graph, project):
+        for t in triples:
             graph.add(t)
 
     #TODO: dm:lastOpenProject
@@ -109,8 +178,8 @@ def read_user(request, username=None):
 def read_all_users(request):
     g = Graph()
     bind_namespaces(g)
-    for u in User.objects.filter():
-        g += user_metadata_graph(user=u)
+    for triples in cached_user_metadata(list(User.objects.filter())):
+        g += triples
 
     return NegotiatedGraphResponse(request, g)
 
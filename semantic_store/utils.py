@@ -159,6 +159,11 @@ def print_triples(triples):
     else:
         print serialization
 
+def unique(items):
+    """Returns a list of the distinct items of an iterable, in the order they were first seen"""
+    seen = set()
+    return [item for item in items if not (item in seen or seen.add(item))]
+
 def b_nodes(graph):
     for s in graph.subjects(None, None):
         if isinstance(s, BNode):
@@ -15,29 +15,32 @@ from django.views.generic.base import View
 from django.contrib.auth.models import User
 from django.utils.text import slugify
 from django.utils.decorators import method_decorator
+from django.utils.cache import patch_vary_headers, patch_cache_control
 
 from rdflib import Graph, ConjunctiveGraph, URIRef
 from rdflib.util import guess_format
 import rdflib.plugin
 
 from semantic_store import collection, permissions, manuscripts
-from semantic_store.models import ProjectPermission, UploadedImage
+from semantic_store.models import ProjectPermission, UploadedImage, Text
 from semantic_store.namespaces import NS, ns, bind_namespaces
 from semantic_store.utils import NegotiatedGraphResponse, JsonResponse, parse_request_into_graph, RDFLIB_SERIALIZER_FORMATS, get_title, metadata_triples
 from semantic_store.rdfstore import rdfstore, default_identifier
 from semantic_store.annotation_views import create_or_update_annotations, get_annotations, search_annotations
-from semantic_store.projects import create_project_from_request, create_project, read_project, update_project, delete_triples_from_project, get_project_graph, project_export_graph, get_project_metadata_graph
+from semantic_store.projects import create_project_from_request, create_project, read_project, update_project, delete_project_from_request, delete_triples_from_project, get_project_graph, project_export_graph, get_project_metadata_graph, add_is_described_bys
 from semantic_store import uris
-from semantic_store.users import read_user, update_user, remove_triples_from_user
+from semantic_store.users import read_user, update_user, remove_triples_from_user, USER_GRAPH_IDENTIFIER
 from semantic_store.canvases import read_canvas, update_canvas, remove_canvas_triples, create_canvas_from_upload
 from semantic_store.specific_resources import read_specific_resource, update_specific_resource
 from semantic_store.annotations import resource_annotation_subgraph
 
 from semantic_store.project_texts import create_project_text_from_request, read_project_text, update_project_text_from_request, remove_project_text
 
-from semantic_store import text_search
+from semantic_store import text_search, queries, project_metadata, exports, project_contents, changelog, project_deletion, canvas_views, image_derivatives, iiif
+from semantic_store.conditional import conditional
 
 from os import listdir
+import urllib
 
 def check_project_resource_permissions(fn):
     def inner(request, *args, **kwargs):
@@ -79,7 +82,7 @@ def projects(request, uri=None):
         if not uri:
             return HttpResponse(status=400, 
                                 content="Project delete request must specify URI.")
-        return delete_project(request, uri)
+        return delete_project_from_request(request, uri)
     else:
         return HttpResponseNotAllowed(['POST', 'PUT', 'DELETE', 'GET'])
 
@@ -191,12 +194,7 @@ DEFAULT_PASSWORD_STRING="DefaultPassword"
 #  as their password
 def add_all_users(graph):
     bind_namespaces(graph)
-    query = graph.query("""SELECT ?user ?email
-                        WHERE {
-                            ?user perm:hasPermissionOver ?project .
-                            ?user foaf:mbox ?email .
-                            ?user rdf:type foaf:Agent
-                        }""", initNs = ns)
+    query = queries.run('user_emails', graph)
 
     for q in query:
         username = ""
@@ -219,7 +217,12 @@ def add_all_users(graph):
 def remove_project_triples(request, uri):
     return delete_triples_from_project(request, uri)
 
+def project_text_dependencies(request, project_uri, text_uri):
+    texts = Text.objects.filter(identifier=text_uri, valid=True, project=project_uri).values_list('timestamp', flat=True)
+    return [uris.uri('semantic_store_projects', uri=project_uri)], list(texts)
+
 @check_project_resource_permissions
+@conditional(project_text_dependencies)
 def project_texts(request, project_uri, text_uri):
     if request.method == 'POST':
         return create_project_text_from_request(request, project_uri)
@@ -235,9 +238,19 @@ def project_texts(request, project_uri, text_uri):
         return HttpResponseNotAllowed(['POST', 'PUT', 'DELETE', 'GET'])
 
 
+def user_dependencies(request, username=None):
+    graphs = [USER_GRAPH_IDENTIFIER]
+    values = list(User.objects.filter(username=username).values_list('username', 'email', 'first_name', 'last_name'))
+    for identifier, permission in ProjectPermission.objects.filter(user__username=username).values_list('identifier', 'permission'):
+        graphs.append(uris.uri('semantic_store_projects', uri=identifier))
+        values.append((identifier, permission))
+    return graphs, values
+
 # @login_required
 def users(request, username=None):
     if request.method == 'GET':
+        if username:
+            return conditional(user_dependencies)(read_user)(request, username)
         return read_user(request, username)
     elif request.method == 'PUT':
         if not username:
@@ -250,13 +263,18 @@ def users(request, username=None):
 def remove_user_triples(request, username):
     return remove_triples_from_user(request, username)
 
+def project_canvas_dependencies(request, project_uri, canvas_uri):
+    return [uris.uri('semantic_store_projects', uri=project_uri)], []
+
 @check_project_resource_permissions
+@conditional(project_canvas_dependencies)
 def project_canvases(request, project_uri, canvas_uri):
     if request.method == 'GET':
         return NegotiatedGraphResponse(request, read_canvas(request, project_uri, canvas_uri))
     elif request.method == 'PUT':
         input_graph = parse_request_into_graph(request)
-        return NegotiatedGraphResponse(request, update_canvas(project_uri, canvas_uri, input_graph))
+        project_graph, delta = update_canvas(project_uri, canvas_uri, input_graph)
+        return delta.add_headers(NegotiatedGraphResponse(request, project_graph))
     else:
         return HttpResponseNotAllowed(('GET', 'PUT'))
 
@@ -287,7 +305,10 @@ def specific_resource_graph(request, project_uri, specific_resource, source):
         return NegotiatedGraphResponse(request, read_specific_resource(project_uri, specific_resource, source))
     elif request.method == 'PUT':
         g = parse_request_into_graph(request)
-        update_specific_resource(g, URIRef(project_uri), URIRef(specific_resource))
+        delta = update_specific_resource(g, URIRef(project_uri), URIRef(specific_resource))
+        return delta.add_headers(HttpResponse(status=204))
+    else:
+        return HttpResponseNotAllowed(('GET', 'PUT'))
 
 class ProjectDownload(View):
     @method_decorator(check_project_resource_permissions)
@@ -307,7 +328,15 @@ class ProjectDownload(View):
 
         project_title = get_title(db_project_graph, project_uri) or u'untitled project'
 
-        response = StreamingHttpResponse(serialization_iterator(project_uri, format), mimetype='text/%s' % extension)
+        if format in exports.STREAMING_FORMATS:
+            compress = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+            response = StreamingHttpResponse(exports.stream_project_export(project_uri, format, compress),
+                                             mimetype='text/%s' % extension)
+            if compress:
+                response['Content-Encoding'] = 'gzip'
+            patch_vary_headers(response, ('Accept-Encoding',))
+        else:
+            response = StreamingHttpResponse(serialization_iterator(project_uri, format), mimetype='text/%s' % extension)
         response['Content-Disposition'] = 'attachment; filename=%s.%s' % (slugify(project_title), extension)
 
         return response
@@ -340,6 +369,176 @@ class SearchAutocomplete(View):
 
         return JsonResponse(text_search.get_autocomplete(project_uri, query))
 
+def project_metadata_dependencies(request, project_uri):
+    return [uris.project_metadata_graph_identifier(project_uri)], []
+
+class ProjectContents(View):
+    @method_decorator(check_project_resource_permissions)
+    @method_decorator(conditional(project_metadata_dependencies))
+    def get(self, request, project_uri):
+        project_uri = URIRef(project_uri)
+
+        try:
+            limit = int(request.GET['limit']) if 'limit' in request.GET else None
+            types = [queries.uri(t) for t in request.GET.getlist('type')]
+            graph, next_cursor = project_contents.contents_page(project_uri, request.GET.get('cursor'), limit, types)
+        except (ValueError, queries.BindingError) as e:
+            return HttpResponseBadRequest(str(e))
+
+        add_is_described_bys(request, project_uri, graph)
+        response = NegotiatedGraphResponse(request, graph)
+
+        if next_cursor:
+            parameters = [('cursor', next_cursor)] + [('type', t.encode('utf-8')) for t in types]
+            if limit is not None:
+                parameters.append(('limit', limit))
+            next_url = uris.url('semantic_store_project_contents', project_uri=project_uri) + '?' + urllib.urlencode(parameters)
+            response['Link'] = '<%s>; rel="next"' % next_url
+
+        return response
+
+class ProjectSummary(View):
+    @method_decorator(check_project_resource_permissions)
+    @method_decorator(conditional(project_metadata_dependencies))
+    def get(self, request, project_uri):
+        return NegotiatedGraphResponse(request, project_contents.contents_summary(project_uri))
+
+class ProjectChanges(View):
+    @method_decorator(check_project_resource_permissions)
+    def get(self, request, project_uri):
+        try:
+            since = int(request.GET.get('since', 0))
+        except ValueError:
+            return HttpResponseBadRequest('"since" must be a revision number')
+
+        try:
+            revision, patch = rdfstore().changelog.changes_since(project_uri, since)
+        except changelog.ChangesTruncated as e:
+            return HttpResponse(str(e), status=410)
+
+        response = HttpResponse(patch.encode('utf-8'), content_type=changelog.RDF_PATCH_MIMETYPE)
+        response['X-Project-Revision'] = str(revision)
+        return response
+
+class ProjectDeletionStatus(View):
+    @method_decorator(login_required)
+    def get(self, request, project_uri):
+        deletion = project_deletion.latest_deletion(project_uri)
+        if deletion is None:
+            return HttpResponseNotFound('Project "%s" is not being deleted' % project_uri)
+        if deletion.requested_by_id != request.user.pk and not request.user.is_staff:
+            return HttpResponseForbidden('User "%s" did not request the deletion of project "%s"' % (request.user.username, project_uri))
+
+        return JsonResponse(project_deletion.status(deletion))
+
+def canvas_batch_max_size_setting():
+    return getattr(settings, 'CANVAS_BATCH_MAX_SIZE', 50)
+
+def project_canvas_batch_dependencies(request, project_uri):
+    return [uris.uri('semantic_store_projects', uri=project_uri)], [request.GET.urlencode()]
+
+class ProjectCanvasBatch(View):
+    """
+    The graphs of several canvases of a project, e.g. the pages a manuscript viewer is about to
+    turn to, read together. The canvases are given either as uri parameters, or as a range of a
+    sequence: sequence (or manuscript, for its first sequence), start and count. With stream=1, each
+    canvas's graph is sent as N-Quads as soon as it has been read, named by the canvas's view graph.
+    """
+    def canvas_uris(self, request, project_uri):
+        if 'uri' in request.GET:
+            return [URIRef(uri) for uri in request.GET.getlist('uri')]
+
+        project_graph = get_project_graph(project_uri)
+        sequence_uri = request.GET.get('sequence')
+        if not sequence_uri and request.GET.get('manuscript'):
+            sequence_uri = manuscripts.first_sequence(project_graph, request.GET['manuscript'])
+        if not sequence_uri:
+            raise ValueError('Either uri, sequence or manuscript must be given')
+
+        start = int(request.GET.get('start', 0))
+        count = int(request.GET.get('count', canvas_batch_max_size_setting()))
+        if start < 0 or count < 0:
+            raise ValueError('start and count must not be negative')
+        return manuscripts.sequence_canvas_range(project_graph, sequence_uri, start, count)
+
+    @method_decorator(check_project_resource_permissions)
+    @method_decorator(conditional(project_canvas_batch_dependencies))
+    def get(self, request, project_uri):
+        project_uri = URIRef(project_uri)
+
+        try:
+            canvas_uris = self.canvas_uris(request, project_uri)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+
+        if len(canvas_uris) > canvas_batch_max_size_setting():
+            return HttpResponseBadRequest('At most %d canvases can be read at once' % canvas_batch_max_size_setting())
+
+        views = canvas_views.iter_views(project_uri, canvas_uris)
+
+        if request.GET.get('stream'):
+            def serialized_views():
+                for canvas_uri, graph in views:
+                    identifier = uris.canvas_view_graph_identifier(project_uri, canvas_uri)
+                    quads = ((s, p, o, identifier) for s, p, o in graph)
+                    yield u''.join(exports.nquads_lines(quads)).encode('utf-8')
+
+            return StreamingHttpResponse(serialized_views(), mimetype='text/nquads')
+        else:
+            graph = Graph()
+            for canvas_uri, canvas_graph in views:
+                graph += canvas_graph
+            return NegotiatedGraphResponse(request, graph)
+
+def iiif_headers(response):
+    response['Link'] = '<%s>;rel="profile"' % iiif.PROFILE
+    response['Access-Control-Allow-Origin'] = '*'
+    return response
+
+def readable_uploaded_image(request, identifier):
+    """Returns the uploaded image and None, or None and the response refusing it"""
+    try:
+        uploaded_image = UploadedImage.objects.get(pk=identifier)
+    except UploadedImage.DoesNotExist:
+        return None, HttpResponseNotFound('Image "%s" does not exist' % identifier)
+
+    if not iiif.may_read(uploaded_image, request.user):
+        return None, HttpResponseForbidden() if request.user.is_authenticated() else HttpResponse(status=401)
+    return uploaded_image, None
+
+class IIIFImageService(View):
+    def get(self, request, identifier):
+        response = HttpResponse(status=303)
+        response['Location'] = uris.url('semantic_store_iiif_info', identifier=identifier)
+        return response
+
+class IIIFImageInfo(View):
+    def get(self, request, identifier):
+        uploaded_image, refusal = readable_uploaded_image(request, identifier)
+        if refusal is not None:
+            return refusal
+
+        mimetype = 'application/ld+json' if 'application/ld+json' in request.META.get('HTTP_ACCEPT', '') else 'application/json'
+        return iiif_headers(JsonResponse(iiif.info(uploaded_image), mimetype=mimetype))
+
+class IIIFImage(View):
+    def get(self, request, identifier, region, size, rotation, quality, format):
+        uploaded_image, refusal = readable_uploaded_image(request, identifier)
+        if refusal is not None:
+            return refusal
+
+        try:
+            data, mimetype = iiif.image_response(uploaded_image, region, size, rotation, quality, format)
+        except iiif.ImageRequestError as e:
+            return HttpResponse(str(e), status=e.status, content_type='text/plain')
+
+        response = HttpResponse(data, content_type=mimetype)
+        if uploaded_image.isPublic:
+            patch_cache_control(response, public=True, max_age=iiif.max_age_setting())
+        else:
+            patch_cache_control(response, private=True, max_age=iiif.max_age_setting())
+        return iiif_headers(response)
+
 class Manuscript(View):
     def manuscript_graph(self, manuscript_uri, project_uri):
         project_graph = get_project_graph(project_uri)
@@ -405,8 +604,11 @@ class CanvasUpload(View):
         # Make the canvas a top level project resource
         canvas_graph.add((project_uri, NS.ore.aggregates, uri))
 
-        project_graph += canvas_graph
-        project_metadata_graph += canvas_graph
+        with project_metadata.maintaining(project_uri), rdfstore().batch():
+            project_graph += canvas_graph
+
+        # The thumbnails and tiles are described in the project graph once they have been generated
+        image_derivatives.request_derivatives(uploaded)
 
         canvas_graph += metadata_triples(project_metadata_graph, project_uri)
         canvas_graph += project_metadata_graph.triples((project_uri, NS.ore.aggregates, None))
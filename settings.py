@@ -54,7 +54,21 @@ LOGGING = {
             'level': 'ERROR',
             'filters': ['require_debug_false'],
             'class': 'django.utils.log.AdminEmailHandler'
-        }
+        },
+        # Store statistics of each request and slow queries, as JSON lines (see
+        # semantic_store.instrumentation); set STORE_INSTRUMENTATION_LOG to write them to a file
+        'store_instrumentation': {
+            'class': 'logging.handlers.WatchedFileHandler',
+            'filename': STORE_INSTRUMENTATION_LOG,
+            'formatter': 'message',
+        } if 'STORE_INSTRUMENTATION_LOG' in globals() else {
+            'class': 'django.utils.log.NullHandler',
+        },
+    },
+    'formatters': {
+        'message': {
+            'format': '%(message)s',
+        },
     },
     'loggers': {
         'django.request': {
@@ -62,6 +76,11 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        'semantic_store.instrumentation': {
+            'handlers': ['store_instrumentation'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     }
 }
 
@@ -97,6 +116,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'semantic_store.instrumentation.StoreInstrumentationMiddleware',
 )
 
 RDFLIB_STORE_IDENTIFIER = 'rdfstore'